@@ -0,0 +1,228 @@
+import csv
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+"""
+
+py file containing the opt-in stage profiler shared by the elicitation and eval pipelines. Every named stage gets
+its wall and CPU time, the peak of the traced Python memory (tracemalloc) and the call stacks of a sampling profiler
+(all threads, every `interval` seconds). Reports are written per stage as folded stacks (flamegraph.pl / speedscope
+input) and as top-N tables of the functions by self and cumulative samples. It is disabled by default, in which
+case `stage` returns a no-op context manager
+
+Like the telemetry registry it lives in the common directory, with symlinks in eval/ and elicitation/
+"""
+
+
+class _NullStage:
+    """
+    Context manager returned by `StageProfiler.stage` when profiling is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.samples = Counter()
+        self.peak = 0
+        self.wall_start = None
+        self.cpu_start = None
+        self.memory_start = 0
+
+    def __enter__(self):
+        self.profiler._enter(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler._exit(self)
+        return False
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StageProfiler:
+    def __init__(self, enabled: bool = False, interval: float = 0.005, top_n: int = 30):
+        """
+        Per stage CPU and memory profiler
+
+        Arguments:
+            enabled (bool): Profile the stages or not, when False every call is a no-op
+            interval (float): Seconds between two stack samples
+            top_n (int): Number of functions listed in the top-N reports
+        """
+        self.enabled = enabled
+        self.interval = interval
+        self.top_n = top_n
+        self._lock = threading.Lock()
+        self._active = []
+        self._stages = {}
+        self._sampler = None
+        self._stopped = threading.Event()
+
+    def enable(self):
+        """
+        Start tracing the memory allocations and the sampling thread, allocations slow a run down noticeably
+        """
+        if self.enabled:
+            return
+        self.enabled = True
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._stopped.clear()
+        self._sampler = threading.Thread(target=self._sample_loop, name="stage-profiler", daemon=True)
+        self._sampler.start()
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._stopped.set()
+        self._sampler.join()
+        tracemalloc.stop()
+
+    def stage(self, name):
+        """
+        Context manager profiling a named stage, stages may be nested and a stage entered several times (e.g. once
+        per file) is reported as one
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def _fold_peak(self):
+        # the traced peak since the last reset counts for every active stage, nested stages keep the outer peaks right
+        peak = tracemalloc.get_traced_memory()[1]
+        for stage in self._active:
+            stage.peak = max(stage.peak, peak)
+        tracemalloc.reset_peak()
+
+    def _enter(self, stage):
+        with self._lock:
+            self._fold_peak()
+            stage.memory_start = tracemalloc.get_traced_memory()[0]
+            stage.wall_start = time.perf_counter()
+            stage.cpu_start = time.process_time()
+            self._active.append(stage)
+
+    def _exit(self, stage):
+        wall = time.perf_counter() - stage.wall_start
+        cpu = time.process_time() - stage.cpu_start
+        with self._lock:
+            self._fold_peak()
+            self._active.remove(stage)
+            record = self._stages.setdefault(stage.name, {
+                "calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0, "peak_bytes": 0, "peak_increase_bytes": 0, "samples": Counter(),
+            })
+            record["calls"] += 1
+            record["wall_seconds"] += wall
+            record["cpu_seconds"] += cpu
+            record["peak_bytes"] = max(record["peak_bytes"], stage.peak)
+            record["peak_increase_bytes"] = max(record["peak_increase_bytes"], stage.peak - stage.memory_start)
+            record["samples"].update(stage.samples)
+
+    def _sample_loop(self):
+        sampler_thread_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                if not self._active:
+                    continue
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stacks = []
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == sampler_thread_id:
+                        continue
+                    labels = []
+                    while frame is not None:
+                        labels.append(frame_label(frame.f_code))
+                        frame = frame.f_back
+                    labels.append(f"thread {thread_names.get(thread_id, thread_id)}")
+                    stacks.append(";".join(reversed(labels)))
+                for stage in self._active:
+                    stage.samples.update(stacks)
+
+    @staticmethod
+    def top_functions(samples):
+        """
+        Self (leaf frame) and cumulative (anywhere on the stack) sample counts per function
+        """
+        self_counts, cumulative_counts = Counter(), Counter()
+        for stack, count in samples.items():
+            frames = stack.split(";")[1:]
+            if not frames:
+                continue
+            self_counts[frames[-1]] += count
+            for frame in set(frames):
+                cumulative_counts[frame] += count
+        return self_counts, cumulative_counts
+
+    def write_stage_report(self, output_dir, name, record):
+        file_name = re.sub(r"[^\w.-]+", "_", name)
+        with open(os.path.join(output_dir, f"{file_name}.folded"), "w") as f:
+            for stack, count in sorted(record["samples"].items()):
+                f.write(f"{stack} {count}\n")
+
+        total = sum(record["samples"].values())
+        self_counts, cumulative_counts = self.top_functions(record["samples"])
+        lines = [
+            f"stage: {name} ({record['calls']} calls)",
+            f"wall: {record['wall_seconds']:.3f}s  cpu: {record['cpu_seconds']:.3f}s  "
+            f"(cpu / wall {record['cpu_seconds'] / record['wall_seconds'] if record['wall_seconds'] else 0.0:.0%}, "
+            f"the rest is waiting on network, disk or locks)",
+            f"traced memory peak: {record['peak_bytes'] / 2**20:.1f} MiB "
+            f"(+{record['peak_increase_bytes'] / 2**20:.1f} MiB during the stage)",
+            f"samples: {total} every {self.interval * 1000:g} ms, over all threads",
+        ]
+        for title, counts in (("self", self_counts), ("cumulative", cumulative_counts)):
+            lines += ["", f"top {self.top_n} functions by {title} samples:"]
+            for frame, count in counts.most_common(self.top_n):
+                lines.append(f"{count:>8} {count / total if total else 0.0:>7.1%}  {frame}")
+        with open(os.path.join(output_dir, f"{file_name}_top.txt"), "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+    def export(self, output_dir: str, prefix: str = "profile"):
+        """
+        Write the reports of every stage and a `stages.csv` summary into `output_dir/prefix`
+        """
+        if not self.enabled:
+            return
+        profile_dir = os.path.join(output_dir, prefix)
+        os.makedirs(profile_dir, exist_ok=True)
+        with self._lock:
+            stages = {name: dict(record, samples=Counter(record["samples"])) for name, record in self._stages.items()}
+
+        headers = ["stage", "calls", "wall_seconds", "cpu_seconds", "peak_mib", "peak_increase_mib", "samples"]
+        with open(os.path.join(profile_dir, "stages.csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=headers)
+            writer.writeheader()
+            for name, record in stages.items():
+                self.write_stage_report(profile_dir, name, record)
+                writer.writerow({
+                    "stage": name,
+                    "calls": record["calls"],
+                    "wall_seconds": round(record["wall_seconds"], 4),
+                    "cpu_seconds": round(record["cpu_seconds"], 4),
+                    "peak_mib": round(record["peak_bytes"] / 2**20, 2),
+                    "peak_increase_mib": round(record["peak_increase_bytes"] / 2**20, 2),
+                    "samples": sum(record["samples"].values()),
+                })
+
+
+# process wide profiler, enabled from the command line of both CLIs with `--profile`
+profiler = StageProfiler()
@@ -0,0 +1,233 @@
+import json
+import os
+import threading
+import time
+
+"""
+
+py file containing a small in-process metrics registry (counters and histograms) shared by
+the elicitation and eval pipelines. It is disabled by default, in which case every call returns
+immediately, and can be exported as a JSON summary or as a Prometheus text file at the end of a run
+
+It lives in the common directory, eval/telemetry.py and elicitation/telemetry.py are symlinks to it so that the
+flat modules of both directories import it by name
+"""
+
+# default histogram buckets (seconds) used for latency measurements
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class _NullTimer:
+    """
+    Context manager returned by `Telemetry.timer` when telemetry is disabled
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, telemetry, name, labels):
+        self.telemetry = telemetry
+        self.name = name
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.telemetry.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Telemetry:
+    def __init__(self, enabled: bool = False, buckets: tuple = DEFAULT_BUCKETS):
+        """
+        Registry for counters and histograms
+
+        Arguments:
+            enabled (bool): Record metrics or not, when False every call is a no-op
+            buckets (tuple): Upper bounds of the histogram buckets
+        """
+        self.enabled = enabled
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._started_at = time.time()
+
+    def enable(self):
+        self.enabled = True
+        self._started_at = time.time()
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self._started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """
+        Increment the counter `name` with the given labels by `value`
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Record a single observation for the histogram `name` with the given labels
+        """
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = {"count": 0, "sum": 0.0, "min": value, "max": value, "buckets": [0] * len(self.buckets)}
+                self._histograms[key] = histogram
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["min"] = min(histogram["min"], value)
+            histogram["max"] = max(histogram["max"], value)
+            for index, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    histogram["buckets"][index] += 1
+                    break
+
+    def timer(self, name: str, **labels):
+        """
+        Context manager recording the wall time of the enclosed block into the histogram `name`
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name, labels)
+
+    def record_usage(self, usage, **labels):
+        """
+        Record prompt, completion and cached token counts from an OpenAI `usage` object or dict
+        """
+        if not self.enabled or usage is None:
+            return
+        if not isinstance(usage, dict):
+            usage = usage.model_dump() if hasattr(usage, "model_dump") else vars(usage)
+        self.inc("llm_prompt_tokens_total", usage.get("prompt_tokens") or 0, **labels)
+        self.inc("llm_completion_tokens_total", usage.get("completion_tokens") or 0, **labels)
+        prompt_details = usage.get("prompt_tokens_details") or {}
+        self.inc("llm_cached_tokens_total", prompt_details.get("cached_tokens") or 0, **labels)
+
+    def counter_value(self, name: str, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+    def counter_total(self, name: str):
+        """
+        Sum of the counter `name` over all label combinations
+        """
+        with self._lock:
+            return sum(value for (counter_name, _), value in self._counters.items() if counter_name == name)
+
+    def summary(self) -> dict:
+        """
+        Return all recorded metrics as a JSON serialisable dict
+        """
+        with self._lock:
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+            histograms = []
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                histograms.append({
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum": histogram["sum"],
+                    "mean": histogram["sum"] / histogram["count"],
+                    "min": histogram["min"],
+                    "max": histogram["max"],
+                    "buckets": dict(zip([str(b) for b in self.buckets], histogram["buckets"])),
+                })
+
+        return {
+            "started_at": self._started_at,
+            "duration_seconds": time.time() - self._started_at,
+            "counters": counters,
+            "histograms": histograms,
+        }
+
+    def write_json(self, file_path: str):
+        with open(file_path, "w") as json_file:
+            json.dump(self.summary(), json_file, indent=4)
+
+    def write_prometheus(self, file_path: str):
+        """
+        Write the metrics in the Prometheus text exposition format, e.g. for the node exporter textfile collector
+        """
+        def format_labels(labels, extra = None):
+            pairs = list(labels) + (extra or [])
+            if not pairs:
+                return ""
+            escaped = [
+                k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                for k, v in pairs
+            ]
+            return "{" + ",".join(escaped) + "}"
+
+        lines = []
+        with self._lock:
+            seen = set()
+            for (name, labels), value in sorted(self._counters.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} counter")
+                    seen.add(name)
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                if name not in seen:
+                    lines.append(f"# TYPE {name} histogram")
+                    seen.add(name)
+                cumulative = 0
+                for upper_bound, count in zip(self.buckets, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', upper_bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{format_labels(labels)} {histogram['count']}")
+
+        # write to a temporary file first so that a scraper never reads a half written file
+        tmp_file_path = file_path + ".tmp"
+        with open(tmp_file_path, "w") as prom_file:
+            prom_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_file_path, file_path)
+
+    def export(self, output_dir: str, prefix: str = "telemetry"):
+        """
+        Write both the JSON summary and the Prometheus text file into `output_dir`
+        """
+        if not self.enabled:
+            return
+        os.makedirs(output_dir, exist_ok=True)
+        self.write_json(os.path.join(output_dir, f"{prefix}.json"))
+        self.write_prometheus(os.path.join(output_dir, f"{prefix}.prom"))
+
+
+# process wide registry, enabled from the command line of both CLIs with `--collect_telemetry`
+telemetry = Telemetry()
+
@@ -0,0 +1,150 @@
+import json
+import os
+import time
+from collections import Counter
+from loguru import logger
+
+"""
+
+py file containing the per (template, subject) elicitation state. Every template has a state file recording, for
+each subject, whether it was submitted, elicited successfully or failed (with the reason), together with the index
+of the template's `wikidata_triples_<index>.csv`. Submissions only send the subjects without a successful (or
+in flight) result, so adding entities to the list costs an elicitation of the new entities only. Templates without
+a state get an index no other template uses, so adding a template never reuses the files of another one
+"""
+
+SUBMITTED = "submitted"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# deterministic failures (temperature 0), a retry would fail the same way
+NON_RETRYABLE_REASONS = ("refusal=",)
+
+
+class ElicitationState:
+    def __init__(self, state_dir_path: str, source_file_name: str):
+        """
+        Arguments:
+            state_dir_path (str): Directory storing one state file per template
+            source_file_name (str): Name of the jinja template
+        """
+        os.makedirs(state_dir_path, exist_ok=True)
+        self.source_file_name = source_file_name
+        self.state_file_path = os.path.join(state_dir_path, f"{source_file_name}.json")
+
+        self.csv_file_index = None
+        self.subjects = {}
+        if os.path.isfile(self.state_file_path):
+            with open(self.state_file_path, "r") as f:
+                data = json.load(f)
+            self.csv_file_index = data.get("csv_file_index")
+            self.subjects = data.get("subjects", {})
+
+    def status(self, subject):
+        return self.subjects.get(subject, {}).get("status")
+
+    def pending(self, subjects) -> list:
+        """
+        Subjects (in order, without duplicates) which were neither elicited successfully nor are in flight
+        """
+        return [subject for subject in dict.fromkeys(subjects) if self.status(subject) not in (SUCCEEDED, SUBMITTED)]
+
+    def _update(self, subject, **values):
+        record = self.subjects.setdefault(subject, {"attempts": 0})
+        record.update(values)
+        record["updated_at"] = time.time()
+        return record
+
+    def mark_submitted(self, subjects, batch_id):
+        for subject in subjects:
+            record = self._update(subject, status=SUBMITTED, batch_id=batch_id)
+            record["attempts"] += 1
+
+    def mark_succeeded(self, subject):
+        self._update(subject, status=SUCCEEDED, reason=None)
+
+    def mark_failed(self, subject, reason):
+        self._update(subject, status=FAILED, reason=reason)
+
+    def fail_in_flight(self, batch_id, reason):
+        """
+        Mark the subjects of a batch which are still in flight as failed, e.g. after its output was processed
+        """
+        for subject, record in self.subjects.items():
+            if record["status"] == SUBMITTED and record.get("batch_id") == batch_id:
+                self._update(subject, status=FAILED, reason=reason)
+
+    def retryable(self, batch_id, max_attempts: int) -> dict:
+        """
+        Failed subjects of a batch with attempts left and a failure a retry can fix
+
+        Returns:
+            dict: subject -> failure reason
+        """
+        return {
+            subject: record["reason"]
+            for subject, record in self.subjects.items()
+            if record["status"] == FAILED
+            and record.get("batch_id") == batch_id
+            and record["attempts"] < max_attempts
+            and not str(record.get("reason")).startswith(NON_RETRYABLE_REASONS)
+        }
+
+    def counts(self) -> Counter:
+        return Counter(record["status"] for record in self.subjects.values())
+
+    def save(self):
+        tmp_file_path = self.state_file_path + ".tmp"
+        with open(tmp_file_path, "w") as f:
+            json.dump({
+                "source_file_name": self.source_file_name,
+                "csv_file_index": self.csv_file_index,
+                "subjects": self.subjects,
+            }, f)
+        os.replace(tmp_file_path, self.state_file_path)
+        logger.info(f"Elicitation state of {self.source_file_name}: {dict(self.counts())}")
+
+
+def assign_csv_file_indices(state_dir_path: str, source_file_names, jinja_file_mapping_path: str = None) -> dict:
+    """
+    Index of the `wikidata_triples_<index>.csv` (and batch / retry record files) of every template. Templates keep
+    the index saved in their state file (or recorded in the jinja index mapping by older runs), new templates get
+    the smallest indices not used by any other template, in the order of their file names
+
+    Arguments:
+        state_dir_path (str): Directory storing one state file per template
+        source_file_names (list): Names of the jinja templates
+        jinja_file_mapping_path (str): Optional `<source file name> wikidata_triples_<index>` mapping file
+
+    Returns:
+        dict: source file name -> csv file index
+    """
+    known_indices = {}
+    if jinja_file_mapping_path is not None and os.path.isfile(jinja_file_mapping_path):
+        with open(jinja_file_mapping_path, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2 and parts[1].startswith("wikidata_triples_") and parts[1][len("wikidata_triples_"):].isdigit():
+                    known_indices[parts[0]] = int(parts[1][len("wikidata_triples_"):])
+
+    if os.path.isdir(state_dir_path):
+        for file_name in os.listdir(state_dir_path):
+            if not file_name.endswith(".json"):
+                continue
+            with open(os.path.join(state_dir_path, file_name), "r") as f:
+                data = json.load(f)
+            if data.get("csv_file_index") is not None:
+                known_indices[data["source_file_name"]] = int(data["csv_file_index"])
+
+    used_indices = set(known_indices.values())
+    csv_file_indices = {}
+    next_index = 1
+    for source_file_name in sorted(dict.fromkeys(source_file_names)):
+        if source_file_name in known_indices:
+            csv_file_indices[source_file_name] = known_indices[source_file_name]
+            continue
+        while next_index in used_indices:
+            next_index += 1
+        csv_file_indices[source_file_name] = next_index
+        used_indices.add(next_index)
+    return csv_file_indices
@@ -10,9 +10,55 @@ from loguru import logger
 from openai import OpenAI
 from openai.types import Batch as OpenAIBatch
 from tqdm import tqdm
-from prompter_parser import AbstractPrompterParser
+from prompter_parser import AbstractPrompterParser, PromptJSONSchema
 from prompter_parser.exceptions import ParsingException
+from telemetry import telemetry
+from profiler import profiler
+from realtime import run_realtime_requests
+from elicitation_state import ElicitationState, SUCCEEDED
 import re
+import threading
+
+# the jinja index mapping file is shared by all runners, appends from concurrent submissions are serialised
+jinja_file_mapping_lock = threading.Lock()
+
+# output token limit of the retries of truncated elicitations (`finish_reason=length`), doubled per retry
+RETRY_MAX_TOKENS_LIMIT = 16384
+
+# batch statuses whose output (and error) files are processed, the requests an expired batch did not run are
+# listed in its error file and retried like any other failed request
+BATCH_PROCESSED_STATUSES = ("completed", "expired")
+
+# batch statuses after which a batch never completes, its in flight subjects are failed and submitted again
+BATCH_TERMINAL_STATUSES = ("failed", "cancelled")
+
+
+def load_list_of_subjects(wikidata_entities_file_path) -> list[str]:
+    """
+    Read the wikidata entities file and get a list of subjects
+    """
+    with open(wikidata_entities_file_path, 'r') as file:
+        json_content = json.load(file)
+
+    # items are either plain names or dicts with a precomputed QID, e.g. {"name": ..., "qid": ...}
+    return [item["name"] if isinstance(item, dict) else item for key, values in json_content.items() for item in values]
+
+
+def render_batch_request_file(template_path, gpt_model_elicitation, subjects_to_expand, batch_record_file_path):
+    """
+    Render the elicitation request of every subject with a jinja template into a batch request file
+    Top level function so that several templates can be rendered in parallel worker processes
+    """
+    prompter_parser_module = PromptJSONSchema(
+        template_path_elicitation = template_path,
+        gpt_model_elicitation = gpt_model_elicitation
+    )
+    with open(batch_record_file_path, "w") as f:
+        for subject in subjects_to_expand:
+            f.write(json.dumps(prompter_parser_module.get_elicitation_prompt(subject_name=subject)) + "\n")
+
+    return len(subjects_to_expand)
+
 
 class GPTKBCRunner:
     def __init__(
@@ -24,6 +70,8 @@ class GPTKBCRunner:
             job_description: str = "Knowledge Elicitation for Wiki data entities", 
             prompter_parser_module: AbstractPrompterParser = None,
             job_type: str = "verify",
+            realtime_max_concurrency: int = 16,
+            max_retries: int = 2,
         ):
 
         """
@@ -36,7 +84,9 @@ class GPTKBCRunner:
             wikidata_triples_dir (str): Dir path for storing the elicited triples
             job_description (str): String based description of the current job
             prompter_parser_module: Abstract prompter parser class object
-            job_type (str): String type to indicate if its a submit job or verify job
+            job_type (str): String type to indicate if its a submit job, verify job or realtime job
+            realtime_max_concurrency (int): Maximum number of concurrent chat completions requests of a realtime job
+            max_retries (int): Number of automatic retries of a failed subject (truncated, malformed or errored response), 0 disables them
 
         
         """
@@ -49,31 +99,37 @@ class GPTKBCRunner:
         self.job_type = job_type
         self.curr_index = curr_index
         self.source_file_name = source_file_name
+        self.realtime_max_concurrency = realtime_max_concurrency
+        self.max_retries = max_retries
 
         self.tmp_folder = os.getcwd()
         self.wikidata_entities_file_path = wikidata_entities_file_path
 
         self.in_progress_dir_path = os.getcwd() + "/progress_dir/"
         self.completed_dir_path = os.getcwd() + "/completed_dir/"
+        self.terminated_dir_path = os.getcwd() + "/terminated_dir/"
         self.batch_results_dir = os.getcwd() + "/results_dir/"
         self.batch_request_dir = os.getcwd() + "/batch_request/"
         self.csv_dir_path = wikidata_triples_dir
+        self.state_dir = os.getcwd() + "/elicitation_state/"
+
+        # per subject state of the template, keeps the csv index of the template stable across submissions
+        self.elicitation_state = ElicitationState(self.state_dir, source_file_name) if source_file_name else None
+        if self.elicitation_state is not None and self.elicitation_state.csv_file_index is not None:
+            self.curr_index = self.elicitation_state.csv_file_index
 
         self.jinja_file_mapping = os.path.abspath(os.path.join(os.getcwd(), "..", "jinja_index_mapping.txt"))
         #self.jinja_file_mapping = os.getcwd() + '/jinja_index_mapping.txt'
 
-        # file path used for storing temporary batch json objects until they are submitted
-        self.batch_record_file_path = os.getcwd() + "/batch_records.jsonl"
+        # file path used for storing temporary batch json objects until they are submitted, one per template
+        self.batch_record_file_path = os.path.join(self.batch_request_dir, f"batch_records_{self.curr_index}.jsonl")
     
 
     def get_list_of_subjects(self) -> list[str]:
         """
         Read the wikidata entities file and get a list of subjects
         """
-        with open(self.wikidata_entities_file_path, 'r') as file:
-            json_content = json.load(file)
-
-        all_values = [item for key, values in json_content.items() for item in values]
+        all_values = load_list_of_subjects(self.wikidata_entities_file_path)
         random_entities = random.sample(all_values, 15)
 
         # change it if you want to sample
@@ -81,6 +137,16 @@ class GPTKBCRunner:
 
 
         return all_values
+
+    def pending_subjects(self, subjects: list[str]) -> list[str]:
+        """
+        Subjects of the list without a successful (or in flight) elicitation for this template
+        """
+        if self.elicitation_state is None:
+            return subjects
+        pending = self.elicitation_state.pending(subjects)
+        logger.info(f"{len(pending)} of {len(subjects)} subjects need an elicitation with {self.source_file_name}.")
+        return pending
     
     def create_dir(self):
         directory_list = [
@@ -91,8 +157,23 @@ class GPTKBCRunner:
         ]
 
         for directory in directory_list:
-            if not os.path.exists(directory):
-                os.makedirs(directory)
+            os.makedirs(directory, exist_ok=True)
+
+    def template_runner(self, source_file_name: str, csv_file_index: int):
+        """
+        Runner of one template, used by verify to process (and retry) a batch with the elicitation state of its template
+        """
+        gpt_runner = GPTKBCRunner(
+            source_file_name = source_file_name,
+            curr_index = csv_file_index,
+            wikidata_entities_file_path = self.wikidata_entities_file_path,
+            wikidata_triples_dir = self.csv_dir_path,
+            job_description = self.job_description,
+            job_type = self.job_type,
+            max_retries = self.max_retries,
+        )
+        gpt_runner.openai_client = self.openai_client
+        return gpt_runner
 
     def loop(self, subjects_to_expand):
         """
@@ -101,68 +182,242 @@ class GPTKBCRunner:
         logger.info("Starting the main loop ...")
         self.create_dir()
 
+        if self.job_type in ("submit", "realtime"):
+            subjects_to_expand = self.pending_subjects(subjects_to_expand)
+            if not subjects_to_expand:
+                logger.info(f"All subjects were already elicited with {self.source_file_name}, nothing to submit.")
+                return
+
         if self.job_type == "submit":
             logger.info("Job type is 'submit'. Submitting a new batch directly.")
             self.create_batch_dir(subjects_to_expand)
 
+        elif self.job_type == "realtime":
+            logger.info("Job type is 'realtime'. Sending the requests directly to the chat completions endpoint.")
+            self.run_realtime(subjects_to_expand)
 
         elif self.job_type == "verify":
 
             logger.info("Job type is 'verify'. Processing completed batches...")
 
-            if self.check_batch_status_dir() == True:
+            with profiler.stage("check_batch_status"):
+                batches_completed = self.check_batch_status_dir()
+
+            if batches_completed == True:
                 # Batch has completed, read the batch
                 for file_name in os.listdir(self.completed_dir_path):
                     completed_file_path = os.path.join(self.completed_dir_path, file_name)
                     with open(completed_file_path, 'r') as f:
                         data = json.load(f)
                         batch_file_id = data.get('batch_id')
-                        match = re.search(r'completed_(\d+)\.json', file_name)
-                        file_index = str(match.group(1))
+                        match = re.search(r'completed_((\d+)(?:_.*)?)\.json', file_name)
+                        results_tag, file_index = match.group(1), str(match.group(2))
+
+                    # the rows of a processed batch are already merged into the csv file
+                    if data.get("processed"):
+                        continue
 
-                    self.process_completed_batch_dir(batch_file_id, file_index)
+                    if data.get("source_file_name"):
+                        gpt_runner = self.template_runner(data["source_file_name"], int(file_index))
+                        gpt_runner.process_completed_batch_dir(batch_file_id, file_index, gpt_runner.elicitation_state, results_tag)
+                    else:
+                        self.process_completed_batch_dir(batch_file_id, file_index, None, results_tag)
+
+                    data["processed"] = True
+                    with open(completed_file_path, 'w') as f:
+                        json.dump(data, f)
             else:
                 logger.info("Batch is still being processed...")
 
 
-    def process_completed_batch_dir(self, batch_id, csv_file_index):
+    def process_completed_batch_dir(self, batch_id, csv_file_index, elicitation_state: ElicitationState = None, results_tag = None):
         """
         Input: batch_id that has been completed.
         Processes the completed batch by downloading results, writing them to the batch_results_dir,
-        and saving the parsed triples to a CSV file.
+        and saving the parsed triples to a CSV file. With the elicitation state of the template the triples
+        are merged into the existing CSV file instead of replacing it, and the failed subjects are retried
+        with a new (small) batch.
         """
         logger.info(f"Processing a newly completed batch: `{batch_id}`. Downloading results.")
 
         # Retrieve batch details and results
-        openai_batch = self.openai_client.batches.retrieve(batch_id)
-        input_file_id = openai_batch.input_file_id
-        output_file_id = openai_batch.output_file_id
-        batch_result = self.openai_client.files.content(output_file_id).content
+        with profiler.stage("download_batch_results"):
+            openai_batch = self.openai_client.batches.retrieve(batch_id)
+            input_file_id = openai_batch.input_file_id
+            output_file_id = openai_batch.output_file_id
+            batch_result = self.openai_client.files.content(output_file_id).content if output_file_id else b""
+
+            # requests which failed as a whole are only listed in the error file
+            if openai_batch.error_file_id:
+                if batch_result and not batch_result.endswith(b"\n"):
+                    batch_result += b"\n"
+                batch_result += self.openai_client.files.content(openai_batch.error_file_id).content
 
         # Ensure the batch results directory exists
         os.makedirs(self.batch_results_dir, exist_ok=True)
 
         # Write batch results to the batch_results_dir
-        result_file_path = os.path.join(self.batch_results_dir, f"batch_results_{csv_file_index}.json")
+        result_file_path = os.path.join(self.batch_results_dir, f"batch_results_{results_tag or csv_file_index}.json")
         with open(result_file_path, "wb") as f:
             f.write(batch_result)
         logger.info(f"Batch results written to `{result_file_path}`.")
 
+        with profiler.stage("process_batch_results"):
+            self.process_batch_results_file(result_file_path, csv_file_index, elicitation_state, batch_id)
+
+        if elicitation_state is not None and self.max_retries > 0:
+            retryable = elicitation_state.retryable(batch_id, self.max_retries + 1)
+            if retryable:
+                # the original requests of the failed subjects, from the input file of the batch
+                input_lines = self.openai_client.files.content(input_file_id).content.decode("utf-8").splitlines()
+                batch_requests = {request["custom_id"]: request for request in map(json.loads, filter(str.strip, input_lines))}
+                retry_requests = self.build_retry_requests(retryable, batch_requests)
+                if retry_requests:
+                    self.submit_batch_request_file(batch_record_file_path = self.write_retry_request_file(retry_requests))
+
+    def build_retry_requests(self, retryable: dict, batch_requests: dict) -> list[dict]:
+        """
+        Requests for retrying failed subjects, truncated responses are retried with twice the output tokens
+        (up to `RETRY_MAX_TOKENS_LIMIT`), other failures with the original request
+
+        Arguments:
+            retryable (dict): Subject -> failure reason, see `ElicitationState.retryable`
+            batch_requests (dict): Subject (custom_id) -> batch request which failed
+        """
+        retry_requests = []
+        for subject, reason in retryable.items():
+            batch_request = batch_requests.get(subject)
+            if batch_request is None:
+                continue
+
+            if reason.startswith("finish_reason=length"):
+                body = batch_request["body"]
+                key = "max_completion_tokens" if "max_completion_tokens" in body else "max_tokens"
+                if body.get(key) is None or body[key] >= RETRY_MAX_TOKENS_LIMIT:
+                    # more output tokens are not possible, a retry would be truncated again
+                    continue
+                body[key] = min(RETRY_MAX_TOKENS_LIMIT, 2 * body[key])
+
+            retry_requests.append(batch_request)
+            telemetry.inc("elicitation_retries_total", reason=reason.split("=")[0])
+
+        logger.info(f"Retrying {len(retry_requests)} of {len(retryable)} failed subjects of {self.source_file_name}.")
+        return retry_requests
+
+    def write_retry_request_file(self, retry_requests: list[dict]):
+        retry_record_file_path = os.path.join(self.batch_request_dir, f"retry_records_{self.curr_index}.jsonl")
+        os.makedirs(self.batch_request_dir, exist_ok=True)
+        with open(retry_record_file_path, "w") as f:
+            for req in retry_requests:
+                f.write(json.dumps(req) + "\n")
+        return retry_record_file_path
+
+    @staticmethod
+    def read_batch_requests(batch_record_file_path) -> dict:
+        """
+        Requests of a batch request file, custom_id (subject) -> request
+        """
+        with open(batch_record_file_path, "r") as f:
+            return {request["custom_id"]: request for request in map(json.loads, filter(str.strip, f))}
+
+    def run_realtime(self, subjects_to_expand: list[str]):
+        """
+        Elicit the subjects without the batch api: the same requests are sent to the chat completions endpoint with
+        bounded, rate limit adaptive concurrency, and the results are written as `batch_results_<index>.json` and
+        `wikidata_triples_<index>.csv` exactly like a completed batch. Failed subjects are retried right away, up
+        to `max_retries` rounds
+        """
+        with profiler.stage("render_batch_requests"):
+            self.write_batch_request_file(subjects_to_expand)
+        batch_record_file_path = self.batch_record_file_path
+
+        for num_round in range(self.max_retries + 1):
+            batch_requests = self.read_batch_requests(batch_record_file_path)
+
+            # only kept in memory until the results are processed, an interrupted run leaves the subjects pending
+            batch_id = f"realtime_{int(time.time())}_{num_round}"
+            if self.elicitation_state is not None:
+                self.elicitation_state.mark_submitted(list(batch_requests), batch_id)
+                self.elicitation_state.csv_file_index = self.curr_index
+
+            result_file_path = os.path.join(self.batch_results_dir, f"batch_results_{self.curr_index}_{batch_id}.json")
+            with telemetry.timer("realtime_elicitation_seconds"), profiler.stage("realtime_requests"):
+                num_failed = run_realtime_requests(batch_record_file_path, result_file_path, self.realtime_max_concurrency)
+            if num_failed:
+                logger.warning(f"{num_failed} of {len(batch_requests)} real-time requests failed.")
+            logger.info(f"Real-time results written to `{result_file_path}`.")
+
+            with profiler.stage("process_batch_results"):
+                self.process_batch_results_file(result_file_path, str(self.curr_index), self.elicitation_state, batch_id)
+
+            if self.elicitation_state is None or num_round == self.max_retries:
+                break
+            retry_requests = self.build_retry_requests(self.elicitation_state.retryable(batch_id, self.max_retries + 1), batch_requests)
+            if not retry_requests:
+                break
+            batch_record_file_path = self.write_retry_request_file(retry_requests)
+
+        self.record_jinja_file_mapping()
+
+    def record_jinja_file_mapping(self):
+        """
+        Append `<source file name> wikidata_triples_<index>` to the jinja index mapping, once per template
+        """
+        mapping_line = f"{self.source_file_name} wikidata_triples_{self.curr_index}\n"
+        with jinja_file_mapping_lock:
+            if os.path.isfile(self.jinja_file_mapping):
+                with open(self.jinja_file_mapping, 'r') as f:
+                    if mapping_line in f:
+                        return
+            with open(self.jinja_file_mapping, 'a') as f:
+                f.write(mapping_line)
+
+    def process_batch_results_file(self, result_file_path, csv_file_index, elicitation_state: ElicitationState = None, batch_id = None):
+        """
+        Parse a file of batch output lines and save the triples to `wikidata_triples_<csv_file_index>.csv`
+
+        Without an elicitation state the csv file is rewritten. With the state of the template the outcome of every
+        subject is recorded, and the triples of subjects without an earlier successful elicitation are appended to
+        the csv file, so that incremental submissions merge into the existing output
+        """
         # Read the results and process triples
         raw_triples = []
+        succeeded_subjects = {}
         with open(result_file_path, "r") as f:
             for line_number, line in enumerate(f, start=1):
+                raw_triples_from_line = []
+                failure_reason = None
                 try:
                     # Parse elicitation responses
                     raw_triples_from_line = self.parse_elicitation_response(line)
-
-                    raw_triples.extend(raw_triples_from_line)
                 except json.JSONDecodeError:
+                    failure_reason = "json"
+                    telemetry.inc("elicitation_parse_failures_total", reason="json")
                     logger.error(f"JSONDecodeError at line {line_number}: {line.strip()}")
+                except ParsingException as e:
+                    failure_reason = str(e)
+                    telemetry.inc("elicitation_parse_failures_total", reason=str(e).split("=")[0])
+                    logger.error(f"Parsing error at line {line_number}: {line.strip()} | Error: {e}")
                 except Exception as e:
+                    failure_reason = f"other={e}"
+                    telemetry.inc("elicitation_parse_failures_total", reason="other")
                     logger.error(f"Unexpected error while parsing line {line_number}: {line.strip()} | Error: {e}")
 
+                if elicitation_state is not None:
+                    subject_name = self.custom_id_of_line(line)
+                    if subject_name is None:
+                        continue
+                    if elicitation_state.status(subject_name) == SUCCEEDED or subject_name in succeeded_subjects:
+                        continue
+                    if failure_reason is None:
+                        succeeded_subjects[subject_name] = True
+                    else:
+                        elicitation_state.mark_failed(subject_name, failure_reason)
+
+                raw_triples.extend(raw_triples_from_line)
+
         logger.info(f"Found {len(raw_triples):,} raw triples in the batch results.")
+        telemetry.inc("elicitation_triples_total", len(raw_triples), file_index=csv_file_index)
 
         if not os.path.exists(self.csv_dir_path):
             os.makedirs(self.csv_dir_path)
@@ -171,14 +426,42 @@ class GPTKBCRunner:
         csv_filename = os.path.join(self.csv_dir_path, f"wikidata_triples_{csv_file_index}.csv")
 
         # Write the triples to a CSV file
-        self.write_triples_to_csv(raw_triples, csv_filename)
+        self.write_triples_to_csv(raw_triples, csv_filename, append = elicitation_state is not None)
         logger.info(f"Raw triples written to `{csv_filename}`.")
 
+        if elicitation_state is not None:
+            for subject_name in succeeded_subjects:
+                elicitation_state.mark_succeeded(subject_name)
+
+            # subjects of the batch without an output line are failures as well
+            if batch_id is not None:
+                elicitation_state.fail_in_flight(batch_id, "missing_output")
+            elicitation_state.save()
+
+    @staticmethod
+    def custom_id_of_line(line):
+        try:
+            return json.loads(line.strip()).get("custom_id")
+        except (json.JSONDecodeError, AttributeError):
+            return None
+
     # This method has been modified from the one in Prompter Parser Class
     def parse_elicitation_response(self, response: str) -> list[dict]:
         response_object = json.loads(response.strip())
 
         subject_name = response_object["custom_id"]
+
+        # requests which failed as a whole have an error and no response
+        if response_object.get("error"):
+            raise ParsingException(f"error={response_object['error'].get('code')}")
+
+        # lines of the batch error file have a response with the error of the request
+        status_code = (response_object.get("response") or {}).get("status_code", 200)
+        if status_code != 200:
+            error = (response_object["response"].get("body") or {}).get("error") or {}
+            raise ParsingException(f"error={error.get('code') or status_code}")
+
+        telemetry.record_usage(response_object["response"]["body"].get("usage"), stage="elicitation")
         choice = response_object["response"]["body"]["choices"][0]
 
         # check if the request was stopped correctly
@@ -219,44 +502,58 @@ class GPTKBCRunner:
         return raw_triples
 
     
-    def write_triples_to_csv(self, raw_triples, input_file_path):
+    def write_triples_to_csv(self, raw_triples, input_file_path, append: bool = False):
         """
-        Write the raw triples to the csv file for further processing
+        Write the raw triples to the csv file for further processing, `append` adds them to an existing file
         """
-        try:
-            with open(input_file_path, mode = 'w', newline='', encoding = 'utf-8') as csv_file:
-                fieldnames = ["subject", "predicate", "object", "subject_name"]
-                writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+        # errors are raised, the subjects of the triples are only recorded as elicited once their rows are written
+        write_header = not append or not os.path.isfile(input_file_path) or os.path.getsize(input_file_path) == 0
+        with open(input_file_path, mode = 'a' if append else 'w', newline='', encoding = 'utf-8') as csv_file:
+            fieldnames = ["subject", "predicate", "object", "subject_name"]
+            writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
+            if write_header:
                 writer.writeheader()
-                writer.writerows(raw_triples)
-                logger.info("Data written to CSV succesfully ...")
-
-        except Exception as e:
-            print("An error occured: {e}")
+            writer.writerows(raw_triples)
+            logger.info("Data written to CSV succesfully ...")
 
     def create_batch_dir(self, subjects_to_expand: list[str], max_tries: int = 5):
         """
         Push the data to a batch request for OpenAI.
         Write the in-progress batch ID to a JSON file for recording in `self.in_progress_dir_path`
-        with a filename format `in_progress_<self.curr_index>.json`.
+        with a filename format `in_progress_<self.curr_index>_<batch id>.json`.
         """
-        batch_request = []
-        
-        # Generate batch request data
-        for subject in subjects_to_expand:
-            req = self.prompter_parser_module.get_elicitation_prompt(subject_name=subject)
-            batch_request.append(req)
+        with profiler.stage("render_batch_requests"):
+            self.write_batch_request_file(subjects_to_expand)
+        with profiler.stage("submit_batches"):
+            self.submit_batch_request_file(max_tries)
 
-        # Write batch request data to a temporary file
+    def write_batch_request_file(self, subjects_to_expand: list[str]):
+        """
+        Generate the batch request data and write it to `self.batch_record_file_path`
+        """
+        os.makedirs(self.batch_request_dir, exist_ok=True)
         with open(self.batch_record_file_path, "w") as f:
-            for obj in batch_request:
-                f.write(json.dumps(obj) + "\n")
+            for subject in subjects_to_expand:
+                req = self.prompter_parser_module.get_elicitation_prompt(subject_name=subject)
+                f.write(json.dumps(req) + "\n")
+
+    def submit_batch_request_file(self, max_tries: int = 5, batch_record_file_path: str = None):
+        """
+        Upload the batch request file written by `write_batch_request_file` (or a retry request file), create the
+        batch and record it
+        """
+        batch_record_file_path = batch_record_file_path or self.batch_record_file_path
+        submitted_subjects = list(self.read_batch_requests(batch_record_file_path))
+        num_requests = len(submitted_subjects)
 
         # Upload the batch request file to OpenAI
-        batch_input_file = self.openai_client.files.create(
-            file=open(self.batch_record_file_path, "rb"),
-            purpose="batch"
-        )
+        with telemetry.timer("batch_upload_seconds"):
+            with open(batch_record_file_path, "rb") as batch_record_file:
+                batch_input_file = self.openai_client.files.create(
+                    file=batch_record_file,
+                    purpose="batch"
+                )
+        telemetry.inc("batch_requests_submitted_total", num_requests)
         batch_input_file_id = batch_input_file.id
 
         openai_batch = None
@@ -275,6 +572,7 @@ class GPTKBCRunner:
                 break
             except openai.RateLimitError as e:
                 logger.error(f"Rate limit error: {e}")
+                telemetry.inc("openai_rate_limit_errors_total", endpoint="batches")
                 logger.info("Waiting for 60 seconds before retrying.")
                 time.sleep(60)
                 continue
@@ -282,24 +580,28 @@ class GPTKBCRunner:
         if openai_batch is None:
             raise Exception(f"Failed to create batch file after {max_tries} attempts.")
 
+        if self.elicitation_state is not None:
+            self.elicitation_state.mark_submitted(submitted_subjects, openai_batch.id)
+            self.elicitation_state.csv_file_index = self.curr_index
+            self.elicitation_state.save()
+
         # Prepare data for writing to the in-progress directory
-        data = {"batch_id": openai_batch.id}
+        data = {"batch_id": openai_batch.id, "source_file_name": self.source_file_name}
 
         # Create the in-progress directory if it doesn't exist
         os.makedirs(self.in_progress_dir_path, exist_ok=True)
 
-        # Determine the filename for the current batch
+        # Determine the filename for the current batch, a template can have several batches (incremental submissions)
         in_progress_file_path = os.path.join(
             self.in_progress_dir_path,
-            f"in_progress_{self.curr_index}.json"
+            f"in_progress_{self.curr_index}_{openai_batch.id}.json"
         )
 
         # Write batch ID to the in-progress file
         with open(in_progress_file_path, "w") as f:
             json.dump(data, f)
         
-        with open(self.jinja_file_mapping, 'a') as f:
-            f.write(f"{self.source_file_name} wikidata_triples_{self.curr_index}\n")
+        self.record_jinja_file_mapping()
         
         logger.info(f"Data processed from jinja file name ... {self.source_file_name}")
 
@@ -334,9 +636,18 @@ class GPTKBCRunner:
                     current_status = openai_batch.status
                     
                     logger.info(f"Current status of batch {batch_file_id} in {file_name}: {current_status}")
+                    telemetry.inc("batch_status_polls_total", status=current_status)
+
+                    # record status transitions, the last seen status is kept in the in-progress file
+                    previous_status = data.get("last_status")
+                    if previous_status != current_status:
+                        telemetry.inc("batch_status_transitions_total", from_status=previous_status or "submitted", to_status=current_status)
+                        data["last_status"] = current_status
+                        with open(file_path, "w") as f:
+                            json.dump(data, f)
                     
-                    # Check if the status is completed
-                    if current_status == "completed":
+                    # Check if the status is completed, an expired batch has the partial results of the requests it ran
+                    if current_status in BATCH_PROCESSED_STATUSES:
                         # Determine the new filename for the completed directory
                         completed_file_name = file_name.replace("in_progress_", "completed_")
                         completed_file_path = os.path.join(self.completed_dir_path, completed_file_name)
@@ -346,9 +657,30 @@ class GPTKBCRunner:
                         logger.info(f"Moved {file_name} to {completed_file_path}")
                         any_completed = True
 
+                    elif current_status in BATCH_TERMINAL_STATUSES:
+                        self.terminate_batch(file_path, data, current_status)
+
                     elif current_status in status_in_progress:
                         logger.info(f"Batch {batch_file_id} in {file_name} is still in progress.")
                     else:
                         logger.warning(f"Unexpected status {current_status} for batch {batch_file_id} in {file_name}.")
 
         return any_completed
+
+    def terminate_batch(self, in_progress_file_path, data, status):
+        """
+        Fail the subjects of a batch which ended without completing (`BATCH_TERMINAL_STATUSES`), so that the next
+        submission sends them again, and move its in-progress file out of the polled directory
+        """
+        file_name = os.path.basename(in_progress_file_path)
+        logger.warning(f"Batch {data.get('batch_id')} in {file_name} ended with status {status}.")
+        if data.get("source_file_name"):
+            csv_file_index = int(re.search(r'in_progress_(\d+)', file_name).group(1))
+            elicitation_state = self.template_runner(data["source_file_name"], csv_file_index).elicitation_state
+            elicitation_state.fail_in_flight(data.get("batch_id"), f"batch_{status}")
+            elicitation_state.save()
+
+        os.makedirs(self.terminated_dir_path, exist_ok=True)
+        terminated_file_path = os.path.join(self.terminated_dir_path, file_name.replace("in_progress_", f"{status}_"))
+        shutil.move(in_progress_file_path, terminated_file_path)
+        logger.info(f"Moved {file_name} to {terminated_file_path}")
@@ -1,7 +1,11 @@
 import fire
-from gpt_kbc import GPTKBCRunner
-from  prompter_parser import PromptJSONSchema
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from gpt_kbc import GPTKBCRunner, load_list_of_subjects, render_batch_request_file
+from elicitation_state import assign_csv_file_indices
+from  prompter_parser import PromptJSONSchema
+from telemetry import telemetry
+from profiler import profiler
 
 
 def main(
@@ -9,7 +13,13 @@ def main(
         template_path_dir:str,              
         wikidata_entities_file_path: str,
         wikidata_triples_dir:str,           
-        job_type: str
+        job_type: str,
+        collect_telemetry: bool = False,
+        submit_workers: int = 1,
+        realtime_max_concurrency: int = 16,
+        max_retries: int = 2,
+        template_file_name: str = None,
+        profile: bool = False,
 ):
     
     """
@@ -21,10 +31,22 @@ def main(
         template_path_dir (str): Dir which stores multiple jinja files, to be used for elicitation, one batch request per prompt file
         wikidata_entities_file_path (str): File path storing the wikidata entities
         wikidata_triples_dir (str): Dir path for storing the elicted triples
-        job_type (str): Either `submit`to submit a new request `verify`to just check and process the status of already submitted batches (default)
-    
+        job_type (str): Either `submit`to submit a new request `verify`to just check and process the status of already submitted batches (default) `realtime` to elicit directly through the chat completions endpoint without the batch api
+        collect_telemetry (bool): Record batch, token and request metrics and write them as elicitation_telemetry.json / .prom into `wikidata_triples_dir`
+        submit_workers (int): Number of templates rendered, uploaded and submitted concurrently in `submit` mode, 1 submits them one after another
+        realtime_max_concurrency (int): Maximum number of concurrent requests in `realtime` mode, reduced automatically while rate limited
+        max_retries (int): Number of automatic retries of a failed subject, truncated responses are retried with more output tokens. Retry batches are submitted by `verify`, `realtime` retries right away
+        template_file_name (str): Only submit / elicit this jinja file of `template_path_dir` (its index, and so its csv file, stays the one of the whole dir)
+        profile (bool): Profile every stage (wall / CPU time, tracemalloc peak, sampled call stacks) and write folded stacks and top-N reports per stage into the elicitation_profile dir of `wikidata_triples_dir`, slows the run down
+
     """
-    
+
+    if collect_telemetry:
+        telemetry.enable()
+
+    if profile:
+        profiler.enable()
+
     if job_type == "verify":
         gpt_runner = GPTKBCRunner(
             source_file_name = "",
@@ -32,15 +54,27 @@ def main(
             wikidata_entities_file_path = wikidata_entities_file_path, 
             wikidata_triples_dir = wikidata_triples_dir, 
             prompter_parser_module = None, 
-            job_type = job_type
+            job_type = job_type,
+            max_retries = max_retries,
         )
 
         list_of_subjects = gpt_runner.get_list_of_subjects()
         gpt_runner.loop(subjects_to_expand = list_of_subjects)
     
+    elif job_type == "submit" and submit_workers > 1:
+        submit_concurrently(
+            gpt_model_elicitation,
+            template_path_dir,
+            wikidata_entities_file_path,
+            wikidata_triples_dir,
+            job_type,
+            submit_workers,
+            template_file_name,
+        )
+
     else:
-        for index, file_name in enumerate(os.listdir(template_path_dir), start = 1):
-            if file_name.endswith(".jinja"): 
+        for file_name, index in template_indices(template_path_dir).items():
+            if template_file_name in (None, file_name):
                 file_path = os.path.join(template_path_dir, file_name)
 
                 prompter_parser_module = PromptJSONSchema(
@@ -54,12 +88,87 @@ def main(
                     wikidata_entities_file_path = wikidata_entities_file_path,
                     wikidata_triples_dir = wikidata_triples_dir,
                     prompter_parser_module = prompter_parser_module,
-                    job_type = job_type
+                    job_type = job_type,
+                    realtime_max_concurrency = realtime_max_concurrency,
+                    max_retries = max_retries,
                 )
 
                 list_of_subjects = gpt_runner.get_list_of_subjects()
                 gpt_runner.loop(subjects_to_expand = list_of_subjects)
 
+    telemetry.export(wikidata_triples_dir, prefix = "elicitation_telemetry")
+    profiler.export(wikidata_triples_dir, prefix = "elicitation_profile")
+
+
+
+def template_indices(template_path_dir: str) -> dict:
+    """
+    Jinja files of `template_path_dir` (sorted) -> index of their csv file, stable when templates are added or removed
+    """
+    file_names = sorted(file_name for file_name in os.listdir(template_path_dir) if file_name.endswith(".jinja"))
+    # same state dir and mapping file as `GPTKBCRunner`
+    return assign_csv_file_indices(
+        os.path.join(os.getcwd(), "elicitation_state"),
+        file_names,
+        os.path.abspath(os.path.join(os.getcwd(), "..", "jinja_index_mapping.txt")),
+    )
+
+
+def submit_concurrently(
+        gpt_model_elicitation: str,
+        template_path_dir: str,
+        wikidata_entities_file_path: str,
+        wikidata_triples_dir: str,
+        job_type: str,
+        submit_workers: int,
+        template_file_name: str = None,
+):
+    """
+    Submit one batch per jinja file concurrently. The entity list is loaded once, the per-template request files
+    (subjects without a successful elicitation of the template only) are rendered in parallel processes, then
+    uploaded and submitted in parallel threads
+    """
+    list_of_subjects = load_list_of_subjects(wikidata_entities_file_path)
+
+    gpt_runners = []
+    pending_subjects = []
+    for file_name, index in template_indices(template_path_dir).items():
+        if template_file_name in (None, file_name):
+            gpt_runner = GPTKBCRunner(
+                source_file_name = file_name,
+                curr_index = index,
+                wikidata_entities_file_path = wikidata_entities_file_path,
+                wikidata_triples_dir = wikidata_triples_dir,
+                prompter_parser_module = None,
+                job_type = job_type
+            )
+            subjects_to_expand = gpt_runner.pending_subjects(list_of_subjects)
+            if not subjects_to_expand:
+                continue
+            gpt_runner.create_dir()
+            gpt_runners.append(gpt_runner)
+            pending_subjects.append(subjects_to_expand)
+
+    with telemetry.timer("stage_duration_seconds", stage="render_batch_requests"), profiler.stage("render_batch_requests"):
+        with ProcessPoolExecutor(max_workers = submit_workers) as executor:
+            futures = [
+                executor.submit(
+                    render_batch_request_file,
+                    os.path.join(template_path_dir, gpt_runner.source_file_name),
+                    gpt_model_elicitation,
+                    subjects_to_expand,
+                    gpt_runner.batch_record_file_path,
+                )
+                for gpt_runner, subjects_to_expand in zip(gpt_runners, pending_subjects)
+            ]
+            for future in futures:
+                future.result()
+
+    with telemetry.timer("stage_duration_seconds", stage="submit_batches"), profiler.stage("submit_batches"):
+        with ThreadPoolExecutor(max_workers = submit_workers) as executor:
+            futures = [executor.submit(gpt_runner.submit_batch_request_file) for gpt_runner in gpt_runners]
+            for future in futures:
+                future.result()
 
 
 if __name__ == "__main__":
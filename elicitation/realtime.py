@@ -0,0 +1,145 @@
+import asyncio
+import json
+import random
+import openai
+from loguru import logger
+from openai import AsyncOpenAI
+from tqdm import tqdm
+from telemetry import telemetry
+
+"""
+
+py file containing the real-time elicitation path: the rendered batch requests are sent straight to the chat
+completions endpoint with bounded async concurrency. The concurrency adapts to rate limits (halved on a 429,
+grown back by one after a run of successes) and every response is wrapped into a line of the batch output
+format, so that results go through the same parsing and csv writing as completed batches
+"""
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, max_concurrency: int = 16, min_concurrency: int = 1, increase_after: int = 20):
+        """
+        Async limiter whose limit is halved on rate limit errors and increased by one after `increase_after`
+        consecutive successes, up to `max_concurrency`
+        """
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.increase_after = increase_after
+        self.limit = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+    async def release(self, rate_limited: bool = False):
+        async with self._condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.successes = 0
+                self.limit = max(self.min_concurrency, self.limit // 2)
+            else:
+                self.successes += 1
+                if self.successes >= self.increase_after and self.limit < self.max_concurrency:
+                    self.successes = 0
+                    self.limit += 1
+            telemetry.observe("realtime_concurrency_limit", self.limit)
+            self._condition.notify_all()
+
+
+def _retry_after(error, num_tries):
+    """
+    Seconds to wait after a rate limit error, the Retry-After header of the response takes precedence
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return min(60.0, 2 ** num_tries) * (0.5 + random.random())
+
+
+def _batch_output_line(batch_request, completion = None, error = None):
+    """
+    Batch api output line for a request answered in real time
+    """
+    return {
+        "id": None,
+        "custom_id": batch_request["custom_id"],
+        "response": {"status_code": 200, "request_id": completion.id, "body": completion.model_dump()} if completion is not None else None,
+        "error": error,
+    }
+
+
+async def _send(client, limiter, batch_request, max_tries):
+    for num_tries in range(max_tries):
+        await limiter.acquire()
+        rate_limited = False
+        try:
+            with telemetry.timer("realtime_request_seconds"):
+                completion = await client.chat.completions.create(**batch_request["body"])
+            return _batch_output_line(batch_request, completion = completion)
+        except openai.RateLimitError as e:
+            rate_limited = True
+            telemetry.inc("openai_rate_limit_errors_total", endpoint="chat")
+            wait_time = _retry_after(e, num_tries)
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            logger.warning(f"Request for {batch_request['custom_id']} failed: {e}")
+            wait_time = min(60.0, 2 ** num_tries)
+        except Exception as e:
+            # any other failure (bad request, authentication, unknown model, ...) is the result of this subject only
+            logger.warning(f"Request for {batch_request['custom_id']} failed: {e}")
+            telemetry.inc("realtime_request_failures_total")
+            code = getattr(e, "code", None) or getattr(e, "status_code", None) or type(e).__name__
+            return _batch_output_line(batch_request, error = {"code": str(code), "message": str(e)})
+        finally:
+            await limiter.release(rate_limited)
+        await asyncio.sleep(wait_time)
+
+    telemetry.inc("realtime_request_failures_total")
+    return _batch_output_line(batch_request, error = {"code": "max_tries_exceeded", "message": f"Failed after {max_tries} attempts"})
+
+
+async def _run(batch_requests, max_concurrency, max_tries):
+    client = AsyncOpenAI(max_retries = 0)
+    limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+    progress_bar = tqdm(total = len(batch_requests), desc = "Real-time elicitation")
+
+    async def send(batch_request):
+        output_line = await _send(client, limiter, batch_request, max_tries)
+        progress_bar.update(1)
+        return output_line
+
+    try:
+        output_lines = await asyncio.gather(*(send(batch_request) for batch_request in batch_requests), return_exceptions = True)
+        # a failure outside the request itself still only costs its own subject
+        return [
+            _batch_output_line(batch_request, error = {"code": type(output_line).__name__, "message": str(output_line)})
+            if isinstance(output_line, BaseException) else output_line
+            for batch_request, output_line in zip(batch_requests, output_lines)
+        ]
+    finally:
+        progress_bar.close()
+        await client.close()
+
+
+def run_realtime_requests(batch_request_file_path, result_file_path, max_concurrency: int = 16, max_tries: int = 6):
+    """
+    Send every request of a batch request file to the chat completions endpoint and write the responses in the
+    batch output format (one JSON line per request, in request order) to `result_file_path`
+
+    Returns:
+        int: number of requests which failed after `max_tries` attempts
+    """
+    with open(batch_request_file_path, "r") as f:
+        batch_requests = [json.loads(line) for line in f if line.strip()]
+
+    output_lines = asyncio.run(_run(batch_requests, max_concurrency, max_tries))
+    with open(result_file_path, "w") as f:
+        for output_line in output_lines:
+            f.write(json.dumps(output_line) + "\n")
+
+    return sum(1 for output_line in output_lines if output_line["error"] is not None)
@@ -0,0 +1,177 @@
+import os
+from array import array
+import numpy as np
+import pandas as pd
+
+"""
+
+py file containing the aggregation layer for judge verdicts. Verdicts are recorded as compact integer coded
+arrays (file, metric, subject, predicate, verdict ids and weights) and aggregated with pandas group-bys into file level,
+per subject, per category and per predicate fractions, plus bootstrap confidence intervals resampled by subject.
+Every verdict counts with its weight, the number of elicited triples it stands for (more than one for the
+representatives of deduplicated triples), so the breakdowns agree with the weighted file level results
+"""
+
+VERDICTS = ["a", "b", "c", "d"]
+VERDICT_COLUMNS = ["True", "Plausible", "Implausible", "False"]
+
+# verdict code for outputs which do not start with a, b, c or d; they count towards the total only
+OTHER_VERDICT = len(VERDICTS)
+
+
+class _Vocabulary:
+    """
+    Maps strings to dense integer ids
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.values = []
+
+    def id(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = len(self.values)
+            self.ids[value] = value_id
+            self.values.append(value)
+        return value_id
+
+
+class VerdictTable:
+    def __init__(self):
+        """
+        Columnar, integer coded table of judge verdicts
+        """
+        self.files = _Vocabulary()
+        self.metrics = _Vocabulary()
+        self.subjects = _Vocabulary()
+        self.subject_names = _Vocabulary()
+        self.predicates = _Vocabulary()
+
+        self._file_ids = array("i")
+        self._metric_ids = array("i")
+        self._subject_ids = array("i")
+        self._subject_name_ids = array("i")
+        self._predicate_ids = array("i")
+        self._verdicts = array("b")
+        self._weights = array("i")
+
+    def __len__(self):
+        return len(self._verdicts)
+
+    @staticmethod
+    def verdict_code(output):
+        output = (output or "")[:1]
+        return VERDICTS.index(output) if output in VERDICTS else OTHER_VERDICT
+
+    def add(self, filename, metric, subject, predicate, output, subject_name = None, weight = 1):
+        """
+        Record a single verdict, `output` is the raw LLM output (only its first character is used). `subject_name` is
+        the entity the triple was elicited for (the subject written by the model may differ), `subject` if not given.
+        `weight` is the number of elicited triples the judged triple stands for
+        """
+        self._file_ids.append(self.files.id(filename))
+        self._metric_ids.append(self.metrics.id(metric))
+        self._subject_ids.append(self.subjects.id(subject))
+        self._subject_name_ids.append(self.subject_names.id(subject if subject_name is None else subject_name))
+        self._predicate_ids.append(self.predicates.id(predicate))
+        self._verdicts.append(self.verdict_code(output))
+        self._weights.append(weight)
+
+    def to_frame(self, categories: dict = None) -> pd.DataFrame:
+        """
+        Verdicts as a DataFrame with categorical columns; `categories` maps the elicited entity (subject name) -> entity category
+        """
+        subject_ids = np.frombuffer(self._subject_ids, dtype=np.int32)
+        frame = pd.DataFrame({
+            "file": pd.Categorical.from_codes(np.frombuffer(self._file_ids, dtype=np.int32), categories=self.files.values),
+            "metric": pd.Categorical.from_codes(np.frombuffer(self._metric_ids, dtype=np.int32), categories=self.metrics.values),
+            "subject": pd.Categorical.from_codes(subject_ids, categories=self.subjects.values),
+            "predicate": pd.Categorical.from_codes(np.frombuffer(self._predicate_ids, dtype=np.int32), categories=self.predicates.values),
+            "verdict": np.frombuffer(self._verdicts, dtype=np.int8),
+            "weight": np.frombuffer(self._weights, dtype=np.int32),
+        })
+        if categories is not None:
+            # categories are keyed by the entities of the entities file, i.e. the subject names the triples were elicited for
+            category_vocabulary = _Vocabulary()
+            subject_name_to_category = np.array(
+                [category_vocabulary.id(categories.get(subject_name, "unknown")) for subject_name in self.subject_names.values], dtype=np.int32
+            )
+            subject_name_ids = np.frombuffer(self._subject_name_ids, dtype=np.int32)
+            frame["category"] = pd.Categorical.from_codes(subject_name_to_category[subject_name_ids], categories=category_vocabulary.values)
+        return frame
+
+    @staticmethod
+    def summarize(frame: pd.DataFrame, keys: list) -> pd.DataFrame:
+        """
+        Fractions of true / plausible / implausible / false verdicts and the total (weighted) count per group of `keys`
+        """
+        counts = pd.crosstab(
+            [frame[key] for key in keys],
+            pd.Categorical(frame["verdict"], categories=range(OTHER_VERDICT + 1)),
+            values=frame["weight"],
+            aggfunc="sum",
+            dropna=False,
+        ).fillna(0).astype(np.int64)
+        counts = counts[counts.sum(axis=1) > 0]
+        totals = counts.sum(axis=1)
+        summary = pd.DataFrame(index=counts.index)
+        for code, column in enumerate(VERDICT_COLUMNS):
+            summary[column] = counts[code] / totals
+        summary["Total #Triples"] = totals
+        return summary.reset_index()
+
+    @staticmethod
+    def bootstrap_ci(frame: pd.DataFrame, num_resamples: int = 1000, confidence: float = 0.95, seed: int = 0, chunk_size: int = 100) -> pd.DataFrame:
+        """
+        Bootstrap confidence intervals of the verdict fractions per (file, metric), resampling subjects with replacement
+        so that the correlation between the triples of one subject is accounted for
+        """
+        rng = np.random.default_rng(seed)
+        alpha = (1 - confidence) / 2
+        rows = []
+        for (filename, metric), group in frame.groupby(["file", "metric"], observed=True):
+            # per subject weighted verdict counts, shape (num_subjects, num_verdicts)
+            subject_codes = group["subject"].cat.remove_unused_categories().cat.codes.to_numpy()
+            num_subjects = subject_codes.max() + 1
+            counts = np.zeros((num_subjects, OTHER_VERDICT + 1), dtype=np.int64)
+            np.add.at(counts, (subject_codes, group["verdict"].to_numpy()), group["weight"].to_numpy())
+
+            # each resample draws num_subjects subjects with replacement, expressed as multiplicity weights
+            fractions = []
+            for start in range(0, num_resamples, chunk_size):
+                size = min(chunk_size, num_resamples - start)
+                weights = rng.multinomial(num_subjects, np.full(num_subjects, 1 / num_subjects), size=size)
+                resampled_counts = weights @ counts
+                totals = resampled_counts.sum(axis=1, keepdims=True)
+                fractions.append(resampled_counts[:, :len(VERDICTS)] / np.maximum(totals, 1))
+            fractions = np.concatenate(fractions)
+
+            low = np.quantile(fractions, alpha, axis=0)
+            high = np.quantile(fractions, 1 - alpha, axis=0)
+            row = {"file": filename, "metric": metric, "Subjects": num_subjects}
+            for index, column in enumerate(VERDICT_COLUMNS):
+                row[f"{column} CI low"] = low[index]
+                row[f"{column} CI high"] = high[index]
+            rows.append(row)
+
+        return pd.DataFrame(rows)
+
+    def write_tables(self, results_dir_path: str, categories: dict = None, num_resamples: int = 1000, seed: int = 0):
+        """
+        Write tidy per file, per subject, per category, per predicate and bootstrap CI tables as csv into `results_dir_path`
+        """
+        if len(self) == 0:
+            return
+        frame = self.to_frame(categories)
+        tables = {
+            "results_by_file.csv": self.summarize(frame, ["file", "metric"]),
+            "results_by_subject.csv": self.summarize(frame, ["file", "metric", "subject"]),
+            "results_by_predicate.csv": self.summarize(frame, ["file", "metric", "predicate"]),
+            "results_bootstrap_ci.csv": self.bootstrap_ci(frame, num_resamples, seed=seed),
+        }
+        if categories is not None:
+            tables["results_by_category.csv"] = self.summarize(frame, ["file", "metric", "category"])
+
+        for file_name, table in tables.items():
+            table.to_csv(os.path.join(results_dir_path, file_name), index=False)
@@ -0,0 +1,76 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import fire
+from loguru import logger
+
+"""
+
+py file containing the startup benchmark of the eval package. The modules of the wikidata only path (eval main,
+gold store, entity resolver, refresh) are imported in fresh interpreters, and the import time, the peak RSS and
+whether an ML backend (torch, sentence_transformers, transformers) got imported are checked against budgets
+"""
+
+WIKIDATA_ONLY_MODULES = ("main", "process_request", "gold_store", "entity_resolver", "refresh_gold")
+ML_MODULES = ("torch", "sentence_transformers", "transformers")
+
+# run in a fresh interpreter in the eval directory, prints the measurements as one JSON line
+STARTUP_PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+import_seconds = time.perf_counter() - start
+print(json.dumps({{
+    "import_seconds": import_seconds,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "ml_modules": [module for module in {ml_modules!r} if module in sys.modules],
+}}))
+"""
+
+
+def measure_startup(modules = WIKIDATA_ONLY_MODULES):
+    """
+    Import time (seconds), peak RSS (MB) and imported ML modules of one fresh interpreter importing `modules`
+    """
+    eval_dir = os.path.dirname(os.path.abspath(__file__))
+    probe = STARTUP_PROBE.format(modules=tuple(modules), ml_modules=ML_MODULES)
+    completed = subprocess.run([sys.executable, "-c", probe], cwd=eval_dir, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main(max_import_seconds: float = 2.0, max_rss_mb: float = 200.0, repeats: int = 5):
+    """
+    Check the startup budgets of the wikidata only path, exits with status 1 when a budget is exceeded
+
+    Arguments:
+        max_import_seconds (float): Budget for the median import time of the wikidata only modules
+        max_rss_mb (float): Budget for the median peak RSS after the imports
+        repeats (int): Number of fresh interpreters measured, the first one also warms the bytecode cache
+    """
+    measurements = [measure_startup() for _ in range(repeats)]
+    import_seconds = statistics.median(measurement["import_seconds"] for measurement in measurements)
+    rss_mb = statistics.median(measurement["max_rss_mb"] for measurement in measurements)
+    ml_modules = sorted({module for measurement in measurements for module in measurement["ml_modules"]})
+
+    logger.info(f"Wikidata only startup: {import_seconds:.3f}s import time, {rss_mb:.1f} MB peak RSS (median of {repeats})")
+
+    failures = []
+    if import_seconds > max_import_seconds:
+        failures.append(f"import time {import_seconds:.3f}s exceeds the budget of {max_import_seconds}s")
+    if rss_mb > max_rss_mb:
+        failures.append(f"peak RSS {rss_mb:.1f} MB exceeds the budget of {max_rss_mb} MB")
+    if ml_modules:
+        failures.append(f"ML backends imported without being selected: {ml_modules}")
+
+    for failure in failures:
+        logger.error(failure)
+    if failures:
+        sys.exit(1)
+    logger.info("Startup budgets met.")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,219 @@
+import csv
+import hashlib
+import json
+import os
+import re
+import unicodedata
+from collections import defaultdict
+import fire
+import numpy as np
+from loguru import logger
+from telemetry import telemetry
+
+"""
+
+py file containing the canonicalisation and deduplication stage between the elicited csv files and the evaluation.
+Triples are normalised (unicode, case, whitespace, underscores, camelCase predicates) and hashed, exact canonical
+duplicates are collapsed, and optionally near duplicate objects of one (subject, predicate) are clustered with
+MinHash / LSH. Every representative keeps the size of its cluster in `duplicate_count`, so that verdicts on the
+representatives can be weighted back to the raw population
+"""
+
+CAMEL_CASE_PATTERN = re.compile(r"(?<=[a-z0-9])(?=[A-Z])")
+SEPARATOR_PATTERN = re.compile(r"[_\-\s]+")
+
+# 61 bit mersenne prime for the universal hash family of the minhash permutations
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def canonical_text(text):
+    """
+    Canonical form of a triple element, e.g. `dateOfBirth`, `date_of_birth` and ` Date of  birth` are equal
+    """
+    text = unicodedata.normalize("NFKC", str(text or ""))
+    text = CAMEL_CASE_PATTERN.sub(" ", text)
+    text = SEPARATOR_PATTERN.sub(" ", text).lower()
+    return text.strip(" .,;:'\"")
+
+
+def canonical_triple(triple):
+    return canonical_text(triple["subject"]), canonical_text(triple["predicate"]), canonical_text(triple["object"])
+
+
+def triple_hash(canonical):
+    return hashlib.sha1("\x1f".join(canonical).encode("utf-8")).hexdigest()
+
+
+class MinHasher:
+    def __init__(self, num_permutations: int = 64, shingle_size: int = 3, seed: int = 0):
+        """
+        MinHash signatures of character shingles
+        """
+        rng = np.random.default_rng(seed)
+        self.shingle_size = shingle_size
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_permutations, dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_permutations, dtype=np.uint64)
+
+    def shingles(self, text):
+        text = f" {text} "
+        if len(text) <= self.shingle_size:
+            return {text}
+        return {text[start:start + self.shingle_size] for start in range(len(text) - self.shingle_size + 1)}
+
+    def signature(self, text):
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little") for shingle in self.shingles(text)],
+            dtype=np.uint64,
+        )
+        # (a * x + b) mod p over the 32 bit shingle hashes, products wrap around in 64 bits which keeps them well mixed
+        permuted = (np.outer(hashes, self.a) + self.b) % np.uint64(MERSENNE_PRIME)
+        return (permuted & np.uint64(MAX_HASH)).min(axis=0)
+
+
+def _find(parents, index):
+    while parents[index] != index:
+        parents[index] = parents[parents[index]]
+        index = parents[index]
+    return index
+
+
+def cluster_near_duplicates(texts, minhasher: MinHasher, bands: int = 16, threshold: float = 0.8):
+    """
+    Cluster texts whose estimated Jaccard similarity of shingles is at least `threshold`, candidates come from LSH banding
+
+    Returns:
+        list: cluster id (index of the first member) for every text
+    """
+    parents = list(range(len(texts)))
+    if len(texts) < 2:
+        return parents
+
+    signatures = np.stack([minhasher.signature(text) for text in texts])
+    rows = signatures.shape[1] // bands
+    for band in range(bands):
+        buckets = defaultdict(list)
+        for index, band_signature in enumerate(signatures[:, band * rows:(band + 1) * rows]):
+            buckets[band_signature.tobytes()].append(index)
+        for members in buckets.values():
+            for other in members[1:]:
+                first_root, other_root = _find(parents, members[0]), _find(parents, other)
+                if first_root == other_root:
+                    continue
+                if np.mean(signatures[members[0]] == signatures[other]) >= threshold:
+                    parents[max(first_root, other_root)] = min(first_root, other_root)
+
+    return [_find(parents, index) for index in range(len(texts))]
+
+
+def deduplicate_triples(triples, near_duplicates: bool = False, threshold: float = 0.8, minhasher: MinHasher = None):
+    """
+    Collapse canonical duplicates (and optionally near duplicate objects) of a list of triples
+
+    Args:
+        triples (list): Rows of an elicited csv file, dicts with `subject`, `predicate` and `object`
+        near_duplicates (bool): Also cluster near duplicate objects of the same (subject, predicate)
+        threshold (float): Minimum estimated Jaccard similarity of the object shingles for near duplicates
+
+    Returns:
+        (list, dict): representatives (first member of every cluster, with `canonical_hash` and `duplicate_count`)
+        and the counts {"raw", "unique", "representatives"}
+    """
+    # exact canonical duplicates
+    groups = {}
+    for each_triple in triples:
+        canonical = canonical_triple(each_triple)
+        key = triple_hash(canonical)
+        if key not in groups:
+            groups[key] = {"canonical": canonical, "triple": dict(each_triple), "count": 0}
+        # a row may itself be a representative of an earlier deduplication
+        groups[key]["count"] += int(each_triple.get("duplicate_count") or 1)
+
+    representatives = list(groups.items())
+    num_unique = len(representatives)
+
+    if near_duplicates:
+        minhasher = minhasher or MinHasher()
+        by_subject_predicate = defaultdict(list)
+        for position, (key, group) in enumerate(representatives):
+            by_subject_predicate[group["canonical"][:2]].append(position)
+
+        merged = [None] * len(representatives)
+        for positions in by_subject_predicate.values():
+            clusters = cluster_near_duplicates([representatives[position][1]["canonical"][2] for position in positions], minhasher, threshold=threshold)
+            for position, cluster in zip(positions, clusters):
+                merged[position] = positions[cluster]
+
+        for position, root in enumerate(merged):
+            if root != position:
+                representatives[root][1]["count"] += representatives[position][1]["count"]
+        representatives = [representative for position, representative in enumerate(representatives) if merged[position] == position]
+
+    deduplicated = []
+    for key, group in representatives:
+        each_triple = group["triple"]
+        each_triple["canonical_hash"] = key
+        each_triple["duplicate_count"] = group["count"]
+        deduplicated.append(each_triple)
+
+    counts = {"raw": sum(group["count"] for _, group in representatives), "unique": num_unique, "representatives": len(deduplicated)}
+    return deduplicated, counts
+
+
+def deduplicate_triples_dir(raw_triples, near_duplicates: bool = False, threshold: float = 0.8):
+    """
+    Deduplicate the triples of every elicited file, see `deduplicate_triples`
+
+    Returns:
+        (dict, dict): filename -> representatives, filename -> counts
+    """
+    minhasher = MinHasher() if near_duplicates else None
+    deduplicated, counts = {}, {}
+    for filename, triples_list in raw_triples.items():
+        deduplicated[filename], counts[filename] = deduplicate_triples(triples_list, near_duplicates, threshold, minhasher)
+        telemetry.inc("dedup_triples_total", counts[filename]["raw"], file=filename, stage="raw")
+        telemetry.inc("dedup_triples_total", counts[filename]["representatives"], file=filename, stage="representatives")
+        logger.info(f"{filename}: {counts[filename]['raw']} triples, {counts[filename]['unique']} canonical, {counts[filename]['representatives']} representatives ...")
+    return deduplicated, counts
+
+
+def write_dedup_counts(counts, file_path):
+    with open(file_path, mode='w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Source Elicited File", "Raw #Triples", "Canonical #Triples", "Representative #Triples"])
+        for filename, file_counts in counts.items():
+            writer.writerow([filename, file_counts["raw"], file_counts["unique"], file_counts["representatives"]])
+
+
+def main(wikidata_triples_dir: str, output_dir: str, near_duplicates: bool = False, threshold: float = 0.8):
+    """
+    Write deduplicated copies of the elicited csv files, with `canonical_hash` and `duplicate_count` columns
+
+    Arguments:
+        wikidata_triples_dir (str): Dir of the elicited `wikidata_triples_<index>.csv` files
+        output_dir (str): Dir the deduplicated files (same names) and `dedup_counts.json` are written to
+        near_duplicates (bool): Also cluster near duplicate objects with MinHash / LSH
+        threshold (float): Minimum estimated Jaccard similarity for near duplicates
+    """
+    raw_triples = {}
+    for file in os.listdir(wikidata_triples_dir):
+        if file.endswith(".csv"):
+            with open(os.path.join(wikidata_triples_dir, file), mode='r', newline='', encoding='utf-8') as f:
+                raw_triples[os.path.splitext(file)[0]] = list(csv.DictReader(f))
+
+    deduplicated, counts = deduplicate_triples_dir(raw_triples, near_duplicates, threshold)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for filename, triples_list in deduplicated.items():
+        fieldnames = list(dict.fromkeys(key for each_triple in triples_list for key in each_triple)) or ["subject", "predicate", "object"]
+        with open(os.path.join(output_dir, f"{filename}.csv"), mode='w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(triples_list)
+    # not a csv, so that the output dir can be evaluated as is
+    with open(os.path.join(output_dir, "dedup_counts.json"), "w") as f:
+        json.dump(counts, f, indent=4)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
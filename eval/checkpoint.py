@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+from loguru import logger
+
+"""
+
+py file containing the append-only JSONL checkpoint of judge verdicts. Every verdict is appended (and flushed to
+the OS) as soon as it is available, fsync is batched every `fsync_every` records or `fsync_interval` seconds, so a
+crash or Ctrl-C loses at most the verdicts of the last unsynced batch on power loss and none on a process crash
+"""
+
+
+def read_checkpoint(file_path) -> dict:
+    """
+    Replay a checkpoint file
+
+    Returns:
+        dict: task id -> checkpointed record, a truncated last line (interrupted write) is ignored
+    """
+    records = {}
+    if not os.path.isfile(file_path):
+        return records
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Ignoring incomplete checkpoint line {line_number} in {file_path}")
+                continue
+            records[record["task_id"]] = record
+
+    return records
+
+
+def truncate_incomplete_line(file_path):
+    """
+    Cut a checkpoint back to its last complete line, so that records appended after an interrupted write start on
+    a line of their own instead of being glued to the broken one
+
+    Returns:
+        int: Number of bytes removed
+    """
+    if not os.path.isfile(file_path):
+        return 0
+
+    with open(file_path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        # scan backwards in blocks for the last newline
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b"\n")
+            if newline != -1:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+            logger.warning(f"Removed an incomplete last line ({size - end} bytes) from checkpoint {file_path}")
+    return size - end
+
+
+class CheckpointWriter:
+    def __init__(self, file_path: str, resume: bool = True, fsync_every: int = 50, fsync_interval: float = 5.0):
+        """
+        Append-only JSONL checkpoint writer
+
+        Arguments:
+            file_path (str): Checkpoint file
+            resume (bool): Keep the existing records (an incomplete last line is removed first), otherwise the
+                checkpoint is started from scratch
+            fsync_every (int): Number of records after which the file is fsynced
+            fsync_interval (float): Seconds after which the file is fsynced, whichever comes first
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+        self.file_path = file_path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._lock = threading.Lock()
+        if resume:
+            truncate_incomplete_line(file_path)
+        self._file = open(file_path, "a" if resume else "w", encoding="utf-8")
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._synced_at >= self.fsync_interval:
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.flush()
+            self._sync()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
@@ -0,0 +1,190 @@
+import math
+import re
+from collections import Counter, OrderedDict
+import numpy as np
+from loguru import logger
+from telemetry import telemetry
+
+"""
+
+py file containing the retrieval based context selection for judge prompts. Instead of the whole claim list of a
+subject (precision) or every elicited fact of a subject (recall), the judge gets the top k context triples most
+relevant to the judged triple, ranked with BM25 or all-MiniLM-L6-v2 embeddings over a per-subject index
+"""
+
+CONTEXT_SELECTION_METHODS = ("full", "bm25", "embedding")
+
+# rough number of characters per token of english text, used for the token budget without a tokenizer dependency
+CHARS_PER_TOKEN = 4
+
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def tokenize(text):
+    """
+    Lower cased word tokens, underscores of entity names count as separators
+    """
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class BM25Index:
+    def __init__(self, documents, k1: float = 1.5, b: float = 0.75):
+        """
+        Okapi BM25 index over a small collection of documents (the context triples of one subject)
+        """
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(tokenize(document)) for document in documents]
+        self.lengths = np.array([sum(frequencies.values()) for frequencies in self.term_frequencies], dtype=np.float64)
+        self.average_length = self.lengths.mean() if len(documents) > 0 else 0.0
+
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        num_documents = len(documents)
+        self.idf = {
+            term: math.log(1 + (num_documents - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    def scores(self, query, ignored_terms = ()):
+        scores = np.zeros(len(self.term_frequencies), dtype=np.float64)
+        if len(scores) == 0:
+            return scores
+        length_norm = self.k1 * (1 - self.b + self.b * self.lengths / max(self.average_length, 1e-9))
+        for term in set(tokenize(query)) - set(ignored_terms):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            frequencies = np.array([frequencies.get(term, 0) for frequencies in self.term_frequencies], dtype=np.float64)
+            scores += idf * frequencies * (self.k1 + 1) / (frequencies + length_norm)
+        return scores
+
+
+class EmbeddingIndex:
+    def __init__(self, documents, model):
+        """
+        Cosine similarity index over normalised sentence embeddings of the documents
+        """
+        self.model = model
+        self.embeddings = model.encode(list(documents), normalize_embeddings=True, convert_to_numpy=True)
+
+    def scores(self, query, ignored_terms = ()):
+        query_embedding = self.model.encode([query], normalize_embeddings=True, convert_to_numpy=True)[0]
+        return self.embeddings @ query_embedding
+
+
+class ContextSelector:
+    def __init__(
+            self,
+            method: str = "full",
+            top_k: int = 20,
+            token_budget: int = None,
+            embedding_model_name: str = "all-MiniLM-L6-v2",
+            max_indexes: int = 256,
+        ):
+        """
+        Select the context triples most relevant to a judged triple
+
+        Arguments:
+            method (str): `full` (no selection, the original behaviour), `bm25` or `embedding`
+            top_k (int): Maximum number of context triples kept per judged triple
+            token_budget (int): Optional maximum (estimated) number of tokens of the kept context triples
+            embedding_model_name (str): Sentence transformer used by the `embedding` method
+            max_indexes (int): Number of per-subject indexes kept in memory
+        """
+        if method not in CONTEXT_SELECTION_METHODS:
+            raise ValueError(f"Unknown context selection method {method}, expected one of {CONTEXT_SELECTION_METHODS}")
+        self.method = method
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.embedding_model_name = embedding_model_name
+        self.max_indexes = max_indexes
+        self._model = None
+        self._indexes = OrderedDict()
+
+    @property
+    def identity(self):
+        """
+        Method and the settings the selected context depends on, part of the checkpoint and judge queue keys
+        """
+        if self.method == "full":
+            return self.method
+        model = f":{self.embedding_model_name}" if self.method == "embedding" else ""
+        return f"{self.method}:{self.top_k}:{self.token_budget}{model}"
+
+    @property
+    def model(self):
+        if self._model is None:
+            # the local embedding worker when it is running, otherwise the model is loaded in process
+            from embedding_worker import EmbeddingClient
+            self._model = EmbeddingClient(self.embedding_model_name)
+        return self._model
+
+    def _build_index(self, documents):
+        if self.method == "embedding":
+            try:
+                return EmbeddingIndex(documents, self.model)
+            except ImportError as e:
+                logger.warning(f"Embedding context selection unavailable ({e}), falling back to BM25 ...")
+                self.method = "bm25"
+        return BM25Index(documents)
+
+    def _index(self, subject, documents):
+        """
+        Per-subject index, rebuilt only when the context documents of the subject change
+        """
+        key = (subject, len(documents), hash(tuple(documents)))
+        index = self._indexes.get(key)
+        if index is None:
+            index = self._build_index(documents)
+            self._indexes[key] = index
+            if len(self._indexes) > self.max_indexes:
+                self._indexes.popitem(last=False)
+        else:
+            self._indexes.move_to_end(key)
+        return index
+
+    def _fits(self, documents):
+        if len(documents) > self.top_k:
+            return False
+        return self.token_budget is None or sum(estimate_tokens(document) for document in documents) <= self.token_budget
+
+    def select(self, subject, query, documents):
+        """
+        Indices of the context documents kept for the judged triple `query`, in their original order
+
+        Arguments:
+            subject (str): Subject of the judged triple, the documents are indexed per subject
+            query (str): The judged triple
+            documents (list): Text of every context triple of the subject
+
+        Returns:
+            list: indices into `documents`, all of them for the `full` method, when the context already fits or
+                when no document is relevant to the query
+        """
+        if self.method == "full" or self._fits(documents):
+            return list(range(len(documents)))
+
+        # the subject occurs in every context triple, its terms carry no information for BM25
+        scores = self._index(subject, documents).scores(query, ignored_terms = tokenize(subject))
+        if not np.any(scores > 0):
+            # nothing in the context relates to the triple, let the judge see all of it
+            telemetry.inc("judge_context_fallbacks_total", method=self.method)
+            return list(range(len(documents)))
+        ranking = [document_index for document_index in np.argsort(-scores, kind="stable")[:self.top_k] if scores[document_index] > 0]
+
+        selected = []
+        used_tokens = 0
+        for document_index in ranking:
+            document_tokens = estimate_tokens(documents[document_index])
+            if self.token_budget is not None and selected and used_tokens + document_tokens > self.token_budget:
+                break
+            selected.append(int(document_index))
+            used_tokens += document_tokens
+
+        telemetry.inc("judge_context_triples_total", len(documents), kind="full")
+        telemetry.inc("judge_context_triples_total", len(selected), kind="selected")
+        return sorted(selected)
@@ -0,0 +1,271 @@
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+import fire
+import numpy as np
+from loguru import logger
+from telemetry import telemetry
+
+"""
+
+py file containing the local embedding worker and its client. The worker is a long lived process keeping the
+sentence transformers (and torch) warm and listening on a Unix socket; requests of all connected clients are
+collected for a few milliseconds and encoded as one batch. `EmbeddingClient` sends its texts to the worker when
+one is running and otherwise encodes them in process, so every eval run uses the worker transparently
+
+Messages are length prefixed frames: the request is a JSON frame {"model", "texts"}, the response a JSON header
+frame {"shape", "dtype"} (or {"error"}) followed by a frame with the raw embeddings
+"""
+
+DEFAULT_MODEL_NAME = "all-MiniLM-L6-v2"
+DEFAULT_SOCKET_PATH = os.environ.get("KB_EVAL_EMBEDDING_SOCKET", os.path.join(tempfile.gettempdir(), "kb_eval_embedding.sock"))
+
+FRAME_HEADER = struct.Struct("!I")
+
+# sentence transformers loaded by this process, model name -> (model, device)
+_sentence_transformers = {}
+_sentence_transformers_lock = threading.Lock()
+
+
+def get_sentence_transformer(model_name = DEFAULT_MODEL_NAME):
+    """
+    Load a sentence transformer once per process, importing torch and sentence_transformers on first use
+
+    Returns:
+        (SentenceTransformer, torch.device)
+    """
+    with _sentence_transformers_lock:
+        if model_name not in _sentence_transformers:
+            import torch
+            from sentence_transformers import SentenceTransformer
+
+            with telemetry.timer("model_load_seconds", model=model_name):
+                device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+                _sentence_transformers[model_name] = (SentenceTransformer(model_name).to(device), device)
+        return _sentence_transformers[model_name]
+
+
+def encode_in_process(texts, model_name = DEFAULT_MODEL_NAME):
+    model, device = get_sentence_transformer(model_name)
+    return model.encode(list(texts), convert_to_numpy=True, device=device).astype(np.float32, copy=False)
+
+
+def _send_frame(connection, payload: bytes):
+    connection.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+
+
+def _receive_exactly(connection, num_bytes):
+    chunks = []
+    while num_bytes:
+        chunk = connection.recv(min(num_bytes, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed by the peer")
+        chunks.append(chunk)
+        num_bytes -= len(chunk)
+    return b"".join(chunks)
+
+
+def _receive_frame(connection):
+    (num_bytes,) = FRAME_HEADER.unpack(_receive_exactly(connection, FRAME_HEADER.size))
+    return _receive_exactly(connection, num_bytes)
+
+
+class _PendingRequest:
+    def __init__(self, model_name, texts):
+        self.model_name = model_name
+        self.texts = texts
+        self.embeddings = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class EmbeddingBatcher:
+    def __init__(self, max_batch_size: int = 256, max_wait_ms: float = 5.0):
+        """
+        Collects the requests of all clients and encodes them together, a batch is closed when it holds
+        `max_batch_size` texts or `max_wait_ms` after its first request
+        """
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def encode(self, model_name, texts):
+        pending_request = _PendingRequest(model_name, texts)
+        self._queue.put(pending_request)
+        pending_request.done.wait()
+        if pending_request.error is not None:
+            raise RuntimeError(pending_request.error)
+        return pending_request.embeddings
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        num_texts = len(batch[0].texts)
+        deadline = time.perf_counter() + self.max_wait_seconds
+        while num_texts < self.max_batch_size:
+            try:
+                pending_request = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            batch.append(pending_request)
+            num_texts += len(pending_request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            by_model = {}
+            for pending_request in batch:
+                by_model.setdefault(pending_request.model_name, []).append(pending_request)
+
+            for model_name, pending_requests in by_model.items():
+                texts = [text for pending_request in pending_requests for text in pending_request.texts]
+                try:
+                    with telemetry.timer("embedding_batch_seconds", model=model_name):
+                        embeddings = encode_in_process(texts, model_name)
+                    telemetry.observe("embedding_batch_size", len(texts))
+                except Exception as e:
+                    logger.error(f"Encoding a batch of {len(texts)} texts with {model_name} failed: {e}")
+                    for pending_request in pending_requests:
+                        pending_request.error = str(e)
+                        pending_request.done.set()
+                    continue
+
+                start = 0
+                for pending_request in pending_requests:
+                    pending_request.embeddings = embeddings[start:start + len(pending_request.texts)]
+                    start += len(pending_request.texts)
+                    pending_request.done.set()
+
+
+class _EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # one connection serves any number of requests of a client
+        while True:
+            try:
+                request = json.loads(_receive_frame(self.request))
+            except (ConnectionError, struct.error):
+                return
+
+            try:
+                embeddings = self.server.batcher.encode(request.get("model") or DEFAULT_MODEL_NAME, request["texts"])
+            except Exception as e:
+                _send_frame(self.request, json.dumps({"error": str(e)}).encode("utf-8"))
+                continue
+            _send_frame(self.request, json.dumps({"shape": list(embeddings.shape), "dtype": "float32"}).encode("utf-8"))
+            _send_frame(self.request, np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+
+
+class EmbeddingWorkerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, batcher: EmbeddingBatcher):
+        self.batcher = batcher
+        super().__init__(socket_path, _EmbeddingRequestHandler)
+
+
+class EmbeddingClient:
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, socket_path: str = None, timeout: float = 60.0):
+        """
+        Sentence embeddings from the local embedding worker, or in process when no worker is running. `encode`
+        follows `SentenceTransformer.encode`, so the client can be used wherever such a model is expected
+
+        Arguments:
+            model_name (str): Sentence transformer to encode with
+            socket_path (str): Unix socket of the worker (default `DEFAULT_SOCKET_PATH`)
+            timeout (float): Socket timeout in seconds
+        """
+        self.model_name = model_name
+        self.socket_path = socket_path or DEFAULT_SOCKET_PATH
+        self.timeout = timeout
+        self._connection = None
+        self._lock = threading.Lock()
+        # a worker which could not be reached is not tried again before this time (e.g. a stale socket file)
+        self._retry_at = 0.0
+
+    def _connect(self):
+        if self._connection is None:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            self._connection = connection
+        return self._connection
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _encode_remote(self, texts):
+        """
+        Embeddings from the worker, None when no worker is reachable
+        """
+        if time.monotonic() < self._retry_at or not os.path.exists(self.socket_path):
+            return None
+        with self._lock:
+            try:
+                connection = self._connect()
+                _send_frame(connection, json.dumps({"model": self.model_name, "texts": texts}).encode("utf-8"))
+                header = json.loads(_receive_frame(connection))
+                if "error" in header:
+                    raise RuntimeError(header["error"])
+                embeddings = np.frombuffer(_receive_frame(connection), dtype=header["dtype"]).reshape(header["shape"])
+            except (OSError, ConnectionError, struct.error) as e:
+                self._close()
+                self._retry_at = time.monotonic() + 30
+                logger.warning(f"Embedding worker at {self.socket_path} unavailable ({e}), encoding in process ...")
+                return None
+        telemetry.inc("embedding_requests_total", source="worker")
+        return embeddings
+
+    def encode(self, sentences, normalize_embeddings: bool = False, convert_to_numpy: bool = True, **kwargs):
+        texts = [sentences] if isinstance(sentences, str) else list(sentences)
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        embeddings = self._encode_remote(texts)
+        if embeddings is None:
+            telemetry.inc("embedding_requests_total", source="in_process")
+            embeddings = encode_in_process(texts, self.model_name)
+
+        if normalize_embeddings:
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings[0] if isinstance(sentences, str) else embeddings
+
+
+def main(socket_path: str = None, model_name: str = DEFAULT_MODEL_NAME, max_batch_size: int = 256, max_wait_ms: float = 5.0):
+    """
+    Run the embedding worker until interrupted
+
+    Arguments:
+        socket_path (str): Unix socket to listen on (default `$KB_EVAL_EMBEDDING_SOCKET` or `<tmp>/kb_eval_embedding.sock`)
+        model_name (str): Sentence transformer loaded at startup, other models are loaded on their first request
+        max_batch_size (int): Maximum number of texts encoded together
+        max_wait_ms (float): Time a batch waits for requests of other clients after its first request
+    """
+    socket_path = socket_path or DEFAULT_SOCKET_PATH
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    get_sentence_transformer(model_name)
+    server = EmbeddingWorkerServer(socket_path, EmbeddingBatcher(max_batch_size, max_wait_ms))
+    logger.info(f"Embedding worker with {model_name} listening on {socket_path} ...")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping the embedding worker ...")
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
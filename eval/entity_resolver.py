@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from loguru import logger
+from telemetry import telemetry
+from wikidata_utils import get_wikidata_entity_id
+
+"""
+
+py file containing the entity name -> wikidata QID resolver shared by the entity sanity check and the gold
+triples construction, so that every name is looked up at most once across runs
+"""
+
+
+def load_wikidata_entities(wikidata_entities_file_path):
+    """
+    Read the handpicked wikidata entities file.
+
+    Every category maps to a list whose items are either a plain entity name or a dict with a precomputed
+    QID, e.g. {"name": "Kurt Gödel", "qid": "Q41390"}
+
+    Returns:
+        tuple: (dict category -> list of entity names, dict entity name -> precomputed QID)
+    """
+    with open(wikidata_entities_file_path, 'r') as file:
+        json_content = json.load(file)
+
+    categories = {}
+    precomputed_qids = {}
+    for category, values in json_content.items():
+        categories[category] = []
+        for item in values:
+            if isinstance(item, dict):
+                categories[category].append(item["name"])
+                if item.get("qid"):
+                    precomputed_qids[item["name"]] = item["qid"]
+            else:
+                categories[category].append(item)
+
+    return categories, precomputed_qids
+
+
+class EntityResolver:
+    def __init__(self, cache_file_path: str = None, max_workers: int = 8, language: str = "en"):
+        """
+        Resolve entity names to wikidata QIDs with a persisted name -> QID map
+
+        Arguments:
+            cache_file_path (str): JSON file persisting the resolved names, names without a match are stored as null
+            max_workers (int): Number of concurrent `wbsearchentities` lookups for names missing from the cache
+            language (str): The language of the entity names (default is "en")
+        """
+        self.cache_file_path = cache_file_path or os.getcwd() + "/entity_qids.json"
+        self.max_workers = max_workers
+        self.language = language
+        self._lock = threading.Lock()
+        self.qids = {}
+
+        if os.path.isfile(self.cache_file_path) and os.path.getsize(self.cache_file_path) > 0:
+            with open(self.cache_file_path, "r") as json_file:
+                self.qids = json.load(json_file)
+
+    def add_precomputed(self, precomputed_qids: dict):
+        """
+        Register QIDs that are already known, e.g. from the QID column of the wikidata entities file
+        """
+        with self._lock:
+            self.qids.update(precomputed_qids)
+
+    def save(self):
+        # unique temporary file, several processes may save the cache at the same time
+        tmp_file_descriptor, tmp_file_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.cache_file_path)), prefix=os.path.basename(self.cache_file_path) + ".", suffix=".tmp"
+        )
+        with self._lock:
+            with os.fdopen(tmp_file_descriptor, "w") as json_file:
+                json.dump(self.qids, json_file, indent=4, ensure_ascii=False)
+        os.replace(tmp_file_path, self.cache_file_path)
+
+    def _lookup(self, entity_name):
+        """
+        Look up a single name, returns (QID or None, True) or (None, False) when the request failed
+        """
+        try:
+            return get_wikidata_entity_id(entity_name, self.language, raise_on_error=True), True
+        except httpx.HTTPError as e:
+            logger.info(f"Lookup of entity {entity_name} failed: {e}")
+            return None, False
+
+    def resolve(self, entity_names, retry_missing: bool = False) -> dict:
+        """
+        Resolve a list of entity names, only names missing from the cache are looked up on wikidata (concurrently)
+
+        Args:
+            entity_names (list): Entity names to resolve
+            retry_missing (bool): Look up again names which previously had no match on wikidata
+
+        Returns:
+            dict: entity name -> QID, or None if the entity does not exist on wikidata or its lookup failed. Failed
+            lookups (transport errors, 429 / 5xx) are not cached and are tried again on the next call
+        """
+        entity_names = list(dict.fromkeys(entity_names))
+        misses = [name for name in entity_names
+                  if name not in self.qids or (retry_missing and self.qids[name] is None)]
+        telemetry.inc("entity_resolver_lookups_total", len(entity_names) - len(misses), result="hit")
+        telemetry.inc("entity_resolver_lookups_total", len(misses), result="miss")
+
+        if misses:
+            logger.info(f"Resolving {len(misses)} entity names on wikidata ...")
+            failed = []
+            try:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                    for name, (qid, ok) in zip(misses, executor.map(self._lookup, misses)):
+                        if not ok:
+                            failed.append(name)
+                            continue
+                        with self._lock:
+                            self.qids[name] = qid
+            finally:
+                # keep the names resolved so far even if the lookups were interrupted
+                self.save()
+            if failed:
+                telemetry.inc("entity_resolver_lookups_total", len(failed), result="error")
+                logger.warning(f"Could not look up {len(failed)} entity names on wikidata, they are not cached and will be retried")
+
+        return {name: self.qids.get(name) for name in entity_names}
+
+    def get(self, entity_name):
+        """
+        Resolve a single entity name
+        """
+        return self.resolve([entity_name])[entity_name]
+
+    def known_qids(self) -> dict:
+        """
+        All names resolved so far which exist on wikidata, without any network lookup
+        """
+        return {name: qid for name, qid in self.qids.items() if qid is not None}
@@ -0,0 +1,281 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from loguru import logger
+from tqdm import tqdm
+from telemetry import telemetry
+from wikidata_utils import fetch_gold_record, fetch_wikidata_revisions
+from wikidata_dump import build_gold_records_from_dump
+from wikidata_sparql import build_gold_records_from_sparql
+
+"""
+
+py file containing the incremental gold triples store. Every subject is persisted as its own shard
+`<gold_dir>/<sha1 of subject>.json`, so the store grows across prompt files and runs, and only subjects
+without a shard are fetched from wikidata. Shards keep the `lastrevid` / `modified` of the entity they were
+built from, so `refresh` only refetches entities edited on wikidata since. Subjects which do not exist on wikidata
+(or are absent from the dump / SPARQL results) get a negative shard {"qid": null, "missing": true, "triples": []}
+with the time of the lookup, so they are not looked up again on every run
+"""
+
+
+class GoldStore:
+    def __init__(self, gold_dir_path: str = None):
+        """
+        Sharded, per-subject store of gold triples parsed from wikidata
+
+        Arguments:
+            gold_dir_path (str): Directory storing one JSON shard per subject
+        """
+        self.gold_dir_path = gold_dir_path or os.getcwd() + "/gold/"
+        os.makedirs(self.gold_dir_path, exist_ok=True)
+        self._lock = threading.Lock()
+
+        # shards read so far, a subject is read from disk at most once per process
+        self._cache = {}
+
+    def shard_path(self, subject):
+        file_name = hashlib.sha1(subject.encode("utf-8")).hexdigest() + ".json"
+        return os.path.join(self.gold_dir_path, file_name)
+
+    def stored(self, subject) -> bool:
+        """
+        The subject has a shard, with gold triples or negative
+        """
+        return subject in self._cache or os.path.isfile(self.shard_path(subject))
+
+    def has(self, subject) -> bool:
+        """
+        The subject has gold triples, i.e. a shard which is not negative
+        """
+        record = self.get_record(subject)
+        return record is not None and not record.get("missing", False)
+
+    def missing(self, subjects, retry_missing: bool = False) -> list:
+        """
+        Subjects (in order, without duplicates) which do not have a shard yet, with `retry_missing` also the
+        subjects with a negative shard
+        """
+        if retry_missing:
+            return [subject for subject in dict.fromkeys(subjects) if not self.has(subject)]
+        return [subject for subject in dict.fromkeys(subjects) if not self.stored(subject)]
+
+    def get_record(self, subject):
+        """
+        Full shard for a subject: {"subject", "qid", "lastrevid", "modified", "triples"}, or None if the subject is not stored
+        """
+        with self._lock:
+            if subject in self._cache:
+                return self._cache[subject]
+
+        shard_path = self.shard_path(subject)
+        if not os.path.isfile(shard_path):
+            return None
+        with open(shard_path, "r") as json_file:
+            record = json.load(json_file)
+        with self._lock:
+            self._cache[subject] = record
+        return record
+
+    def get(self, subject) -> list:
+        """
+        Gold triples for a subject, empty list if the subject is not stored
+        """
+        record = self.get_record(subject)
+        telemetry.inc("gold_lookups_total", result="hit" if record is not None else "miss")
+        return record["triples"] if record is not None else []
+
+    def put_record(self, subject, record):
+        """
+        Write a record as returned by `fetch_gold_record` / `build_gold_records_from_dump`
+        """
+        metadata = {key: value for key, value in record.items() if key != "triples"}
+        self.put(subject, record["triples"], **metadata)
+
+    def put(self, subject, triples, **metadata):
+        """
+        Write (or overwrite) the shard of a subject, extra keyword arguments are stored alongside the triples
+        """
+        record = {"subject": subject, **metadata, "triples": triples}
+        shard_path = self.shard_path(subject)
+        # unique temporary file, concurrent processes (e.g. the gold stages of the pipeline) may write the same shard
+        tmp_file_descriptor, tmp_file_path = tempfile.mkstemp(dir=self.gold_dir_path, prefix=os.path.basename(shard_path) + ".", suffix=".tmp")
+        with os.fdopen(tmp_file_descriptor, "w") as json_file:
+            json.dump(record, json_file, indent=4)
+        os.replace(tmp_file_path, shard_path)
+        with self._lock:
+            self._cache[subject] = record
+
+    def put_missing(self, subject):
+        """
+        Write the negative shard of a subject which does not exist on wikidata
+        """
+        self.put(subject, [], qid=None, missing=True, checked_at=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+
+    def subjects(self) -> list:
+        """
+        All stored subjects, reads every shard
+        """
+        subjects = []
+        for file_name in sorted(os.listdir(self.gold_dir_path)):
+            if file_name.endswith(".json"):
+                with open(os.path.join(self.gold_dir_path, file_name), "r") as json_file:
+                    record = json.load(json_file)
+                subjects.append(record["subject"])
+                with self._lock:
+                    self._cache.setdefault(record["subject"], record)
+        return subjects
+
+    def as_dict(self, subjects = None) -> dict:
+        """
+        Same structure as the legacy gold.json: subject -> list of triples
+        """
+        subjects = self.subjects() if subjects is None else subjects
+        return {subject: self.get_record(subject)["triples"] for subject in subjects if self.has(subject)}
+
+    def import_gold_file(self, gold_file_path):
+        """
+        Import the subjects of a legacy gold.json which are not in the store yet
+        """
+        if not (os.path.isfile(gold_file_path) and os.path.getsize(gold_file_path) > 0):
+            return 0
+
+        with open(gold_file_path, "r") as json_file:
+            gold_triples = json.load(json_file)
+
+        imported = 0
+        for subject, triples in gold_triples.items():
+            if not self.stored(subject):
+                self.put(subject, triples)
+                imported += 1
+
+        if imported:
+            logger.info(f"Imported {imported} subjects from {gold_file_path} into the gold store ...")
+        return imported
+
+    def ensure(self, subjects, entity_resolver, wikidata_dump_path = None, sparql_endpoint = None, retry_missing: bool = False):
+        """
+        Fetch the gold triples of all subjects which are not stored yet, from the web api, a local dump or SPARQL
+
+        Args:
+            subjects (iterable): Subject names across all elicited files
+            entity_resolver (EntityResolver): Resolver used to map subject names to QIDs
+            wikidata_dump_path (str): Optional local Wikidata JSON dump used instead of the web api
+            sparql_endpoint (str): Optional SPARQL endpoint url (or local RDF file) to fetch the subjects in bulk
+            retry_missing (bool): Look up again the subjects with a negative shard
+
+        Returns:
+            list: The subjects which were missing before the call
+        """
+        missing_subjects = self.missing(subjects, retry_missing)
+        logger.info(f"Gold store has {len(dict.fromkeys(subjects)) - len(missing_subjects)} subjects, fetching {len(missing_subjects)} missing ...")
+        if not missing_subjects:
+            return missing_subjects
+
+        self.fetch(missing_subjects, entity_resolver, wikidata_dump_path, sparql_endpoint, retry_missing)
+        return missing_subjects
+
+    def check_entities(self, entity_names, entity_resolver, wikidata_dump_path = None, retry_missing: bool = False) -> dict:
+        """
+        Sanity check that the entities exist on wikidata. With a local dump the entities are matched in the dump (their
+        shards are built in the same pass, so the gold stage does not scan it for them again) instead of the web api
+
+        Returns:
+            dict: entity name -> QID, or None if the entity was not found
+        """
+        if wikidata_dump_path is None:
+            return entity_resolver.resolve(entity_names, retry_missing)
+
+        self.ensure(entity_names, entity_resolver, wikidata_dump_path, retry_missing = retry_missing)
+        entity_qids = {}
+        for name in entity_names:
+            record = self.get_record(name)
+            entity_qids[name] = record.get("qid") if record is not None else None
+        return entity_qids
+
+    def fetch(self, subjects, entity_resolver, wikidata_dump_path = None, sparql_endpoint = None, retry_missing: bool = False):
+        """
+        Fetch (or refetch) the gold triples of the given subjects and write their shards. Subjects which do not exist
+        on wikidata get a negative shard, subjects whose lookup failed get no shard and are fetched again next time
+        """
+        if wikidata_dump_path is not None:
+            gold_records = build_gold_records_from_dump(subjects, wikidata_dump_path, entity_resolver.known_qids())
+            self.put_records(subjects, gold_records)
+            return
+
+        subject_entity_ids = entity_resolver.resolve(subjects, retry_missing)
+        # names whose lookup failed are not in the resolver cache, only the cached null entries are real misses
+        not_on_wikidata = {subject for subject in subjects if subject in entity_resolver.qids and entity_resolver.qids[subject] is None}
+        if sparql_endpoint is not None:
+            gold_records = build_gold_records_from_sparql(subject_entity_ids, sparql_endpoint)
+            self.put_records([subject for subject in subjects if subject_entity_ids[subject] is not None or subject in not_on_wikidata], gold_records)
+            return
+
+        for subject in tqdm(subjects, desc="Fetching gold subjects"):
+            subject_entity_id = subject_entity_ids[subject]
+            if subject_entity_id is None:
+                if subject in not_on_wikidata:
+                    self.put_missing(subject)
+                continue
+            self.put_record(subject, fetch_gold_record(subject, subject_entity_id))
+
+    def put_records(self, subjects, gold_records):
+        """
+        Write the records built in bulk (dump or SPARQL), subjects without a record get a negative shard
+        """
+        for subject in subjects:
+            if subject in gold_records:
+                self.put_record(subject, gold_records[subject])
+            else:
+                self.put_missing(subject)
+        telemetry.inc("gold_missing_subjects_total", len([subject for subject in subjects if subject not in gold_records]))
+
+    def refresh(self, entity_resolver, batch_size: int = 50, sparql_endpoint = None) -> list:
+        """
+        Refetch the subjects whose wikidata entity changed since their shard was written. Revisions are checked in
+        bulk (`batch_size` entities per request), so an up to date store costs len(store) / batch_size requests.
+        Shards without a recorded revision (e.g. imported from a legacy gold.json) are always refetched.
+        With a SPARQL endpoint the stale subjects are refetched in bulk through it.
+
+        Returns:
+            list: The refreshed subjects
+        """
+        # negative shards have nothing to refresh, `ensure(..., retry_missing=True)` looks them up again
+        records = [record for record in (self.get_record(subject) for subject in self.subjects()) if not record.get("missing", False)]
+
+        # shards imported from gold.json have no qid yet
+        unresolved = [record["subject"] for record in records if not record.get("qid")]
+        resolved_qids = entity_resolver.resolve(unresolved) if unresolved else {}
+        for record in records:
+            if not record.get("qid"):
+                record["qid"] = resolved_qids.get(record["subject"])
+
+        records = [record for record in records if record.get("qid")]
+        revisions = fetch_wikidata_revisions([record["qid"] for record in records], batch_size)
+
+        stale_subjects = []
+        for record in records:
+            revision = revisions.get(record["qid"])
+            if revision is None:
+                continue
+            if record.get("lastrevid") is None or revision["lastrevid"] != record["lastrevid"]:
+                stale_subjects.append(record["subject"])
+
+        telemetry.inc("gold_refresh_checked_total", len(records))
+        telemetry.inc("gold_refresh_stale_total", len(stale_subjects))
+        logger.info(f"{len(stale_subjects)} of {len(records)} gold subjects changed on wikidata, refetching ...")
+
+        if sparql_endpoint is not None:
+            stale_qids = {subject: self.get_record(subject)["qid"] for subject in stale_subjects}
+            for subject, record in build_gold_records_from_sparql(stale_qids, sparql_endpoint).items():
+                self.put_record(subject, record)
+            return stale_subjects
+
+        for subject in tqdm(stale_subjects, desc="Refreshing gold subjects"):
+            record = self.get_record(subject)
+            self.put_record(subject, fetch_gold_record(subject, record["qid"]))
+
+        return stale_subjects
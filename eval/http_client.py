@@ -0,0 +1,224 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlparse
+import httpx
+from loguru import logger
+from telemetry import telemetry
+
+"""
+
+py file containing the shared HTTP client used for the Wikidata api and web search calls. Connections are pooled
+and kept alive across calls (no TCP / TLS handshake per request), responses are gzip compressed, every request has
+a timeout, 429 / 5xx responses and transport errors are retried with exponential backoff honouring Retry-After,
+and the number of requests in flight is capped per host. The same client serves sync and async callers
+"""
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# requests in flight per host, hosts not listed use `max_connections_per_host`
+DEFAULT_HOST_LIMITS = {
+    "www.wikidata.org": 8,
+    "api.search.brave.com": 4,
+}
+
+USER_AGENT = "KB-Eval-Enhanced/1.0 (knowledge base evaluation; python-httpx)"
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait according to a Retry-After header, given either as seconds or as an HTTP date
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class HttpClient:
+    def __init__(
+            self,
+            timeout: float = 30.0,
+            connect_timeout: float = 10.0,
+            max_connections: int = 64,
+            max_keepalive_connections: int = 32,
+            max_connections_per_host: int = 8,
+            host_limits: dict = None,
+            max_retries: int = 5,
+            backoff_factor: float = 0.5,
+            max_backoff: float = 60.0,
+        ):
+        """
+        Pooled HTTP client with retries and per-host concurrency caps
+
+        Arguments:
+            timeout (float): Read / write / pool timeout in seconds
+            connect_timeout (float): Connect timeout in seconds
+            max_connections (int): Maximum number of pooled connections over all hosts
+            max_keepalive_connections (int): Maximum number of idle connections kept alive
+            max_connections_per_host (int): Maximum number of requests in flight per host
+            host_limits (dict): Per host overrides of `max_connections_per_host`
+            max_retries (int): Retries of a request after a 429 / 5xx response or a transport error
+            backoff_factor (float): Base of the exponential backoff in seconds, jittered
+            max_backoff (float): Upper bound of a single wait, also for Retry-After
+        """
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive_connections)
+        self.headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip"}
+        self.max_connections_per_host = max_connections_per_host
+        self.host_limits = dict(DEFAULT_HOST_LIMITS, **(host_limits or {}))
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+
+        # requests per (host, status), status is the exception name for transport errors
+        self.request_counts = Counter()
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+        self._host_semaphores = {}
+        self._async_host_semaphores = {}
+
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(timeout=self.timeout, limits=self.limits, headers=self.headers, follow_redirects=True)
+            return self._client
+
+    @property
+    def async_client(self):
+        """
+        Async client, bound to the event loop of its first use
+        """
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits, headers=self.headers, follow_redirects=True)
+        return self._async_client
+
+    def host_limit(self, host):
+        return self.host_limits.get(host, self.max_connections_per_host)
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            semaphore = self._host_semaphores.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.host_limit(host))
+                self._host_semaphores[host] = semaphore
+            return semaphore
+
+    def _async_host_semaphore(self, host):
+        semaphore = self._async_host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.host_limit(host))
+            self._async_host_semaphores[host] = semaphore
+        return semaphore
+
+    def _record(self, host, status):
+        with self._lock:
+            self.request_counts[(host, str(status))] += 1
+        telemetry.inc("http_requests_total", host=host, status=status)
+
+    def _retry_delay(self, attempt, response = None):
+        """
+        Seconds to wait before retry number `attempt`, the server's Retry-After takes precedence
+        """
+        retry_after = parse_retry_after(response.headers.get("Retry-After")) if response is not None else None
+        if retry_after is None:
+            retry_after = self.backoff_factor * (2 ** attempt) * (0.5 + random.random())
+        return min(retry_after, self.max_backoff)
+
+    def _should_retry(self, host, attempt, response, error):
+        if attempt >= self.max_retries:
+            return False
+        if error is not None:
+            reason = type(error).__name__
+        elif response.status_code in RETRY_STATUS_CODES:
+            reason = str(response.status_code)
+        else:
+            return False
+        telemetry.inc("http_retries_total", host=host, reason=reason)
+        logger.info(f"Retrying request to {host} after {reason} (attempt {attempt + 1} of {self.max_retries}) ...")
+        return True
+
+    def request(self, method, url, params = None, headers = None, **kwargs):
+        """
+        Send a request, retrying 429 / 5xx responses and transport errors
+
+        Returns:
+            httpx.Response: the final response, which may still be an error status once the retries are exhausted
+        """
+        host = urlparse(url).netloc
+        semaphore = self._host_semaphore(host)
+        attempt = 0
+        while True:
+            response, error = None, None
+            with semaphore, telemetry.timer("http_request_latency_seconds", host=host):
+                try:
+                    response = self.client.request(method, url, params=params, headers=headers, **kwargs)
+                except httpx.TransportError as e:
+                    error = e
+            self._record(host, response.status_code if response is not None else type(error).__name__)
+
+            if not self._should_retry(host, attempt, response, error):
+                if error is not None:
+                    raise error
+                return response
+            time.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    def get(self, url, params = None, headers = None, **kwargs):
+        return self.request("GET", url, params=params, headers=headers, **kwargs)
+
+    async def arequest(self, method, url, params = None, headers = None, **kwargs):
+        """
+        Async version of `request`
+        """
+        host = urlparse(url).netloc
+        semaphore = self._async_host_semaphore(host)
+        attempt = 0
+        while True:
+            response, error = None, None
+            async with semaphore:
+                with telemetry.timer("http_request_latency_seconds", host=host):
+                    try:
+                        response = await self.async_client.request(method, url, params=params, headers=headers, **kwargs)
+                    except httpx.TransportError as e:
+                        error = e
+            self._record(host, response.status_code if response is not None else type(error).__name__)
+
+            if not self._should_retry(host, attempt, response, error):
+                if error is not None:
+                    raise error
+                return response
+            await asyncio.sleep(self._retry_delay(attempt, response))
+            attempt += 1
+
+    async def aget(self, url, params = None, headers = None, **kwargs):
+        return await self.arequest("GET", url, params=params, headers=headers, **kwargs)
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+            self._async_host_semaphores = {}
+
+
+# process wide client shared by the wikidata helpers and the web search
+http_client = HttpClient()
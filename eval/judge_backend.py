@@ -0,0 +1,388 @@
+import random
+import re
+import threading
+from collections import Counter
+import numpy as np
+from loguru import logger
+from request import Request
+from telemetry import telemetry
+
+"""
+
+py file containing the judge backends used by ProcessRequest. A backend answers with the option of the judge
+prompt (a: true, b: plausible, c: implausible, d: false) for a triple given its context (gold triples, elicited
+facts or web snippets). Besides the OpenAI chat judge there is a cascade of a cheap and a strong LLM, a local
+CPU backend scoring (context, triple) pairs in batches with a cross-encoder NLI model, and a deterministic rule
+based backend
+"""
+
+JUDGE_BACKENDS = ("openai", "cascade", "cross_encoder", "rule")
+
+
+def split_triple_str(triple):
+    """
+    Split a triple string `(subject, predicate, object)` into its three parts
+    """
+    parts = [part.strip() for part in triple.strip().strip("()").split(",", 2)]
+    return parts + [""] * (3 - len(parts))
+
+
+class JudgeBackend:
+    """
+    Interface of a judge backend
+    """
+    name = None
+
+    # number of (triple, context) pairs the backend scores in one call
+    batch_size = 1
+
+    # prompt token counts, only reported by LLM backends
+    prompt_tokens = 0
+    cached_tokens = 0
+
+    @property
+    def identity(self):
+        """
+        Backend name and the settings its verdicts depend on, verdicts of different identities are never mixed
+        """
+        return self.name
+
+    def judge(self, triple, context, judge_type = "wikidata"):
+        """
+        Judge a single triple against its context, `judge_type` is either wikidata or snippet
+
+        Returns:
+            str: output starting with the option a, b, c or d
+        """
+        raise NotImplementedError
+
+    def judge_batch(self, pairs, judge_type = "wikidata"):
+        """
+        Judge a list of (triple, context) pairs, returns the outputs in the same order
+        """
+        return [self.judge(triple, context, judge_type) for triple, context in pairs]
+
+    def snapshot(self):
+        """
+        Copy of the counters reported by `summary`, None for backends without a report
+        """
+        return None
+
+    def summary(self, since = None):
+        """
+        Optional one line report of the backend, logged after every judged file
+
+        Arguments:
+            since: Counters returned by `snapshot`, only the verdicts judged after it are reported
+        """
+        return None
+
+
+class OpenAIJudgeBackend(JudgeBackend):
+    name = "openai"
+
+    def __init__(self, model_name: str = "gpt-4o-mini", prompt_layout: str = "prefix_cache"):
+        """
+        LLM as a judge through the OpenAI chat completions api, see `Request`
+        """
+        self.request = Request(model_name, prompt_layout = prompt_layout)
+
+    @property
+    def identity(self):
+        return f"{self.name}:{self.request.model_name}:{self.request.prompt_layout}"
+
+    @property
+    def prompt_tokens(self):
+        return self.request.prompt_tokens
+
+    @property
+    def cached_tokens(self):
+        return self.request.cached_tokens
+
+    def judge(self, triple, context, judge_type = "wikidata"):
+        if judge_type == "snippet":
+            return self.request.verify_triple_lm_snippet(triple, context)
+        return self.request.verify_triple_lm_wikidata(triple, context)
+
+
+class CascadeJudgeBackend(JudgeBackend):
+    name = "cascade"
+
+    def __init__(
+            self,
+            cheap_model_name: str = "gpt-4o-mini",
+            strong_model_name: str = "gpt-4o",
+            confidence_threshold: float = 0.9,
+            audit_rate: float = 0.0,
+            prompt_layout: str = "prefix_cache",
+            seed: int = 0,
+        ):
+        """
+        Two stage LLM judge: the cheap model answers with a single token verdict and its probability (logprobs), only
+        verdicts below `confidence_threshold` are escalated to the strong model, whose verdict is kept
+
+        Arguments:
+            cheap_model_name (str): Model judging every triple
+            strong_model_name (str): Model judging the escalated triples
+            confidence_threshold (float): Minimum probability of the cheap verdict to keep it without escalation
+            audit_rate (float): Fraction of the confident cheap verdicts also judged by the strong model (the cheap
+                verdict is kept), measures the agreement above the threshold for tuning it
+            prompt_layout (str): Judge prompt layout of both models, see `Request`
+            seed (int): Seed of the audit sampling
+        """
+        self.cheap_request = Request(cheap_model_name, prompt_layout = prompt_layout)
+        self.strong_request = Request(strong_model_name, prompt_layout = prompt_layout)
+        self.confidence_threshold = confidence_threshold
+        self.audit_rate = audit_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        # routed verdicts, and agreement of the compared (escalated or audited) verdicts per confidence decile
+        self.routes = Counter()
+        self.compared = Counter()
+        self.agreed = Counter()
+
+    @property
+    def identity(self):
+        return (
+            f"{self.name}:{self.cheap_request.model_name}:{self.strong_request.model_name}:"
+            f"{self.confidence_threshold:g}:{self.cheap_request.prompt_layout}"
+        )
+
+    @property
+    def prompt_tokens(self):
+        return self.cheap_request.prompt_tokens + self.strong_request.prompt_tokens
+
+    @property
+    def cached_tokens(self):
+        return self.cheap_request.cached_tokens + self.strong_request.cached_tokens
+
+    def _strong_verdict(self, triple, context, judge_type):
+        if judge_type == "snippet":
+            return self.strong_request.verify_triple_lm_snippet(triple, context)
+        return self.strong_request.verify_triple_lm_wikidata(triple, context)
+
+    def _record(self, route, confidence, cheap_verdict = None, strong_verdict = None):
+        telemetry.inc("judge_cascade_verdicts_total", route=route)
+        telemetry.observe("judge_cascade_confidence", confidence, route=route)
+        with self._lock:
+            self.routes[route] += 1
+            if strong_verdict is None:
+                return
+            agree = cheap_verdict == strong_verdict.strip()[:1].lower()
+            confidence_decile = min(int(confidence * 10), 9) / 10
+            self.compared[confidence_decile] += 1
+            self.agreed[confidence_decile] += agree
+        telemetry.inc("judge_cascade_compared_total", route=route, agree=agree, confidence_decile=confidence_decile)
+
+    def judge(self, triple, context, judge_type = "wikidata"):
+        cheap_verdict, confidence = self.cheap_request.verify_triple_with_confidence(triple, context, judge_type)
+
+        if confidence < self.confidence_threshold:
+            strong_verdict = self._strong_verdict(triple, context, judge_type)
+            self._record("escalated", confidence, cheap_verdict, strong_verdict)
+            return strong_verdict
+
+        if self.audit_rate > 0 and self._random.random() < self.audit_rate:
+            self._record("audited", confidence, cheap_verdict, self._strong_verdict(triple, context, judge_type))
+        else:
+            self._record("cheap", confidence)
+        return cheap_verdict
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.routes), Counter(self.compared), Counter(self.agreed)
+
+    def summary(self, since = None):
+        # counters are cumulative over the process, `since` turns them into the counts of one file
+        routes, compared, agreed = self.snapshot()
+        if since is not None:
+            routes, compared, agreed = routes - since[0], compared - since[1], agreed - since[2]
+        total = sum(routes.values())
+        if not total:
+            return None
+        num_compared = sum(compared.values())
+        agreement_rate = sum(agreed.values()) / num_compared if num_compared else 0.0
+        deciles = ", ".join(f">={decile:.1f}: {agreed[decile]}/{compared[decile]}" for decile in sorted(compared))
+        return (
+            f"Cascade judge: {routes['escalated']} of {total} verdicts escalated ({routes['escalated'] / total:.1%}), "
+            f"cheap / strong agreement {agreement_rate:.1%} on {num_compared} compared verdicts "
+            f"(by cheap confidence {deciles or '-'})"
+        )
+
+
+class CrossEncoderJudgeBackend(JudgeBackend):
+    name = "cross_encoder"
+
+    def __init__(
+            self,
+            model_name: str = "cross-encoder/nli-deberta-v3-small",
+            batch_size: int = 64,
+            true_threshold: float = 0.5,
+            num_threads: int = None,
+        ):
+        """
+        Local CPU judge scoring (context, triple) pairs with a cross-encoder NLI model, loaded once. Contexts longer
+        than the model input are split at their triple separators into premises that fit, the triple is scored against
+        every premise and the most conclusive premise decides (an entailing one, otherwise a contradicting one)
+
+        Arguments:
+            model_name (str): Sentence transformers cross-encoder with entailment / neutral / contradiction labels
+            batch_size (int): Number of pairs scored per forward pass
+            true_threshold (float): Minimum entailment probability for a true (a) verdict, a lower winning entailment is plausible (b)
+            num_threads (int): Optional number of torch CPU threads
+        """
+        import torch
+        from sentence_transformers import CrossEncoder
+
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.true_threshold = true_threshold
+        self.model = CrossEncoder(model_name, device = "cpu")
+        self.tokenizer = self.model.tokenizer
+        # tokenizers without a configured limit report a huge model_max_length
+        self.max_length = getattr(self.model, "max_length", None) or min(self.tokenizer.model_max_length, 512)
+        self._lock = threading.Lock()
+
+        id2label = {index: label.lower() for index, label in self.model.config.id2label.items()}
+        label_index = {label: index for index, label in id2label.items()}
+        try:
+            self.entailment_index = label_index["entailment"]
+            self.neutral_index = label_index["neutral"]
+            self.contradiction_index = label_index["contradiction"]
+        except KeyError:
+            raise ValueError(f"Model {model_name} is not an NLI cross-encoder, labels are {id2label}")
+
+    @property
+    def identity(self):
+        return f"{self.name}:{self.model_name}:{self.true_threshold:g}:{self.max_length}"
+
+    def premises(self, context, hypothesis):
+        """
+        Split a context into premises which fit the model input next to the hypothesis, at the separators of its
+        triples. A single context triple longer than the input is still truncated by the model, which is logged
+        """
+        # room for the special tokens of the pair
+        budget = self.max_length - len(self.tokenizer(hypothesis, add_special_tokens = False)["input_ids"]) - 4
+        pieces = [piece for piece in re.split(r"(?<=,)", context) if piece.strip()]
+        if not pieces:
+            return [context]
+        lengths = [len(input_ids) for input_ids in self.tokenizer(pieces, add_special_tokens = False)["input_ids"]]
+        if sum(lengths) <= budget:
+            return [context]
+
+        premises, current, current_length = [], [], 0
+        for piece, length in zip(pieces, lengths):
+            if length > budget:
+                telemetry.inc("judge_cross_encoder_truncated_premises_total", model=self.model_name)
+                logger.warning(f"Context triple of {length} tokens does not fit the {self.max_length} token input of {self.model_name}, it is truncated")
+            if current and current_length + length > budget:
+                premises.append("".join(current))
+                current, current_length = [], 0
+            current.append(piece)
+            current_length += length
+        premises.append("".join(current))
+        telemetry.inc("judge_cross_encoder_split_contexts_total", model=self.model_name)
+        return premises
+
+    def aggregate(self, probabilities):
+        """
+        Probabilities of the premise deciding the verdict of a triple scored against several premises
+        """
+        winners = np.argmax(probabilities, axis=1)
+        if np.any(winners == self.entailment_index):
+            return probabilities[np.argmax(probabilities[:, self.entailment_index])]
+        if np.any(winners == self.contradiction_index):
+            return probabilities[np.argmax(probabilities[:, self.contradiction_index])]
+        return probabilities[np.argmax(probabilities[:, self.entailment_index])]
+
+    def verdict(self, probabilities):
+        """
+        Map the entailment / neutral / contradiction probabilities of one pair to a judge option
+        """
+        entailment = probabilities[self.entailment_index]
+        contradiction = probabilities[self.contradiction_index]
+        winner = int(np.argmax(probabilities))
+        if winner == self.entailment_index:
+            return "a" if entailment >= self.true_threshold else "b"
+        if winner == self.contradiction_index:
+            return "d"
+        return "b" if entailment >= contradiction else "c"
+
+    def judge(self, triple, context, judge_type = "wikidata"):
+        return self.judge_batch([(triple, context)], judge_type)[0]
+
+    def judge_batch(self, pairs, judge_type = "wikidata"):
+        # the context is the premise and the triple the hypothesis, contexts longer than the model input are
+        # scored as several premises instead of being truncated
+        inputs, owners = [], []
+        for pair_index, (triple, context) in enumerate(pairs):
+            hypothesis = " ".join(split_triple_str(triple))
+            for premise in self.premises(context, hypothesis):
+                inputs.append((premise, hypothesis))
+                owners.append(pair_index)
+        with self._lock, telemetry.timer("judge_latency_seconds", model=self.model_name, judge_type=judge_type):
+            logits = self.model.predict(inputs, batch_size = self.batch_size, convert_to_numpy = True)
+        logits = np.asarray(logits).reshape(len(inputs), -1)
+        probabilities = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities /= probabilities.sum(axis=1, keepdims=True)
+        telemetry.inc("judge_requests_total", len(inputs), model=self.model_name, judge_type=judge_type)
+        owners = np.asarray(owners)
+        return [self.verdict(self.aggregate(probabilities[owners == pair_index])) for pair_index in range(len(pairs))]
+
+
+class RuleBasedJudgeBackend(JudgeBackend):
+    name = "rule"
+
+    def __init__(self, batch_size: int = 256):
+        """
+        Deterministic judge based on string containment, for testing the evaluation without any model:
+        a) the predicate and the object occur in the context, b) the object occurs in the context,
+        c) the predicate occurs in the context, d) neither occurs in the context
+        """
+        self.batch_size = batch_size
+
+    @staticmethod
+    def normalize(text):
+        # only letters and digits are compared, so spacing / underscores / separators of the context do not matter
+        return re.sub(r"[\W_]+", "", str(text).lower())
+
+    def judge(self, triple, context, judge_type = "wikidata"):
+        _, predicate, obj = split_triple_str(triple)
+        context, predicate, obj = self.normalize(context), self.normalize(predicate), self.normalize(obj)
+        predicate_found = len(predicate) > 0 and predicate in context
+        object_found = len(obj) > 0 and obj in context
+        if predicate_found and object_found:
+            return "a"
+        if object_found:
+            return "b"
+        if predicate_found:
+            return "c"
+        return "d"
+
+
+def create_judge_backend(
+        backend: str = "openai",
+        model_name: str = "gpt-4o-mini",
+        prompt_layout: str = "prefix_cache",
+        cross_encoder_model_name: str = "cross-encoder/nli-deberta-v3-small",
+        batch_size: int = None,
+        strong_model_name: str = "gpt-4o",
+        confidence_threshold: float = 0.9,
+        audit_rate: float = 0.0,
+    ):
+    """
+    Create a judge backend by name, `model_name` is the LLM of the openai backend and the cheap LLM of the cascade
+    """
+    if backend == "openai":
+        return OpenAIJudgeBackend(model_name, prompt_layout)
+    if backend == "cascade":
+        return CascadeJudgeBackend(model_name, strong_model_name, confidence_threshold, audit_rate, prompt_layout)
+    if backend == "cross_encoder":
+        logger.info(f"Loading cross-encoder judge {cross_encoder_model_name} ...")
+        return CrossEncoderJudgeBackend(cross_encoder_model_name, batch_size = batch_size or 64)
+    if backend == "rule":
+        return RuleBasedJudgeBackend(batch_size = batch_size or 256)
+    raise ValueError(f"Unknown judge backend {backend}, expected one of {JUDGE_BACKENDS}")
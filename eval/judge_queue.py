@@ -0,0 +1,346 @@
+import hashlib
+import os
+import socket
+import sqlite3
+import time
+import fire
+from loguru import logger
+from telemetry import telemetry
+
+"""
+
+py file containing the durable work queue of judge tasks for distributed judging. The coordinator (`main.py` with
+`--judge_queue_path`) enqueues the judge tasks of every (file, metric, seed, judge) job into a SQLite database, any number
+of worker processes (`python judge_queue.py worker ...`, on one or several hosts sharing the database file) claim
+batches of tasks under a lease, judge them and write the verdicts back. A task whose lease expires (crashed or killed
+worker) is claimed again by another worker, verdicts are written once, so a late duplicate verdict is ignored.
+Re-running the coordinator command once the queue is drained reduces the verdicts into `results.csv`. Every job
+records the judge identity (backend and settings, see `JudgeBackend.identity`) of the coordinator, workers only claim
+the tasks of jobs with their own identity
+"""
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+
+
+def context_hash(context):
+    return hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+
+class JudgeQueue:
+    def __init__(self, queue_file_path: str, timeout: float = 60.0):
+        """
+        SQLite queue of judge tasks, the contexts are stored once and referenced by hash from the tasks
+        (the precision tasks of one subject share its gold context)
+
+        Arguments:
+            queue_file_path (str): SQLite database file, on storage with working file locks when shared between hosts
+            timeout (float): Seconds a statement waits for the database lock held by another process
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(queue_file_path)), exist_ok=True)
+        self.queue_file_path = queue_file_path
+        # transactions are started explicitly, so a claim reads and leases its tasks atomically
+        self.connection = sqlite3.connect(queue_file_path, timeout=timeout, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS contexts ("
+            "hash TEXT PRIMARY KEY, "
+            "context TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "job TEXT NOT NULL, "
+            "task_id TEXT NOT NULL, "
+            "subject TEXT NOT NULL, "
+            "predicate TEXT NOT NULL, "
+            "triple_str TEXT NOT NULL, "
+            "context_hash TEXT NOT NULL, "
+            "judge_type TEXT NOT NULL, "
+            "status TEXT NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, "
+            "lease_expires REAL, "
+            "output TEXT, "
+            "PRIMARY KEY (job, task_id))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "job TEXT PRIMARY KEY, "
+            "judge TEXT NOT NULL)"
+        )
+
+    def enqueue(self, job, tasks, judge, judge_type = "wikidata"):
+        """
+        Add the tasks of a job in the given order, tasks already in the queue (e.g. a re-run coordinator) are kept as they are.
+        A job is judged by a single judge identity, enqueueing it for another judge raises a ValueError
+
+        Returns:
+            int: number of newly added tasks
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            self.connection.execute("INSERT OR IGNORE INTO jobs (job, judge) VALUES (?, ?)", (job, judge))
+            job_judge = self.connection.execute("SELECT judge FROM jobs WHERE job = ?", (job,)).fetchone()[0]
+            if job_judge != judge:
+                raise ValueError(f"Job {job} of the judge queue is judged by {job_judge}, not by {judge}")
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO contexts (hash, context) VALUES (?, ?)",
+                {(context_hash(task["context"]), task["context"]) for task in tasks},
+            )
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO tasks (job, task_id, subject, predicate, triple_str, context_hash, judge_type, status) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (job, task["task_id"], task["subject"], task["predicate"], task["triple_str"],
+                     context_hash(task["context"]), judge_type, PENDING)
+                    for task in tasks
+                ],
+            )
+            added = self.connection.total_changes - before
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return added
+
+    def claim(self, worker, judge, batch_size = 16, lease_seconds = 600.0, max_attempts = 5):
+        """
+        Lease up to `batch_size` tasks of the jobs of `judge` to `worker`: pending tasks, or leased tasks whose lease
+        expired, in enqueue order.
+        Tasks whose lease expired `max_attempts` times (e.g. a task crashing every worker) are left out, they are
+        reported as failed by `counts` and put back with `requeue_failed`
+
+        Returns:
+            list: task dicts with job, task_id, triple_str, context and judge_type
+        """
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.connection.execute(
+                "SELECT tasks.rowid, tasks.job, task_id, triple_str, judge_type, context FROM tasks "
+                "JOIN contexts ON contexts.hash = tasks.context_hash "
+                "JOIN jobs ON jobs.job = tasks.job "
+                "WHERE jobs.judge = ? AND (status = ? OR (status = ? AND lease_expires < ?)) AND attempts < ? "
+                "ORDER BY tasks.rowid LIMIT ?",
+                (judge, PENDING, LEASED, now, max_attempts, batch_size),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE tasks SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE rowid = ?",
+                [(LEASED, worker, now + lease_seconds, row[0]) for row in rows],
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return [
+            {"job": job, "task_id": task_id, "triple_str": triple_str, "judge_type": judge_type, "context": context}
+            for _, job, task_id, triple_str, judge_type, context in rows
+        ]
+
+    def complete(self, worker, verdicts):
+        """
+        Write the verdicts of (job, task_id, output) tuples, also after the lease expired. The first verdict of a task
+        wins, so a task judged twice (lease expired while it was judged) keeps a single verdict
+
+        Returns:
+            int: number of verdicts written
+        """
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "UPDATE tasks SET status = ?, worker = ?, output = ?, lease_expires = NULL "
+                "WHERE job = ? AND task_id = ? AND status != ?",
+                [(DONE, worker, output, job, task_id, DONE) for job, task_id, output in verdicts],
+            )
+            written = self.connection.total_changes - before
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return written
+
+    def release(self, worker, tasks):
+        """
+        Give the leased tasks back to the queue, e.g. after the judge failed on them. The claim does not count as an
+        attempt, only leases which expired (crashed or killed workers) do
+        """
+        self.connection.executemany(
+            "UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0) "
+            "WHERE job = ? AND task_id = ? AND status = ? AND worker = ?",
+            [(PENDING, task["job"], task["task_id"], LEASED, worker) for task in tasks],
+        )
+
+    def outputs(self, job) -> dict:
+        """
+        Verdicts of a job written so far
+
+        Returns:
+            dict: task id -> judge output
+        """
+        rows = self.connection.execute(
+            "SELECT task_id, output FROM tasks WHERE job = ? AND status = ?", (job, DONE)
+        ).fetchall()
+        return dict(rows)
+
+    def counts(self, max_attempts = 5, job = None, judge = None) -> dict:
+        """
+        Number of tasks (of one job, of the jobs of one judge, or of the whole queue) per state: pending, leased (in
+        flight or expired), done and failed (`max_attempts` expired leases without a verdict)
+        """
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, "failed": 0}
+        rows = self.connection.execute(
+            "SELECT CASE WHEN attempts >= ? AND (status = ? OR (status = ? AND lease_expires < ?)) THEN 'failed' ELSE status END, "
+            "COUNT(*) FROM tasks JOIN jobs ON jobs.job = tasks.job "
+            "WHERE (? IS NULL OR tasks.job = ?) AND (? IS NULL OR jobs.judge = ?) GROUP BY 1",
+            (max_attempts, PENDING, LEASED, time.time(), job, job, judge, judge),
+        ).fetchall()
+        counts.update(dict(rows))
+        return counts
+
+    def requeue_failed(self, max_attempts = 5, job = None):
+        """
+        Put the failed tasks (of one job, or of the whole queue) back as pending with their attempts reset
+
+        Returns:
+            int: number of requeued tasks
+        """
+        before = self.connection.total_changes
+        self.connection.execute(
+            "UPDATE tasks SET status = ?, worker = NULL, lease_expires = NULL, attempts = 0 "
+            "WHERE attempts >= ? AND status != ? AND (status = ? OR lease_expires < ?) AND (? IS NULL OR job = ?)",
+            (PENDING, max_attempts, DONE, PENDING, time.time(), job, job),
+        )
+        return self.connection.total_changes - before
+
+    def judges(self) -> dict:
+        """
+        Judge identity of every job
+        """
+        return dict(self.connection.execute("SELECT job, judge FROM jobs").fetchall())
+
+    def close(self):
+        self.connection.close()
+
+
+def worker(
+        queue_file_path: str,
+        judge_backend: str = "openai",
+        model_name: str = "gpt-4o-mini",
+        judge_prompt_layout: str = "prefix_cache",
+        cross_encoder_model_name: str = "cross-encoder/nli-deberta-v3-small",
+        judge_batch_size: int = None,
+        cascade_strong_model_name: str = "gpt-4o",
+        cascade_confidence_threshold: float = 0.9,
+        cascade_audit_rate: float = 0.0,
+        claim_size: int = 16,
+        lease_seconds: float = 600.0,
+        max_attempts: int = 5,
+        poll_interval: float = 5.0,
+        wait: bool = False,
+        worker_id: str = None,
+):
+    """
+    Judge worker: claims batches of tasks from the queue until it is drained
+
+    Arguments:
+        queue_file_path (str): SQLite queue written by the coordinator
+        judge_backend (str): Judge backend of this worker, see `main.py`
+        model_name (str): LLM of the openai judge backend, cheap LLM of the cascade
+        judge_prompt_layout (str): Either prefix_cache or legacy
+        cross_encoder_model_name (str): NLI cross-encoder of the cross_encoder backend
+        judge_batch_size (int): Number of pairs scored per call by the local judge backends
+        cascade_strong_model_name (str): Strong LLM of the cascade backend
+        cascade_confidence_threshold (float): Escalation threshold of the cascade backend
+        cascade_audit_rate (float): Fraction of the confident cascade verdicts also judged by the strong LLM
+        claim_size (int): Number of tasks leased per claim, at least the batch size of the judge backend
+        lease_seconds (float): Seconds after which the tasks of a claim are handed to another worker, must exceed the time to judge a claim
+        max_attempts (int): Number of claims after which a task is given up
+        poll_interval (float): Seconds between claims while the queue only has tasks leased by other workers
+        wait (bool): Keep polling when the queue is empty, for workers started before the coordinator
+        worker_id (str): Name recorded with the leases and verdicts, by default host:pid
+    """
+    from judge_backend import create_judge_backend
+
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    backend = create_judge_backend(
+        judge_backend,
+        model_name,
+        judge_prompt_layout,
+        cross_encoder_model_name,
+        judge_batch_size,
+        cascade_strong_model_name,
+        cascade_confidence_threshold,
+        cascade_audit_rate,
+    )
+    claim_size = max(claim_size, backend.batch_size)
+    queue = JudgeQueue(queue_file_path)
+    judge = backend.identity
+    logger.info(f"Judge worker {worker_id} ({judge}) polling {queue_file_path} ...")
+    other_judges = set(queue.judges().values()) - {judge}
+    if other_judges:
+        logger.warning(f"The queue also has jobs of other judges {sorted(other_judges)}, they are left to their workers")
+
+    judged = 0
+    try:
+        while True:
+            tasks = queue.claim(worker_id, judge, claim_size, lease_seconds, max_attempts)
+            if not tasks:
+                counts = queue.counts(max_attempts, judge = judge)
+                if counts[PENDING] == 0 and counts[LEASED] == 0 and not wait:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            verdicts = []
+            try:
+                for judge_type in dict.fromkeys(task["judge_type"] for task in tasks):
+                    typed_tasks = [task for task in tasks if task["judge_type"] == judge_type]
+                    outputs = backend.judge_batch([(task["triple_str"], task["context"]) for task in typed_tasks], judge_type)
+                    verdicts += [(task["job"], task["task_id"], output) for task, output in zip(typed_tasks, outputs)]
+            except Exception as e:
+                logger.warning(f"Judge worker {worker_id} failed on a claim of {len(tasks)} tasks ({e}), releasing them ...")
+                queue.release(worker_id, tasks)
+                time.sleep(poll_interval)
+                continue
+
+            written = queue.complete(worker_id, verdicts)
+            judged += written
+            telemetry.inc("queue_verdicts_total", written, worker=worker_id)
+            if written < len(verdicts):
+                logger.info(f"{len(verdicts) - written} verdicts of {worker_id} were already written by another worker")
+    finally:
+        queue.close()
+
+    logger.info(f"Judge worker {worker_id} done, {judged} verdicts written")
+    if backend.summary() is not None:
+        logger.info(backend.summary())
+    return judged
+
+
+def requeue_failed(queue_file_path: str, max_attempts: int = 5, job: str = None):
+    """
+    Give the failed tasks (of `job`, or of every job) to the workers again, returns the number of requeued tasks
+    """
+    queue = JudgeQueue(queue_file_path)
+    try:
+        return queue.requeue_failed(max_attempts, job)
+    finally:
+        queue.close()
+
+
+def status(queue_file_path: str, max_attempts: int = 5):
+    """
+    Number of pending, leased, done and failed tasks of the queue
+    """
+    queue = JudgeQueue(queue_file_path)
+    try:
+        return queue.counts(max_attempts)
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    fire.Fire({"worker": worker, "status": status, "requeue_failed": requeue_failed})
@@ -1,9 +1,16 @@
 import fire
 from request import Request
 from process_request import ProcessRequest
-from wikidata_utils import *
 import os
 from loguru import logger
+from telemetry import telemetry
+from profiler import profiler
+from entity_resolver import EntityResolver, load_wikidata_entities
+from gold_store import GoldStore
+from context_selector import ContextSelector
+from judge_backend import create_judge_backend
+from judge_queue import JudgeQueue
+from canonicalize import deduplicate_triples_dir, write_dedup_counts
 
 def main(
         wikidata_triples_dir:str,
@@ -13,7 +20,28 @@ def main(
         verification_method: str,
         sample_size: int,
         metric: str,
-        results_dir_path:str
+        results_dir_path:str,
+        collect_telemetry: bool = False,
+        wikidata_dump_path: str = None,
+        sparql_endpoint: str = None,
+        search_tier: str = "free",
+        search_max_workers: int = 4,
+        judge_max_workers: int = 4,
+        resume: bool = False,
+        judge_prompt_layout: str = "prefix_cache",
+        context_selection: str = "full",
+        context_top_k: int = 20,
+        context_token_budget: int = None,
+        judge_backend: str = "openai",
+        cross_encoder_model_name: str = "cross-encoder/nli-deberta-v3-small",
+        judge_batch_size: int = None,
+        cascade_strong_model_name: str = "gpt-4o",
+        cascade_confidence_threshold: float = 0.9,
+        cascade_audit_rate: float = 0.0,
+        judge_queue_path: str = None,
+        deduplicate: str = "off",
+        near_duplicate_threshold: float = 0.8,
+        profile: bool = False,
 ):  
     """
     Main function to perform eval on multiple elicited triples with specified parameters
@@ -27,29 +55,67 @@ def main(
         sample_size (int): Size of the random sample. Select -1 if you dont want to sample
         metric (str): Type precision or recall
         results_dir_path (str): Directory path for storing the eval results
+        collect_telemetry (bool): Record request, latency and token metrics and write them as telemetry.json / telemetry.prom into the results dir
+        wikidata_dump_path (str): Optional local Wikidata JSON dump (.json.bz2 / .json.gz), used instead of the web api to build the gold triples
+        sparql_endpoint (str): Optional SPARQL endpoint (e.g. https://query.wikidata.org/sparql, a local mirror or a local RDF file) used to fetch the gold triples in bulk instead of per entity
+        search_tier (str): Brave search subscription tier (free, base or pro), sets the search rate limit for web verification
+        search_max_workers (int): Maximum number of concurrent search requests for web verification
+        judge_max_workers (int): Number of concurrent judge calls consuming search results for web verification
+        resume (bool): Reuse the verdicts checkpointed by a previous (interrupted) run with the same seed instead of judging them again
+        judge_prompt_layout (str): Either prefix_cache (instructions and subject context first, triple last, shares the cached prompt prefix between triples of a subject) or legacy (instructions, triple, context)
+        context_selection (str): Context triples sent with every judged triple for wikidata verification, either full (all triples of the subject), bm25 or embedding (top k most relevant triples)
+        context_top_k (int): Maximum number of context triples kept per judged triple with bm25 / embedding context selection
+        context_token_budget (int): Optional maximum number of (estimated) tokens of the kept context triples
+        judge_backend (str): Either openai (LLM judge `model_name`), cascade (`model_name` judges first, its low confidence verdicts are escalated to `cascade_strong_model_name`), cross_encoder (local CPU NLI model scoring pairs in batches) or rule (deterministic, for tests)
+        cross_encoder_model_name (str): Sentence transformers NLI cross-encoder used by the cross_encoder judge backend
+        judge_batch_size (int): Number of (triple, context) pairs scored per call by the local judge backends
+        cascade_strong_model_name (str): Stronger LLM judging the escalated triples of the cascade judge backend
+        cascade_confidence_threshold (float): Minimum probability of the single token verdict of `model_name` to keep it without escalation
+        cascade_audit_rate (float): Fraction of the confident verdicts also judged by the strong model to measure the agreement (the verdict is kept)
+        judge_queue_path (str): Optional SQLite judge queue for distributed judging (wikidata verification): the judge tasks are enqueued for `judge_queue.py worker` processes instead of judged here, re-run the same command once the queue is drained to write the results
+        deduplicate (str): Either off, exact (collapse canonical duplicates) or near (also cluster near duplicate objects with MinHash / LSH), only representatives are judged and verdicts are weighted by duplicate count
+        near_duplicate_threshold (float): Minimum estimated Jaccard similarity of the objects for near duplicates
+        profile (bool): Profile every stage (wall / CPU time, tracemalloc peak, sampled call stacks) and write folded stacks and top-N reports per stage into the profile dir of the results dir, slows the run down
     
     
     """
-    # path where all wikidata parsed facts will be stored for each entity
+    # path of the legacy single file gold triples, imported into the per-subject gold store if present
     gold_triple_file_path = os.getcwd() + "/gold.json"
+
+    if collect_telemetry:
+        telemetry.enable()
+
+    if profile:
+        profiler.enable()
     
 
+    gold_store = GoldStore()
+    gold_store.import_gold_file(gold_triple_file_path)
+
     # basic sanity check to make sure all entities exist on wikidata
-    with open(wikidata_entities_file_path, 'r') as file:
-        json_content = json.load(file)
-    all_entities = [item for key, values in json_content.items() for item in values]
-    for each_entity in all_entities:
-        if sanity_check_entity(each_entity) == False:
-            print(f"Entity {each_entity} does not exist on wikidata ...")
+    # names are resolved once and persisted, only names never seen before cost a (concurrent) lookup,
+    # with a local dump the entities are matched in the dump and the run stays offline
+    entity_categories, precomputed_qids = load_wikidata_entities(wikidata_entities_file_path)
+    all_entities = [item for key, values in entity_categories.items() for item in values]
+    entity_resolver = EntityResolver()
+    entity_resolver.add_precomputed(precomputed_qids)
+    with telemetry.timer("stage_duration_seconds", stage="sanity_check"), profiler.stage("sanity_check"):
+        entity_qids = gold_store.check_entities(all_entities, entity_resolver, wikidata_dump_path)
+        for each_entity in all_entities:
+            if entity_qids[each_entity] is None:
+                print(f"Entity {each_entity} does not exist on wikidata ...")
             
     
     valid_methods = ["web", "wikidata"]
     if verification_method not in valid_methods:
         raise ValueError(f"Invalid verification method. Choose from {valid_methods}")
 
+    if judge_queue_path is not None and verification_method != "wikidata":
+        raise ValueError("A judge queue is only supported for wikidata verification")
+
     if not os.path.exists(results_dir_path):
         os.makedirs(results_dir_path)
-    
+
     process_request = ProcessRequest(
         model_name, 
         wikidata_triples_dir,
@@ -57,39 +123,76 @@ def main(
         seed, 
         sample_size,
         results_dir_path,
+        gold_store = gold_store,
+        search_tier = search_tier,
+        search_max_workers = search_max_workers,
+        resume = resume,
+        judge_prompt_layout = judge_prompt_layout,
+        context_selector = ContextSelector(context_selection, context_top_k, context_token_budget),
+        judge_backend = create_judge_backend(
+            judge_backend,
+            model_name,
+            judge_prompt_layout,
+            cross_encoder_model_name,
+            judge_batch_size,
+            cascade_strong_model_name,
+            cascade_confidence_threshold,
+            cascade_audit_rate,
+        ),
+        judge_queue = JudgeQueue(judge_queue_path) if judge_queue_path is not None else None,
     )
 
-    ret_triples = process_request.read_triples_dir()
+    with profiler.stage("read_triples"):
+        ret_triples = process_request.read_triples_dir()
+
+    # judge one representative per group of (near) duplicate triples, the counts before / after are kept
+    if deduplicate != "off":
+        with telemetry.timer("stage_duration_seconds", stage="deduplicate"), profiler.stage("deduplicate"):
+            ret_triples, dedup_counts = deduplicate_triples_dir(ret_triples, deduplicate == "near", near_duplicate_threshold)
+        write_dedup_counts(dedup_counts, os.path.join(results_dir_path, "dedup_counts.csv"))
 
     """
-    Check if gold triples pasrsed from wikidata api for each entity exists or not
-    Local persisted copy will improve the runtime
+    Make sure the gold store has the wikidata triples of every subject across all elicited files
+    Only subjects without a persisted shard are fetched, so adding entities costs one fetch per new entity
     """
-    if os.path.isfile(gold_triple_file_path) and os.path.getsize(gold_triple_file_path) > 0:
-        logger.info("Gold triples file exists ..")
-    else:
-        logger.info("Gold triples does not exists, it may take a while to create one ...")
-        # get the data from the first file
-        first_file_data = next(iter(ret_triples.values()))
-        create_gold_triples_file(first_file_data, gold_triple_file_path)
-
-    # need to verify if it works fine with the new changes
+    all_subjects = [each_triple['subject'] for triples_list in ret_triples.values() for each_triple in triples_list]
+    with telemetry.timer("stage_duration_seconds", stage="gold"), profiler.stage("gold"):
+        gold_store.ensure(all_subjects, entity_resolver, wikidata_dump_path, sparql_endpoint)
+
+    # search and judging run as one pipeline, so the total time approaches the slower of the two stages
     if verification_method == "web":
-        ret_triples_with_snippet = process_request.query_snippets(ret_triples)
-        output_dict = process_request.verify_triples(ret_triples_with_snippet)
+        with telemetry.timer("stage_duration_seconds", stage="search_and_judge"), profiler.stage("search_and_judge"):
+            output_dict = process_request.verify_triples_pipelined(ret_triples, judge_workers = judge_max_workers)
         print("Output dictionary recording triple verification ... ", output_dict)
     
 
     if verification_method == "wikidata":
 
-        if metric == "precision":
-            process_request.compute_precision_dir(ret_triples)
-        else:
-            process_request.compute_recall_dir(ret_triples)
+        with telemetry.timer("stage_duration_seconds", stage="judge"), profiler.stage("judge"):
+            if metric == "precision":
+                process_request.compute_precision_dir(ret_triples)
+            else:
+                process_request.compute_recall_dir(ret_triples)
+
+    # the results are only reduced once the workers have judged every queued task
+    if process_request.pending_jobs:
+        logger.info(f"{len(process_request.pending_jobs)} jobs waiting for judge workers on {judge_queue_path} ({process_request.judge_queue.counts()}), re-run once the queue is drained to write the results ...")
+        telemetry.export(results_dir_path)
+        profiler.export(results_dir_path)
+        return
 
-        output_filename = os.path.join(results_dir_path, f"results.csv")    
+    output_filename = os.path.join(results_dir_path, f"results.csv")    
+    with profiler.stage("write_results"):
         process_request.write_to_csv(output_filename, process_request.aggregated_data)
 
+    # per subject / category / predicate breakdowns and bootstrap confidence intervals next to results.csv
+    subject_categories = {entity: category for category, entities in entity_categories.items() for entity in entities}
+    with telemetry.timer("stage_duration_seconds", stage="aggregation"), profiler.stage("aggregation"):
+        process_request.verdict_table.write_tables(results_dir_path, subject_categories)
+
+    telemetry.export(results_dir_path)
+    profiler.export(results_dir_path)
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,68 @@
+import csv
+import hashlib
+import json
+import fire
+from loguru import logger
+from entity_resolver import EntityResolver, load_wikidata_entities
+from gold_store import GoldStore
+
+
+def main(
+        wikidata_entities_file_path: str,
+        wikidata_triples_file_path: str = None,
+        manifest_path: str = None,
+        entity_qids_path: str = None,
+        wikidata_dump_path: str = None,
+        sparql_endpoint: str = None,
+        retry_missing: bool = False,
+):
+    """
+    Resolve the entities (sanity check) and, for an elicited csv file, make sure the gold store has its subjects.
+    Used as standalone stages of the pipeline, `main.py` does the same before judging
+
+    Arguments:
+        wikidata_entities_file_path (str): File path storing the manually curated wikidata entity files
+        wikidata_triples_file_path (str): Optional elicited csv file whose subjects are fetched into the gold store
+        manifest_path (str): Optional JSON file written with a content hash of the gold triples of every subject of the csv file
+        entity_qids_path (str): Optional JSON file written with the resolved QID of every entity of the entities file
+        wikidata_dump_path (str): Optional local Wikidata JSON dump used instead of the web api
+        sparql_endpoint (str): Optional SPARQL endpoint url (or local RDF file) to fetch the subjects in bulk
+        retry_missing (bool): Look up again the entities and subjects which were not found on wikidata before
+    """
+    entity_categories, precomputed_qids = load_wikidata_entities(wikidata_entities_file_path)
+    all_entities = [item for key, values in entity_categories.items() for item in values]
+    entity_resolver = EntityResolver()
+    entity_resolver.add_precomputed(precomputed_qids)
+    gold_store = GoldStore()
+    # with a local dump the entities are matched in the dump, no web api call
+    entity_qids = gold_store.check_entities(all_entities, entity_resolver, wikidata_dump_path, retry_missing)
+    for each_entity in all_entities:
+        if entity_qids[each_entity] is None:
+            print(f"Entity {each_entity} does not exist on wikidata ...")
+
+    if entity_qids_path is not None:
+        with open(entity_qids_path, "w") as f:
+            json.dump(entity_qids, f, indent=4, sort_keys=True, ensure_ascii=False)
+
+    if wikidata_triples_file_path is None:
+        return
+
+    with open(wikidata_triples_file_path, mode='r', newline='', encoding='utf-8') as f:
+        subjects = list(dict.fromkeys(row['subject'] for row in csv.DictReader(f)))
+
+    gold_store.ensure(subjects, entity_resolver, wikidata_dump_path, sparql_endpoint, retry_missing)
+
+    if manifest_path is not None:
+        # the gold version of the csv file, changes whenever the gold triples of one of its subjects change
+        manifest = {}
+        for subject in subjects:
+            record = gold_store.get_record(subject)
+            triples = record["triples"] if record is not None else None
+            manifest[subject] = hashlib.sha1(json.dumps(triples, sort_keys=True).encode("utf-8")).hexdigest()
+        with open(manifest_path, "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True, ensure_ascii=False)
+        logger.info(f"Gold manifest of {len(manifest)} subjects written to {manifest_path} ...")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
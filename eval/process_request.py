@@ -1,18 +1,25 @@
 import os
 import time
 import sys
-import pickle
 import random
 from openai import OpenAI
 import json
 import pandas as pd
-import requests
 from loguru import logger
 import csv
+import hashlib
 from tqdm import tqdm
 
-from request import Request
-from wikidata_utils import *
+from wikidata_utils import http_get
+from telemetry import telemetry
+from profiler import profiler
+from gold_store import GoldStore
+from snippet_retrieval import SnippetCache, SnippetRetriever, BRAVE_TIERS
+from verification_pipeline import JsonlResultsSink, WebVerificationPipeline
+from checkpoint import CheckpointWriter, read_checkpoint
+from aggregation import VerdictTable
+from context_selector import ContextSelector
+from judge_backend import OpenAIJudgeBackend
 
 class ProcessRequest:
     def __init__(self, 
@@ -22,18 +29,39 @@ class ProcessRequest:
                 seed, 
                 sample_size,
                 results_dir_path,
+                gold_store = None,
+                search_tier = "free",
+                search_max_workers = 4,
+                resume = False,
+                judge_prompt_layout = "prefix_cache",
+                context_selector = None,
+                judge_backend = None,
+                judge_queue = None,
         ):
 
 
         self.client = OpenAI()
 
         # directory to store the snippets downloaded from the search query
-        self.snippet_dir = os.getcwd() + "snippets/"
+        self.snippet_dir = os.getcwd() + "/snippets/"
+
+        # searches are deduplicated, cached across runs and rate limited to the brave subscription tier
+        self.snippet_cache = SnippetCache(os.path.join(self.snippet_dir, "snippets.sqlite"))
+        self.snippet_retriever = SnippetRetriever(
+            self.get_brave_results,
+            self.snippet_cache,
+            rate = BRAVE_TIERS[search_tier]["rate"],
+            burst = BRAVE_TIERS[search_tier]["burst"],
+            max_workers = search_max_workers,
+        )
         self.wikidata_triples_dir = wikidata_triples_dir
         self.wikidata_entities_file_path = wikidata_entities_file_path
 
-        # file location that stores the gold triples from wikidata
+        # file location of the legacy single file gold triples from wikidata
         self.gold_triples_file_path = os.getcwd() + "/gold.json"
+
+        # per-subject store of the gold triples from wikidata
+        self.gold_store = gold_store if gold_store is not None else GoldStore()
         self.seed = seed
         self.model_name = model_name
 
@@ -43,6 +71,27 @@ class ProcessRequest:
         self.results_dir_path = results_dir_path
         self.aggregated_data = []
 
+        # integer coded record of every verdict, used for the per subject / category / predicate breakdowns
+        self.verdict_table = VerdictTable()
+
+        # verdicts are checkpointed per (file, metric, seed), with resume the checkpointed verdicts are reused
+        self.checkpoint_dir = os.path.join(results_dir_path, "checkpoints")
+        self.resume = resume
+
+        # order of instructions, context and triple in the judge prompt, see `Request`
+        self.judge_prompt_layout = judge_prompt_layout
+
+        # selects the context triples sent along with every judged triple, by default the full context
+        self.context_selector = context_selector if context_selector is not None else ContextSelector()
+
+        # backend answering the judge prompts, by default the OpenAI chat judge
+        self.judge_backend = judge_backend if judge_backend is not None else OpenAIJudgeBackend(model_name, judge_prompt_layout)
+
+        # with a `JudgeQueue` the tasks are enqueued for distributed workers instead of judged here, jobs of the
+        # queue with verdicts still missing are recorded and left out of the results
+        self.judge_queue = judge_queue
+        self.pending_jobs = []
+
 
     def verify_triples(self, raw_triples):
 
@@ -50,8 +99,6 @@ class ProcessRequest:
         Process raw triples, verify from language model, as to which of the four categories the response falls into
         
         """
-        request = Request(self.model_name)
-
         # this dict just stores results which fall into either of categories (a, b, c, d) --> see content in verify_triples, Request class
         results = {"a":[], "b":[], "c":[], "d":[], "noSnippet": []}
         for each_triple in raw_triples:
@@ -64,7 +111,7 @@ class ProcessRequest:
                     snippet_str += each_snippet
                     snippet_str += " | "
                 
-                output = request.verify_triple_language_model(each_triple_str, snippet_str)
+                output = self.judge_backend.judge(each_triple_str, snippet_str, "snippet")
                 #print('output ...', output)
                 results = self.parse_lm_output(each_triple, results, output)
             
@@ -74,6 +121,85 @@ class ProcessRequest:
         return results
             
 
+    def verify_triples_pipelined(self, raw_triples, judge_workers = 4, queue_size = 64):
+        """
+        Web verification where search and judging overlap: search workers feed snippets straight to judge workers,
+        and every verdict is appended to `web_verdicts_<seed>_<backend>_<hash>.jsonl` in the results dir (keyed like
+        the checkpoints, started from scratch unless resuming) as soon as it is available.
+        Per file fractions are added to `self.aggregated_data`. Triples without snippets or whose judge call failed
+        are retrieval / api failures, not verdicts: they are counted apart and left out of the fractions.
+
+        Parameters:
+            raw_triples (dict): Dictionary where keys are filenames and values are lists of rows from CSVs.
+        """
+        tasks = []
+        for filename, triples_list in raw_triples.items():
+            # Apply sampling if enabled
+            if self.sampling:
+                triples_list = self.sample_triples(triples_list, filename, "web")
+            for each_triple in triples_list:
+                tasks.append({
+                    "filename": filename,
+                    "triple": each_triple,
+                    "triple_str": f"({each_triple['subject'].replace('_', ' ')}, {each_triple['predicate'].replace('_', ' ')}, {each_triple['object'].replace('_', ' ')})",
+                    "query": self.snippet_query(each_triple),
+                })
+
+        verdicts_file_path = os.path.join(
+            self.results_dir_path, f"web_verdicts_{self.seed}_{self.judge_backend.name}_{self.judge_settings_hash()}.jsonl"
+        )
+        results_sink = JsonlResultsSink(verdicts_file_path, resume = self.resume)
+        pipeline = WebVerificationPipeline(
+            self.snippet_retriever,
+            lambda triple_str, snippet_str: self.judge_backend.judge(triple_str, snippet_str, "snippet"),
+            results_sink,
+            search_workers = self.snippet_retriever.max_workers,
+            judge_workers = judge_workers,
+            queue_size = queue_size,
+        )
+        try:
+            pipeline.run(tasks)
+        finally:
+            results_sink.close()
+
+        # tally the verdicts of this run per file
+        verdict_counts = {filename: {"a": 0, "b": 0, "c": 0, "d": 0, "total": 0, "noSnippet": 0, "error": 0} for filename in raw_triples}
+        for task in tasks:
+            # deduplicated triples stand for `duplicate_count` elicited triples
+            weight = self.triple_weight(task["triple"])
+            if task.get("verdict") in ("noSnippet", "error"):
+                verdict_counts[task["filename"]][task["verdict"]] += weight
+                continue
+            verdict_counts[task["filename"]]["total"] += weight
+            if task.get("verdict") in ("a", "b", "c", "d"):
+                verdict_counts[task["filename"]][task["verdict"]] += weight
+                self.verdict_table.add(
+                    task["filename"], "web", task["triple"]["subject"], task["triple"]["predicate"], task.get("output"),
+                    task["triple"].get("subject_name"), weight,
+                )
+
+        for filename, counts in verdict_counts.items():
+            total_triples = counts["total"]
+            if counts["noSnippet"] or counts["error"]:
+                logger.warning(f"Web precision of {filename}: {counts['noSnippet']} triples without snippets and {counts['error']} failed judge calls are not counted")
+            if total_triples == 0:
+                continue
+            self.aggregated_data.append({
+                "True": counts["a"] / total_triples,
+                "Plausible": counts["b"] / total_triples,
+                "Implausible": counts["c"] / total_triples,
+                "False": counts["d"] / total_triples,
+                "Total #Triples": total_triples,
+                "Metric": "Web Precision",
+                "Source Elicited File": str(filename),
+                "Source Prompt File": self.read_parse_jinja_file(filename),
+                "No Snippet #Triples": counts["noSnippet"],
+                "Judge Error #Triples": counts["error"],
+            })
+
+        logger.info(f"Web verdicts written to {verdicts_file_path}")
+        return verdict_counts
+
     def parse_lm_output(self, current_triple, results, output):
         """
         Parse the lm output to decide, true, plausible, false for the current triple
@@ -123,34 +249,17 @@ class ProcessRequest:
         print("Unique Subjects:", unique_subjects)
 
 
-    def query_snippets(self, data_triples):
+    def snippet_query(self, each_triple):
         """
-        Process raw triples, make the query to the search engine and get the snippets
-        Wait for 2 seconds before making a new query (using free subscription for now that it requires min 1 sec wait time)
+        Search term used to find snippets for a triple
         """
-        for each_triple in data_triples:
-            returned_snippet = self.get_brave_results(each_triple['subject'].replace("_", " ") + " " + each_triple['object'].replace("_", " "))
-            # get the snippet returned by api search call and add a new key to the triple dict
-            each_triple['snippet'] = returned_snippet
-            time.sleep(2)
-
-        if not os.path.exists(self.snippet_dir):
-            os.makedirs(self.snippet_dir)
-            print(f"Directory created: {self.snippet_dir}")
-        else:
-            print(f"Directory already exists: {self.snippet_dir}")
-
-        file_path = os.path.join(self.snippet_dir, f"{self.seed}.pkl")
-
-        with open(file_path, "wb") as f:
-            pickle.dump(data_triples, f)
-        
-        return data_triples
+        return each_triple['subject'].replace("_", " ") + " " + each_triple['object'].replace("_", " ")
 
     def get_brave_results(self, search_term):
         
         """
         Hit the brave web search API given a search term, get the response and return the snippets
+        Returns None if the request failed (e.g. rate limited), so that the failure is not cached
         """
 
         logger.info(f"Processing the search query .. {search_term}")
@@ -164,13 +273,16 @@ class ProcessRequest:
         params = {
             "q": search_term,
         }
-        response = requests.get(url, headers = headers, params = params)
+        response = http_get(url, headers = headers, params = params)
+        if response.status_code != 200:
+            logger.info(f"Search request failed. HTTP Status Code: {response.status_code}")
+            return None
         data = response.json()
 
-        # dict_keys(['query', 'mixed', 'type', 'web'])
+        # dict_keys(['query', 'mixed', 'type', 'web']), 'web' is left out when there are no results
         snippets = []
         try:
-            for item in data['web']['results'][:5]:
+            for item in data.get('web', {}).get('results', [])[:5]:
                 snippets.append(item['description'])
         except Exception as e:
             print(e)
@@ -187,52 +299,58 @@ class ProcessRequest:
         Parameters:
             raw_triples (dict): Dictionary where keys are filenames and values are lists of rows from CSVs.
         """
-        request = Request(self.model_name)
-
         # Iterate through each file in raw_triples
         for filename, triples_list in raw_triples.items():
             print(f"Processing file: {filename}")
-            results = {"a": [], "b": [], "c": [], "d": []}  # Reset results for each file
 
-            # Apply sampling if enabled
+            # Apply sampling if enabled, the sample only depends on the seed so a resumed run judges the same triples
             if self.sampling:
-                triples_list = random.sample(triples_list, self.sample_size)
+                triples_list = self.sample_triples(triples_list, filename, "precision")
+
+            # Build one judge task per triple in the current file
+            tasks = []
+            for index, each_triple in enumerate(triples_list):
+                # Get gold Wikidata triples for the current subject
+                wikidata_triples_curr_subject = self.gold_store.get(each_triple['subject'])
 
-            # Process each triple in the current file
-            for each_triple in tqdm(triples_list, desc=f"Computing Precision for {filename}"):
-                # Read gold Wikidata triples
-                wikidata_triples = self.read_gold_triples_file()
+                # Convert the current triple to string
+                each_triple_str = f"({each_triple['subject'].replace('_', ' ')}, " \
+                                f"{each_triple['predicate'].replace('_', ' ')}, " \
+                                f"{each_triple['object'].replace('_', ' ')})"
 
-                # Get triples for the current subject
-                wikidata_triples_curr_subject = wikidata_triples.get(each_triple['subject'], [])
+                # Keep the gold triples relevant to the current triple (all of them unless context selection is enabled)
+                selected_indices = self.context_selector.select(
+                    each_triple['subject'],
+                    each_triple_str,
+                    [f"{each_subj_triple['subject']} {each_subj_triple['predicate']} {each_subj_triple['object']}"
+                     for each_subj_triple in wikidata_triples_curr_subject],
+                )
                 wikidata_triples_curr_subject_str = ' '
-                for each_subj_triple in wikidata_triples_curr_subject:
+                for gold_index in selected_indices:
+                    each_subj_triple = wikidata_triples_curr_subject[gold_index]
                     wikidata_triples_curr_subject_str += (
                         '(' + each_subj_triple['subject'] +
                         each_subj_triple['predicate'] +
                         each_subj_triple['object'] + '),'
                     )
 
-                # Convert the current triple to string
-                each_triple_str = f"({each_triple['subject'].replace('_', ' ')}, " \
-                                f"{each_triple['predicate'].replace('_', ' ')}, " \
-                                f"{each_triple['object'].replace('_', ' ')})"
-
-                # Ask the LLM to verify the triple
-                output = request.verify_triple_lm_wikidata(each_triple_str, wikidata_triples_curr_subject_str)
+                tasks.append(self.make_judge_task(index, each_triple['subject'], each_triple['predicate'], each_triple_str, wikidata_triples_curr_subject_str, self.triple_weight(each_triple), each_triple.get('subject_name')))
 
-                # Parse and store the results
-                results = self.parse_lm_output(each_triple_str, results, output)
+            # Ask the LLM to verify the triples
+            with profiler.stage("judge_tasks"):
+                results = self.judge_tasks(tasks, filename, "precision")
+            if results is None:
+                continue
 
-            # Aggregate results for the current file
-            total_triples = len(triples_list)
+            # Aggregate results for the current file, weighted back to the elicited triples if they were deduplicated
+            total_triples = sum(task["weight"] for task in tasks)
 
 
             results_dict = {
-                "True": len(results['a']) / total_triples,
-                "Plausible": len(results['b']) / total_triples,
-                "Implausible": len(results['c']) / total_triples,
-                "False": len(results['d']) / total_triples,
+                "True": results['a'] / total_triples,
+                "Plausible": results['b'] / total_triples,
+                "Implausible": results['c'] / total_triples,
+                "False": results['d'] / total_triples,
                 "Total #Triples": total_triples,
                 "Metric": "Precision",
                 "Source Elicited File": str(filename),
@@ -242,6 +360,155 @@ class ProcessRequest:
             self.aggregated_data.append(results_dict)
 
 
+    def sample_triples(self, triples_list, filename, metric):
+        """
+        Random sample of `self.sample_size` triples, deterministic given the seed, the file and the metric
+        """
+        rng = random.Random(f"{self.seed}:{filename}:{metric}")
+        return rng.sample(triples_list, self.sample_size)
+
+    @staticmethod
+    def triple_weight(triple):
+        """
+        Number of elicited triples a triple stands for, more than one for the representatives of deduplicated duplicates
+        """
+        return int(triple.get("duplicate_count") or 1)
+
+    def make_judge_task(self, index, subject, predicate, triple_str, context, weight = 1, subject_name = None):
+        """
+        A single LLM judgement, the task id is stable across runs for the same (deterministic) sample.
+        `subject_name` is the entity the triple was elicited for, the key of its category
+        """
+        triple_hash = hashlib.sha1(triple_str.encode("utf-8")).hexdigest()[:12]
+        return {
+            "task_id": f"{index}:{triple_hash}",
+            "subject": subject,
+            "predicate": predicate,
+            "triple_str": triple_str,
+            "context": context,
+            "weight": weight,
+            "subject_name": subject_name,
+        }
+
+    def judge_settings_hash(self):
+        """
+        Short hash of everything a verdict depends on besides the triple: the judge backend and its settings (model,
+        prompt layout, ...) and the context selection producing the judged context
+        """
+        judge_settings = f"{self.judge_backend.identity}|{self.context_selector.identity}"
+        return hashlib.sha1(judge_settings.encode("utf-8")).hexdigest()[:8]
+
+    def checkpoint_path(self, filename, metric):
+        # verdicts of other judges or context settings are never resumed from each other
+        return os.path.join(self.checkpoint_dir, f"{filename}_{metric}_{self.seed}_{self.judge_backend.name}_{self.judge_settings_hash()}.jsonl")
+
+    def enqueue_tasks(self, tasks, filename, metric):
+        """
+        Add the tasks of (file, metric, seed, judge) to the judge queue, tasks already queued by a previous run are kept.
+        The job is judged by workers with the same judge backend and settings as this process
+
+        Returns:
+            dict or None: the verdict counts (see `judge_tasks`) once the workers judged every task, None before
+        """
+        judge = self.judge_backend.identity
+        # the context selection is part of the job, the queue keeps the context of the tasks it was first given
+        job = f"{filename}_{metric}_{self.seed}_{self.judge_settings_hash()}"
+        added = self.judge_queue.enqueue(job, self.subject_ordered(tasks), judge)
+        outputs = self.judge_queue.outputs(job)
+        missing = sum(task["task_id"] not in outputs for task in tasks)
+        if missing > 0:
+            logger.info(f"Queued {metric} for {filename}: {added} tasks added, {missing} of {len(tasks)} verdicts pending for workers of {judge} ...")
+            failed = self.judge_queue.counts(job = job)["failed"]
+            if failed > 0:
+                logger.warning(f"{failed} tasks of {job} failed on every attempt, put them back with `python judge_queue.py requeue_failed {self.judge_queue.queue_file_path} --job {job}`")
+            self.pending_jobs.append(job)
+            return None
+
+        completed = {}
+        for task in tasks:
+            completed[task["task_id"]] = {"output": outputs[task["task_id"]]}
+            telemetry.inc("verdicts_total", metric=metric, file=filename, verdict=outputs[task["task_id"]][:1])
+        return self.count_verdicts(tasks, completed, filename, metric)
+
+    @staticmethod
+    def subject_ordered(tasks):
+        """
+        Tasks of one subject back to back, they share the prompt prefix (instructions and subject context)
+        """
+        subject_order = {}
+        for task in tasks:
+            subject_order.setdefault(task["subject"], len(subject_order))
+        return sorted(tasks, key=lambda task: subject_order[task["subject"]])
+
+    def judge_tasks(self, tasks, filename, metric):
+        """
+        Ask the judge backend to judge every task against its context, in batches of the backend's batch size.
+        Every verdict is appended to the checkpoint of (file, metric, seed) as soon as it arrives; when resuming,
+        tasks found in the checkpoint are not judged again.
+
+        Returns:
+            dict: option (a, b, c, d) -> number of triples judged with that option, weighted by the task weights,
+                None for tasks handed to the judge queue which are not judged yet
+        """
+        if self.judge_queue is not None:
+            return self.enqueue_tasks(tasks, filename, metric)
+
+        checkpoint_file_path = self.checkpoint_path(filename, metric)
+        completed = read_checkpoint(checkpoint_file_path) if self.resume else {}
+        pending_tasks = [task for task in tasks if task["task_id"] not in completed]
+        if len(pending_tasks) < len(tasks):
+            logger.info(f"Resuming {metric} for {filename}: {len(tasks) - len(pending_tasks)} of {len(tasks)} triples already judged ...")
+
+        pending_tasks = self.subject_ordered(pending_tasks)
+
+        judge_backend = self.judge_backend
+        batch_size = max(1, judge_backend.batch_size)
+        prompt_tokens, cached_tokens = judge_backend.prompt_tokens, judge_backend.cached_tokens
+        judge_snapshot = judge_backend.snapshot()
+        with CheckpointWriter(checkpoint_file_path, resume = self.resume) as checkpoint, \
+                tqdm(total=len(pending_tasks), desc=f"Computing {metric.capitalize()} for {filename}") as progress_bar:
+            for start in range(0, len(pending_tasks), batch_size):
+                batch = pending_tasks[start:start + batch_size]
+                outputs = judge_backend.judge_batch([(task["triple_str"], task["context"]) for task in batch], "wikidata")
+                for task, output in zip(batch, outputs):
+                    record = {
+                        "task_id": task["task_id"],
+                        "subject": task["subject"],
+                        "predicate": task["predicate"],
+                        "triple_str": task["triple_str"],
+                        "output": output,
+                    }
+                    checkpoint.write(record)
+                    completed[task["task_id"]] = record
+                    telemetry.inc("verdicts_total", metric=metric, file=filename, verdict=output[:1])
+                progress_bar.update(len(batch))
+
+        prompt_tokens = judge_backend.prompt_tokens - prompt_tokens
+        cached_tokens = judge_backend.cached_tokens - cached_tokens
+        if prompt_tokens > 0:
+            logger.info(f"{metric.capitalize()} for {filename}: {cached_tokens} of {prompt_tokens} prompt tokens served from the prompt cache ({cached_tokens / prompt_tokens:.1%})")
+        judge_summary = judge_backend.summary(since = judge_snapshot)
+        if judge_summary is not None:
+            logger.info(f"{metric.capitalize()} for {filename}: {judge_summary}")
+
+        return self.count_verdicts(tasks, completed, filename, metric)
+
+    def count_verdicts(self, tasks, completed, filename, metric):
+        """
+        Weighted verdict counts of the tasks from their judged records (task id -> record with the output)
+        """
+        # Count the verdicts and record them for the breakdown tables
+        results = {"a": 0, "b": 0, "c": 0, "d": 0}
+        for task in tasks:
+            output = completed[task["task_id"]]["output"]
+            if output[:1] in results:
+                results[output[:1]] += task["weight"]
+            else:
+                logger.info('Results fall into some other category ...')
+            self.verdict_table.add(filename, metric, task["subject"], task["predicate"], output, task.get("subject_name"), task["weight"])
+
+        return results
+
     def subject_based_lookup(self, current_subject, data_triples):
 
         """
@@ -256,48 +523,22 @@ class ProcessRequest:
         
         return subject_list_triple
 
-    def entity_based_stats(self, raw_triples, results):
+    def entity_based_stats(self):
 
         """
-        Process some entity wise statistics
+        Process some entity wise statistics from the recorded verdicts
         """
 
-        # dict for recording subject to count of a,b,c ... (true, plausible, implausible, false) etc
-        subject_to_key_counts = {}
-
-        for key, triples in results.items():
-            for triple in triples:
-                
-                triple_split = triple.strip("()").split(", ")
-                if len(triple_split) != 3:
-                    print(f"Skipping invalid triple: {triple}")
-                    continue
+        if len(self.verdict_table) == 0:
+            return
 
-                subject,b,c = triple_split
-                
-                # Initialize nested dictionary for the subject if it doesn't exist
-                if subject not in subject_to_key_counts:
-                    subject_to_key_counts[subject] = {}
-                
-                # Increment the count for the current key
-                if key not in subject_to_key_counts[subject]:
-                    subject_to_key_counts[subject][key] = 0
-                subject_to_key_counts[subject][key] += 1
-
-        print(subject_to_key_counts)
-        subjects_true_or_plausible = []
-        subjects_false_or_implausible = []
-
-        for subject, freq_count in subject_to_key_counts.items():
-            if "a" not in freq_count and "b" not in freq_count:
-                if "c" in freq_count or "d" in freq_count:
-                    subjects_false_or_implausible.append(subject)
-            
+        # per subject fraction of true or plausible (a, b) and implausible or false (c, d) verdicts
+        subject_stats = VerdictTable.summarize(self.verdict_table.to_frame(), ["subject"])
+        true_or_plausible = subject_stats["True"] + subject_stats["Plausible"]
+        false_or_implausible = subject_stats["Implausible"] + subject_stats["False"]
 
-            if "a" in freq_count or "b" in freq_count:
-                if "c" not in freq_count and "d" not in freq_count:
-                    subjects_true_or_plausible.append(subject)
-        
+        subjects_true_or_plausible = subject_stats.loc[(true_or_plausible > 0) & (false_or_implausible == 0), "subject"].tolist()
+        subjects_false_or_implausible = subject_stats.loc[(true_or_plausible == 0) & (false_or_implausible > 0), "subject"].tolist()
 
         print("Subjects true or plausible ...", subjects_true_or_plausible)
         print("count subjects true or plausible ..", len(subjects_true_or_plausible))
@@ -307,16 +548,17 @@ class ProcessRequest:
 
 
     def read_gold_triples_file(self):
-
-        with open(self.gold_triples_file_path, "r") as json_file:
-            wikidata_triples = json.load(json_file)
-        
-        return wikidata_triples
+        """
+        Return all gold triples as a dict subject -> list of triples, same structure as the legacy gold.json
+        """
+        return self.gold_store.as_dict()
 
 
     def write_to_csv(self, filename, data):
 
-        headers = ['True', 'Plausible', 'Implausible', 'False', 'Total #Triples', "Metric", "Source Elicited File", "Source Prompt File"]
+        # the web precision rows also report the triples left out of the fractions (no snippets, failed judge calls)
+        headers = ['True', 'Plausible', 'Implausible', 'False', 'Total #Triples', "Metric", "Source Elicited File", "Source Prompt File",
+                   "No Snippet #Triples", "Judge Error #Triples"]
 
 
         with open(filename, mode = 'w', newline = "") as file:
@@ -351,26 +593,25 @@ class ProcessRequest:
         Parameters:
             raw_triples (dict): Dictionary where keys are filenames and values are lists of rows from CSVs.
         """
-        request = Request(self.model_name)
-
         # Iterate through each file in raw_triples
         for filename, triples_list in raw_triples.items():
             print(f"Processing file: {filename}")
             fact_count = dict()
-            results = {"a": [], "b": [], "c": [], "d": []}
 
             # Dict for recording Wikidata facts per subject
             wikidata_facts_per_subject = dict()
 
-            # Build fact count and Wikidata facts per subject
+            # Build fact count and Wikidata facts per subject, and the entity each subject was elicited for
+            subject_names = dict()
             for each_triple in triples_list:
+                subject_names.setdefault(each_triple['subject'], each_triple.get('subject_name'))
+                # deduplicated triples stand for `duplicate_count` elicited facts
                 if each_triple['subject'] in fact_count:
-                    fact_count[each_triple['subject']] += 1
+                    fact_count[each_triple['subject']] += self.triple_weight(each_triple)
                 else:
-                    fact_count[each_triple['subject']] = 1
-                    wikidata_triples = self.read_gold_triples_file()
-                    if each_triple['subject'] in wikidata_triples:
-                        wikidata_facts_per_subject[each_triple['subject']] = wikidata_triples[each_triple['subject']]
+                    fact_count[each_triple['subject']] = self.triple_weight(each_triple)
+                    if self.gold_store.has(each_triple['subject']):
+                        wikidata_facts_per_subject[each_triple['subject']] = self.gold_store.get(each_triple['subject'])
 
             print('Yield ...')
             total_facts = sum(fact_count.values())
@@ -382,15 +623,21 @@ class ProcessRequest:
 
             # Apply sampling if enabled
             if self.sampling:
-                all_wikidata_facts = random.sample(all_wikidata_facts, self.sample_size)
+                all_wikidata_facts = self.sample_triples(all_wikidata_facts, filename, "recall")
 
-            # Process each Wikidata fact
-            for each_wikidata_fact in tqdm(all_wikidata_facts, desc=f"Computing Recall for {filename}"):
+            # Build one judge task per Wikidata fact
+            tasks = []
+            for index, each_wikidata_fact in enumerate(all_wikidata_facts):
                 subject_based_facts = self.subject_based_lookup(each_wikidata_fact['subject'], triples_list)
-                subject_based_facts_str = ", ".join(subject_based_facts)
                 each_triple_str = f"({each_wikidata_fact['subject']}, {each_wikidata_fact['predicate']}, {each_wikidata_fact['object']})"
-                output = request.verify_triple_lm_wikidata(each_triple_str, subject_based_facts_str)
-                results = self.parse_lm_output(each_triple_str, results, output)
+                selected_indices = self.context_selector.select(each_wikidata_fact['subject'], each_triple_str, subject_based_facts)
+                subject_based_facts_str = ", ".join(subject_based_facts[fact_index] for fact_index in selected_indices)
+                tasks.append(self.make_judge_task(index, each_wikidata_fact['subject'], each_wikidata_fact['predicate'], each_triple_str, subject_based_facts_str, subject_name = subject_names.get(each_wikidata_fact['subject'])))
+
+            with profiler.stage("judge_tasks"):
+                results = self.judge_tasks(tasks, filename, "recall")
+            if results is None:
+                continue
 
             """
             print("Recall results ....")
@@ -403,10 +650,10 @@ class ProcessRequest:
             """
 
             results_dict = {
-                "True": len(results['a']) / len(all_wikidata_facts),
-                "Plausible": len(results['b']) / len(all_wikidata_facts),
-                "Implausible": len(results['c']) / len(all_wikidata_facts),
-                "False": len(results['d']) / len(all_wikidata_facts),
+                "True": results['a'] / len(all_wikidata_facts),
+                "Plausible": results['b'] / len(all_wikidata_facts),
+                "Implausible": results['c'] / len(all_wikidata_facts),
+                "False": results['d'] / len(all_wikidata_facts),
                 "Total #Triples": len(all_wikidata_facts),
                 "Metric": "Recall",
                 "Source Elicited File": str(filename),
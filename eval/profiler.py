@@ -0,0 +1 @@
+../common/profiler.py
\ No newline at end of file
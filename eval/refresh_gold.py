@@ -0,0 +1,22 @@
+import fire
+from loguru import logger
+from entity_resolver import EntityResolver
+from gold_store import GoldStore
+
+
+def main(gold_dir_path: str = None, batch_size: int = 50, sparql_endpoint: str = None):
+    """
+    Refresh the persisted gold triples, only entities edited on wikidata since they were fetched are refetched
+
+    Arguments:
+        gold_dir_path (str): Directory of the gold store (default is `gold/` in the current directory)
+        batch_size (int): Number of entities per revision lookup request (max 50 for anonymous clients)
+        sparql_endpoint (str): Optional SPARQL endpoint url (or local RDF file) used to refetch the changed entities in bulk
+    """
+    gold_store = GoldStore(gold_dir_path)
+    refreshed_subjects = gold_store.refresh(EntityResolver(), batch_size, sparql_endpoint)
+    logger.info(f"Refreshed {len(refreshed_subjects)} gold subjects: {refreshed_subjects}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
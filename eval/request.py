@@ -1,24 +1,63 @@
 from openai import OpenAI
 import json
+import math
+from telemetry import telemetry
+
+# judge prompt layouts: `prefix_cache` puts the instructions and the (per subject) context first and the triple
+# last, so that consecutive judgements of one subject share a long prompt prefix which the api can serve from
+# its prompt cache; `legacy` is the original instructions, triple, context order
+JUDGE_PROMPT_LAYOUTS = ("prefix_cache", "legacy")
+
+JUDGE_OPTIONS = ("a", "b", "c", "d")
 
 class Request:
-    def __init__(self, model_name: str = "gpt-4o-mini", max_tokens = 3000):
+    def __init__(self, model_name: str = "gpt-4o-mini", max_tokens = 3000, prompt_layout = "prefix_cache"):
+        if prompt_layout not in JUDGE_PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown judge prompt layout {prompt_layout}, expected one of {JUDGE_PROMPT_LAYOUTS}")
         self.model_name = model_name
         self.max_tokens = max_tokens
+        self.prompt_layout = prompt_layout
         self.client = OpenAI() 
 
-    def verify_triple_lm_snippet(self, triple, snippet):
+        # usage object of the most recent response, kept so that callers can inspect token counts
+        self.last_usage = None
+
+        # running prompt token counts, used to report the prompt cache hit rate
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def _create_completion(self, messages, judge_type, max_tokens = None, **kwargs):
         """
+        Send the messages to the chat completions endpoint, recording latency and token usage
+        """
+        with telemetry.timer("judge_latency_seconds", model=self.model_name, judge_type=judge_type):
+            response = self.client.chat.completions.create(
+                messages = messages,
+                model = self.model_name,
+                max_tokens = max_tokens or self.max_tokens,
+                temperature=0.0,
+                **kwargs,
+            )
 
-        Get the facts and web parsed snippet, and ask LLM as a judge if the fact
-        entails or is plausible
+        self.last_usage = response.usage
+        if response.usage is not None:
+            self.prompt_tokens += response.usage.prompt_tokens or 0
+            prompt_details = getattr(response.usage, "prompt_tokens_details", None)
+            self.cached_tokens += getattr(prompt_details, "cached_tokens", None) or 0
+        telemetry.inc("judge_requests_total", model=self.model_name, judge_type=judge_type)
+        telemetry.record_usage(response.usage, model=self.model_name, stage="judge")
+        return response
 
+    def cache_hit_rate(self):
+        """
+        Fraction of the prompt tokens sent so far which were served from the prompt cache
         """
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
 
+    def snippet_messages(self, triple, snippet):
         triple_prompt_str = f"Statement to verify: {triple}."
         snippet_prompt_str = f"Snippet to verify from: {snippet}"
-        response = self.client.chat.completions.create(
-            messages=[
+        messages = [
                 {"role": "user",
                     "content": "Can the given RDF be inferred from the given snippet? \
                                 Please choose the correct option based on your answer and return only a or b or c or d: \
@@ -28,22 +67,21 @@ class Request:
                                 d) The RDF statement is false according to the snippet."},
                 {"role": "user", "content": triple_prompt_str},
                 {"role": "user", "content": snippet_prompt_str},
-            ],
-            model = self.model_name,
-            max_tokens = self.max_tokens,
-            temperature=0.0,
-        )
-        return response.choices[0].message.content
-    
+            ]
+        return messages
 
-    def verify_triple_lm_wikidata(self, triple, gold_triples):
+    def verify_triple_lm_snippet(self, triple, snippet):
         """
 
-        Get the facts and wikidata gold triple and ask LLM as a judge if it the fact 
+        Get the facts and web parsed snippet, and ask LLM as a judge if the fact
         entails or is plausible
 
         """
 
+        response = self._create_completion(self.snippet_messages(triple, snippet), "snippet")
+        return response.choices[0].message.content
+
+    def wikidata_messages(self, triple, gold_triples):
         triple_prompt_str = f"Statement to verify: {triple}."
         gold_prompt_str = f"List of triples to verify from :{str(gold_triples)}"
         messages = [
@@ -57,13 +95,44 @@ class Request:
                 {"role": "user", "content": triple_prompt_str},
                 {"role": "user", "content": gold_prompt_str},
             ]
+        if self.prompt_layout == "prefix_cache":
+            # the static instructions and the subject's gold triples form the shared prefix, the triple comes last
+            messages = [messages[0], messages[2], messages[1]]
 
         #print(json.dumps(messages, indent=4))
-         
-        response = self.client.chat.completions.create(
-            messages = messages,
-            model = self.model_name,
-            max_tokens = self.max_tokens,
-            temperature=0.0,
-        )
-        return response.choices[0].message.content
\ No newline at end of file
+        return messages
+
+    def verify_triple_lm_wikidata(self, triple, gold_triples):
+        """
+
+        Get the facts and wikidata gold triple and ask LLM as a judge if it the fact 
+        entails or is plausible
+
+        """
+
+        response = self._create_completion(self.wikidata_messages(triple, gold_triples), "wikidata")
+        return response.choices[0].message.content
+
+    def verify_triple_with_confidence(self, triple, context, judge_type = "wikidata", top_logprobs = 10):
+        """
+        Single token verdict with its probability: the answer is cut to one token and the probability mass of each
+        option a, b, c, d is read from the top logprobs of that token
+
+        Returns:
+            (str, float): the most probable option (the raw token if no option is among the top logprobs) and its probability
+        """
+        messages = self.snippet_messages(triple, context) if judge_type == "snippet" else self.wikidata_messages(triple, context)
+        response = self._create_completion(messages, judge_type, max_tokens = 1, logprobs = True, top_logprobs = top_logprobs)
+        choice = response.choices[0]
+
+        probabilities = {}
+        if choice.logprobs is not None and choice.logprobs.content:
+            for candidate in choice.logprobs.content[0].top_logprobs:
+                option = candidate.token.strip().lower().rstrip(")")
+                if option in JUDGE_OPTIONS:
+                    probabilities[option] = probabilities.get(option, 0.0) + math.exp(candidate.logprob)
+
+        if not probabilities:
+            return choice.message.content or "", 0.0
+        option = max(probabilities, key=probabilities.get)
+        return option, probabilities[option]
\ No newline at end of file
@@ -0,0 +1,192 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+from tqdm import tqdm
+from telemetry import telemetry
+
+"""
+
+py file containing the web snippet retrieval engine: a token bucket rate limiter, concurrent search requests
+within that limit, query normalisation / deduplication and a persistent SQLite snippet cache
+"""
+
+# requests per second and burst size of the brave search api subscription plans
+BRAVE_TIERS = {
+    "free": {"rate": 1.0, "burst": 1},
+    "base": {"rate": 20.0, "burst": 20},
+    "pro": {"rate": 50.0, "burst": 50},
+}
+
+
+def normalize_query(query):
+    """
+    Normalise a search query so that trivially different queries share one search call and one cache entry
+    """
+    query = query.replace("_", " ").lower()
+    return re.sub(r"\s+", " ", query).strip()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int = 1):
+        """
+        Thread safe token bucket
+
+        Arguments:
+            rate (float): Tokens added per second, i.e. the sustained number of requests per second
+            capacity (int): Maximum number of tokens, i.e. the allowed burst
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class SnippetCache:
+    def __init__(self, cache_file_path: str):
+        """
+        Persistent snippet cache keyed by the normalised query
+
+        Arguments:
+            cache_file_path (str): SQLite database file
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file_path)), exist_ok=True)
+        self.cache_file_path = cache_file_path
+        self._lock = threading.Lock()
+        self.connection = sqlite3.connect(cache_file_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS snippets ("
+            "query TEXT PRIMARY KEY, "
+            "engine TEXT NOT NULL, "
+            "snippets TEXT NOT NULL, "
+            "fetched_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get(self, query, engine = "brave"):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT snippets FROM snippets WHERE query = ? AND engine = ?", (normalize_query(query), engine)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def get_many(self, queries, engine = "brave") -> dict:
+        """
+        Cached snippets for the given queries, keyed by normalised query, queries not in the cache are left out
+        """
+        normalized_queries = list(dict.fromkeys(normalize_query(query) for query in queries))
+        found = {}
+        with self._lock:
+            # stay below the default SQLite limit of host parameters per statement
+            for start in range(0, len(normalized_queries), 500):
+                chunk = normalized_queries[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT query, snippets FROM snippets WHERE engine = ? AND query IN ({placeholders})", [engine] + chunk
+                ).fetchall()
+                for query, snippets in rows:
+                    found[query] = json.loads(snippets)
+        return found
+
+    def put(self, query, snippets, engine = "brave"):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO snippets (query, engine, snippets, fetched_at) VALUES (?, ?, ?, ?)",
+                (normalize_query(query), engine, json.dumps(snippets), time.time()),
+            )
+            self.connection.commit()
+
+    def search(self, pattern, engine = "brave") -> dict:
+        """
+        Query the cache with a SQL LIKE pattern on the normalised query, e.g. `%kurt gödel%`
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT query, snippets FROM snippets WHERE engine = ? AND query LIKE ?", (engine, pattern)
+            ).fetchall()
+        return {query: json.loads(snippets) for query, snippets in rows}
+
+    def close(self):
+        self.connection.close()
+
+
+class SnippetRetriever:
+    def __init__(self, search_fn, cache: SnippetCache, rate: float = 1.0, burst: int = 1, max_workers: int = 4, engine: str = "brave"):
+        """
+        Retrieve snippets for many queries with deduplication, caching and rate limited concurrency
+
+        Arguments:
+            search_fn (callable): Function taking a search term and returning a list of snippets, or None if the request failed
+            cache (SnippetCache): Persistent snippet cache
+            rate (float): Allowed search requests per second
+            burst (int): Allowed burst of search requests
+            max_workers (int): Maximum number of search requests in flight
+            engine (str): Name of the search engine, part of the cache key
+        """
+        self.search_fn = search_fn
+        self.cache = cache
+        self.token_bucket = TokenBucket(rate, burst)
+        self.max_workers = max_workers
+        self.engine = engine
+
+    def fetch(self, query):
+        """
+        Search a single query, waiting for the rate limiter first. Failed requests are not cached.
+        """
+        self.token_bucket.acquire()
+        with telemetry.timer("search_latency_seconds", engine=self.engine):
+            snippets = self.search_fn(query)
+        if snippets is None:
+            telemetry.inc("search_requests_total", engine=self.engine, result="error")
+            return []
+        telemetry.inc("search_requests_total", engine=self.engine, result="ok")
+        self.cache.put(query, snippets, self.engine)
+        return snippets
+
+    def get(self, query):
+        """
+        Snippets for a single query, from the cache if possible
+        """
+        snippets = self.cache.get(query, self.engine)
+        telemetry.inc("snippet_cache_lookups_total", result="hit" if snippets is not None else "miss")
+        return snippets if snippets is not None else self.fetch(normalize_query(query))
+
+    def retrieve(self, queries) -> dict:
+        """
+        Snippets for many queries. Queries are normalised and deduplicated, only queries missing from the cache are searched.
+
+        Returns:
+            dict: normalised query -> list of snippets
+        """
+        normalized_queries = list(dict.fromkeys(normalize_query(query) for query in queries))
+        results = self.cache.get_many(normalized_queries, self.engine)
+        misses = [query for query in normalized_queries if query not in results]
+        telemetry.inc("snippet_cache_lookups_total", len(normalized_queries) - len(misses), result="hit")
+        telemetry.inc("snippet_cache_lookups_total", len(misses), result="miss")
+        logger.info(f"{len(queries)} snippet queries, {len(normalized_queries)} unique, {len(misses)} not cached ...")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for query, snippets in zip(misses, tqdm(executor.map(self.fetch, misses), total=len(misses), desc="Searching snippets")):
+                results[query] = snippets
+
+        return results
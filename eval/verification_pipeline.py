@@ -0,0 +1,170 @@
+import json
+import queue
+import threading
+import time
+import openai
+from loguru import logger
+from tqdm import tqdm
+from telemetry import telemetry
+from snippet_retrieval import normalize_query
+
+"""
+
+py file containing the staged producer / consumer pipeline for web verification: search workers feed snippets
+straight to judge workers through bounded queues, and verdicts are written to a results sink as they arrive.
+A full queue blocks the stage before it, so a throttled judge slows down searching (and vice versa) instead of
+piling up work in memory. Tasks with the same normalised query are searched once
+"""
+
+# marks the end of the input of a stage
+_STOP = object()
+
+
+class JsonlResultsSink:
+    def __init__(self, file_path: str, resume: bool = False):
+        """
+        Thread safe sink appending one JSON verdict per line, flushed as every verdict arrives
+
+        Arguments:
+            file_path (str): JSONL file the verdicts are appended to
+            resume (bool): Keep the verdicts of a previous run, otherwise the file is started from scratch
+        """
+        self.file_path = file_path
+        self._lock = threading.Lock()
+        self._file = open(file_path, "a" if resume else "w", encoding="utf-8")
+
+    def write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class WebVerificationPipeline:
+    def __init__(
+            self,
+            snippet_retriever,
+            judge_fn,
+            results_sink: JsonlResultsSink,
+            search_workers: int = 4,
+            judge_workers: int = 4,
+            queue_size: int = 64,
+            max_judge_retries: int = 5,
+        ):
+        """
+        Arguments:
+            snippet_retriever (SnippetRetriever): Retriever used by the search workers (cached and rate limited)
+            judge_fn (callable): Function (triple string, snippet string) -> LLM output, e.g. `Request.verify_triple_lm_snippet`
+            results_sink (JsonlResultsSink): Sink receiving every verdict as soon as it is available
+            search_workers (int): Number of search worker threads
+            judge_workers (int): Number of judge worker threads
+            queue_size (int): Capacity of each bounded queue between stages
+            max_judge_retries (int): Attempts per judge call when the LLM api is rate limiting
+        """
+        self.snippet_retriever = snippet_retriever
+        self.judge_fn = judge_fn
+        self.results_sink = results_sink
+        self.search_workers = search_workers
+        self.judge_workers = judge_workers
+        self.queue_size = queue_size
+        self.max_judge_retries = max_judge_retries
+
+    def _search_worker(self, search_queue, judge_queue):
+        while True:
+            item = search_queue.get()
+            if item is _STOP:
+                return
+            # every task of the group shares the normalised query, search it once for all of them
+            query, group = item
+            try:
+                snippets = self.snippet_retriever.get(query)
+            except Exception as e:
+                logger.error(f"Search failed for query {query} | Error: {e}")
+                snippets = []
+            for task in group:
+                task["snippet"] = snippets
+                telemetry.observe("pipeline_queue_depth", judge_queue.qsize(), queue="judge")
+                judge_queue.put(task)
+
+    def _judge(self, task):
+        snippet_str = ""
+        for each_snippet in task["snippet"]:
+            snippet_str += each_snippet
+            snippet_str += " | "
+
+        for num_tries in range(self.max_judge_retries):
+            try:
+                return self.judge_fn(task["triple_str"], snippet_str)
+            except openai.RateLimitError:
+                wait_time = 2 ** num_tries
+                logger.info(f"Judge rate limited, waiting {wait_time} seconds before retrying ...")
+                telemetry.inc("openai_rate_limit_errors_total", endpoint="chat")
+                time.sleep(wait_time)
+        raise Exception(f"Judge failed after {self.max_judge_retries} attempts")
+
+    def _judge_worker(self, judge_queue, progress_bar):
+        while True:
+            task = judge_queue.get()
+            if task is _STOP:
+                return
+            if len(task["snippet"]) > 0:
+                try:
+                    output = self._judge(task)
+                    verdict = output[:1] if output[:1] in ("a", "b", "c", "d") else "other"
+                except Exception as e:
+                    logger.error(f"Judge failed for triple {task['triple_str']} | Error: {e}")
+                    output, verdict = None, "error"
+            else:
+                output, verdict = None, "noSnippet"
+
+            task["output"], task["verdict"] = output, verdict
+            telemetry.inc("verdicts_total", metric="web", file=task["filename"], verdict=verdict)
+            self.results_sink.write({
+                "filename": task["filename"],
+                "triple": task["triple"],
+                "triple_str": task["triple_str"],
+                "query": task["query"],
+                "snippet": task["snippet"],
+                "output": output,
+                "verdict": verdict,
+            })
+            progress_bar.update(1)
+
+    def run(self, tasks):
+        """
+        Run the pipeline over the tasks, each task is a dict with keys `filename`, `triple`, `triple_str` and `query`
+        Returns once every verdict has been written to the sink
+        """
+        query_groups = dict()
+        for task in tasks:
+            query_groups.setdefault(normalize_query(task["query"]), []).append(task)
+        logger.info(f"{len(tasks)} triples to verify, {len(query_groups)} unique queries ...")
+
+        search_queue = queue.Queue(maxsize=self.queue_size)
+        judge_queue = queue.Queue(maxsize=self.queue_size)
+        progress_bar = tqdm(total=len(tasks), desc="Verifying triples on the web")
+
+        search_threads = [threading.Thread(target=self._search_worker, args=(search_queue, judge_queue), daemon=True)
+                          for _ in range(self.search_workers)]
+        judge_threads = [threading.Thread(target=self._judge_worker, args=(judge_queue, progress_bar), daemon=True)
+                         for _ in range(self.judge_workers)]
+        for thread in search_threads + judge_threads:
+            thread.start()
+
+        # put blocks while the search queue is full, which is the backpressure on the producer
+        for query_group in query_groups.items():
+            search_queue.put(query_group)
+        for _ in search_threads:
+            search_queue.put(_STOP)
+        for thread in search_threads:
+            thread.join()
+
+        for _ in judge_threads:
+            judge_queue.put(_STOP)
+        for thread in judge_threads:
+            thread.join()
+
+        progress_bar.close()
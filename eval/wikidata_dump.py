@@ -0,0 +1,253 @@
+import bz2
+import gzip
+import json
+import re
+import fire
+from loguru import logger
+from tqdm import tqdm
+from telemetry import telemetry
+
+"""
+
+py file containing helper methods for building the gold triples from a local Wikidata JSON dump
+(https://dumps.wikimedia.org/wikidatawiki/entities/) instead of the web api
+
+The dump is streamed line by line twice:
+    pass 1 keeps the claims of the requested entities only and collects the ids they refer to
+    pass 2 keeps the labels of the referred items and properties only
+so memory is bounded by the size of the requested entities, never by the size of the dump
+"""
+
+# the entity id and the label are serialised before the claims, so they can be read from the line prefix
+# without decoding the (potentially very large) entity
+ENTITY_ID_PATTERN = re.compile(r'"id":"([QP]\d+)"')
+ENTITY_ID_PREFIX_LENGTH = 200
+
+
+def open_wikidata_dump(dump_path):
+    """
+    Open a Wikidata JSON dump as text, transparently handling `.bz2` and `.gz` compression
+    """
+    if dump_path.endswith(".bz2"):
+        return bz2.open(dump_path, "rt", encoding="utf-8")
+    if dump_path.endswith(".gz"):
+        return gzip.open(dump_path, "rt", encoding="utf-8")
+    return open(dump_path, "r", encoding="utf-8")
+
+
+def iter_dump_lines(dump_path):
+    """
+    Yield one raw JSON entity string per line, skipping the enclosing `[` / `]` of the dump
+    """
+    with open_wikidata_dump(dump_path) as dump_file:
+        for line in dump_file:
+            line = line.strip()
+            if line in ("", "[", "]"):
+                continue
+            yield line.rstrip(",")
+
+
+def _label_pattern(language):
+    return re.compile(r'"labels":\{.*?"' + re.escape(language) + r'":\{"language":"' + re.escape(language) + r'","value":"((?:[^"\\]|\\.)*)"')
+
+
+def _entity_label(entity, language):
+    return entity.get("labels", {}).get(language, {}).get("value")
+
+
+def _entity_claims(entity):
+    """
+    Keep only claim values which refer to other entities, same as `fetch_wikidata_claims` +
+    `convert_wikidata_claims_to_triples` do for the web api
+    """
+    claims = []
+    for prop, values in entity.get("claims", {}).items():
+        for value in values:
+            datavalue = value.get("mainsnak", {}).get("datavalue")
+            if datavalue is None:
+                continue
+            if type(datavalue.get("value")) == dict and "id" in datavalue["value"]:
+                claims.append((prop, datavalue["value"]["id"]))
+    return claims
+
+
+def collect_subject_claims(dump_path, subject_names, qid_map = None, language = "en"):
+    """
+    First pass over the dump. Find the entities for the requested subjects and keep their claims.
+
+    Args:
+        dump_path (str): Path to the Wikidata JSON dump (.json, .json.bz2 or .json.gz)
+        subject_names (list): Subject names, matched against the entity label in `language`
+        qid_map (dict): Optional mapping subject name -> QID, subjects in it are matched by id instead of label
+        language (str): The language code used for label matching (default is "en")
+
+    Returns:
+        dict: subject name -> {"qid": str, "lastrevid": int, "modified": str, "claims": [(property id, value id), ...]}
+    """
+    qid_map = {name: qid for name, qid in (qid_map or {}).items() if qid}
+    qid_to_names = {}
+    for name in subject_names:
+        if name in qid_map:
+            qid_to_names.setdefault(qid_map[name], []).append(name)
+    label_to_names = {}
+    for name in subject_names:
+        if name not in qid_map:
+            label_to_names.setdefault(name, []).append(name)
+
+    label_pattern = _label_pattern(language)
+
+    # for label matches several entities can share the same label, the one with the most sitelinks wins
+    # which approximates the ranking of `wbsearchentities`
+    matched = {}
+    for line in tqdm(iter_dump_lines(dump_path), desc="Scanning dump for subjects"):
+        id_match = ENTITY_ID_PATTERN.search(line, 0, ENTITY_ID_PREFIX_LENGTH)
+        entity_id = id_match.group(1) if id_match else None
+
+        if entity_id is None and qid_to_names:
+            entity_id = json.loads(line).get("id")
+
+        names = list(qid_to_names.get(entity_id, []))
+        label_names = []
+        if label_to_names:
+            label_match = label_pattern.search(line)
+            if label_match is not None:
+                label_names = label_to_names.get(json.loads('"' + label_match.group(1) + '"'), [])
+
+        if not names and not label_names:
+            continue
+
+        entity = json.loads(line)
+        # the prefix regex may pick up a description when the entity has no label, so confirm on the decoded entity
+        if label_names and _entity_label(entity, language) in label_to_names:
+            names.extend(label_names)
+        if not names:
+            continue
+        sitelinks = len(entity.get("sitelinks", {}))
+        for name in names:
+            matched_by_id = name in qid_map
+            if not matched_by_id and name in matched and matched[name]["sitelinks"] >= sitelinks:
+                continue
+            matched[name] = {
+                "qid": entity["id"],
+                "sitelinks": sitelinks,
+                "lastrevid": entity.get("lastrevid"),
+                "modified": entity.get("modified"),
+                "claims": _entity_claims(entity),
+            }
+
+    for name in subject_names:
+        if name not in matched:
+            logger.info(f"No matches found in the dump for entity: {name}")
+
+    for value in matched.values():
+        del value["sitelinks"]
+    return matched
+
+
+def collect_labels(dump_path, entity_ids, language = "en"):
+    """
+    Second pass over the dump. Build the label table for the given item and property ids only.
+    """
+    remaining = set(entity_ids)
+    labels = {}
+    for line in tqdm(iter_dump_lines(dump_path), desc="Scanning dump for labels"):
+        if not remaining:
+            break
+        id_match = ENTITY_ID_PATTERN.search(line, 0, ENTITY_ID_PREFIX_LENGTH)
+        if id_match is not None:
+            if id_match.group(1) not in remaining:
+                continue
+            entity = json.loads(line)
+        else:
+            entity = json.loads(line)
+            if entity.get("id") not in remaining:
+                continue
+
+        remaining.discard(entity["id"])
+        label = _entity_label(entity, language)
+        if label is not None:
+            labels[entity["id"]] = label
+
+    return labels
+
+
+def build_gold_records_from_dump(subject_names, dump_path, qid_map = None, language = "en"):
+    """
+    Build the gold records for the given subjects from a local dump.
+
+    Returns:
+        dict: subject name -> {"qid", "lastrevid", "modified", "triples"}, where triples has the structure of `create_gold_triples_file`
+    """
+    subject_names = list(dict.fromkeys(subject_names))
+    subject_claims = collect_subject_claims(dump_path, subject_names, qid_map, language)
+
+    referenced_ids = set()
+    for value in subject_claims.values():
+        for prop, value_id in value["claims"]:
+            referenced_ids.add(prop)
+            referenced_ids.add(value_id)
+    labels = collect_labels(dump_path, referenced_ids, language)
+
+    gold_records = dict()
+    for subject in subject_names:
+        if subject not in subject_claims:
+            continue
+        all_triples_wikidata = []
+        for prop, value_id in subject_claims[subject]["claims"]:
+            prop_label = labels.get(prop)
+            referred_entity = labels.get(value_id)
+            if prop_label != None and referred_entity != None:
+                all_triples_wikidata.append({'subject': subject, 'predicate': prop_label, 'object': referred_entity})
+        gold_records[subject] = {
+            "qid": subject_claims[subject]["qid"],
+            "lastrevid": subject_claims[subject]["lastrevid"],
+            "modified": subject_claims[subject]["modified"],
+            "triples": all_triples_wikidata,
+        }
+        telemetry.inc("gold_entities_fetched_total", source="dump")
+
+    return gold_records
+
+
+def build_gold_triples_from_dump(subject_names, dump_path, qid_map = None, language = "en"):
+    """
+    Build the gold triples for the given subjects from a local dump.
+
+    Returns:
+        dict: subject name -> list of {'subject', 'predicate', 'object'} dicts, same structure as `create_gold_triples_file`
+    """
+    gold_records = build_gold_records_from_dump(subject_names, dump_path, qid_map, language)
+    return {subject: record["triples"] for subject, record in gold_records.items()}
+
+
+def create_gold_triples_file_from_dump(data_triples, dump_path, gold_file_path, qid_map = None):
+    """
+    Same as `create_gold_triples_file` but reads the claims and labels from a local Wikidata dump
+    """
+    subject_names = [each_triple['subject'] for each_triple in data_triples]
+    gold_triples = build_gold_triples_from_dump(subject_names, dump_path, qid_map)
+
+    with open(gold_file_path, "w") as json_file:
+        json.dump(gold_triples, json_file, indent=4)
+
+    print(f"Data has been written to {gold_file_path}")
+
+
+def main(dump_path: str, wikidata_entities_file_path: str, gold_file_path: str):
+    """
+    Build the gold triples file for all handpicked entities from a local Wikidata dump
+
+    Arguments:
+        dump_path (str): Path to the Wikidata JSON dump (.json, .json.bz2 or .json.gz)
+        wikidata_entities_file_path (str): File path storing the manually curated wikidata entity files
+        gold_file_path (str): File path where the gold triples are written
+    """
+    from entity_resolver import load_wikidata_entities
+
+    entity_categories, precomputed_qids = load_wikidata_entities(wikidata_entities_file_path)
+    all_entities = [{'subject': item} for key, values in entity_categories.items() for item in values]
+    create_gold_triples_file_from_dump(all_entities, dump_path, gold_file_path, precomputed_qids)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,174 @@
+import os
+import threading
+from loguru import logger
+from tqdm import tqdm
+from telemetry import telemetry
+from http_client import http_client
+
+"""
+
+py file containing helper methods for building the gold triples in bulk through SPARQL instead of one
+`Special:EntityData` call per subject plus one label call per claim value. Subjects are fetched in chunks of QIDs
+(`VALUES`), every claim value is joined with its `rdfs:label`, so a chunk of entities costs a single round trip
+
+The endpoint is either the url of a SPARQL endpoint (the Wikidata query service by default, or a local mirror)
+or the path of a local RDF file in the Wikidata RDF format, which is queried in process with rdflib
+"""
+
+WIKIDATA_SPARQL_ENDPOINT = "https://query.wikidata.org/sparql"
+
+# the wikidata query service predefines these prefixes, other endpoints need them spelled out
+SPARQL_PREFIXES = """PREFIX wd: <http://www.wikidata.org/entity/>
+PREFIX wikibase: <http://wikiba.se/ontology#>
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+PREFIX schema: <http://schema.org/>
+"""
+
+# every statement (all ranks, as the web api), with the english labels of the property and of the item value;
+# literal values and unknown / no values have no label and drop out of the join
+CLAIMS_QUERY = SPARQL_PREFIXES + """SELECT ?item ?prop ?propLabel ?valueLabel WHERE {{
+  VALUES ?item {{ {values} }}
+  ?item ?claim ?statement .
+  ?prop wikibase:claim ?claim ;
+        wikibase:statementProperty ?statementProperty ;
+        rdfs:label ?propLabel .
+  ?statement ?statementProperty ?value .
+  ?value rdfs:label ?valueLabel .
+  FILTER(LANG(?propLabel) = "{language}" && LANG(?valueLabel) = "{language}")
+}}"""
+
+REVISIONS_QUERY = SPARQL_PREFIXES + """SELECT ?item ?version ?modified WHERE {{
+  VALUES ?item {{ {values} }}
+  OPTIONAL {{ ?item schema:version ?version . }}
+  OPTIONAL {{ ?item schema:dateModified ?modified . }}
+}}"""
+
+# rdflib graphs of local stand-in endpoints, parsed once per process
+_local_graphs = {}
+_local_graphs_lock = threading.Lock()
+
+
+def _local_graph(file_path):
+    with _local_graphs_lock:
+        graph = _local_graphs.get(file_path)
+        if graph is None:
+            import rdflib
+
+            # keep the lexical form of the literals (e.g. "...T00:00:00Z", not "+00:00") as an endpoint returns it
+            normalize_literals = rdflib.NORMALIZE_LITERALS
+            rdflib.NORMALIZE_LITERALS = False
+            try:
+                graph = rdflib.Graph()
+                graph.parse(file_path)
+            finally:
+                rdflib.NORMALIZE_LITERALS = normalize_literals
+            _local_graphs[file_path] = graph
+        return graph
+
+
+def run_sparql_query(query, endpoint = WIKIDATA_SPARQL_ENDPOINT):
+    """
+    Run a SELECT query against a SPARQL endpoint url or a local RDF file
+
+    Returns:
+        list: one dict per result row, variable name -> value as string (unbound variables are left out)
+    """
+    with telemetry.timer("sparql_query_seconds"):
+        if os.path.isfile(endpoint):
+            rows = []
+            for row in _local_graph(endpoint).query(query):
+                rows.append({name: str(value) for name, value in row.asdict().items()})
+        else:
+            response = http_client.request(
+                "POST",
+                endpoint,
+                data = {"query": query},
+                headers = {"Accept": "application/sparql-results+json"},
+            )
+            if response.status_code != 200:
+                raise Exception(f"SPARQL query failed. HTTP Status Code: {response.status_code}")
+            rows = [
+                {name: binding["value"] for name, binding in each_binding.items()}
+                for each_binding in response.json()["results"]["bindings"]
+            ]
+    telemetry.inc("sparql_queries_total")
+    return rows
+
+
+def _entity_id(iri):
+    return iri.rsplit("/", 1)[-1]
+
+
+def _values(entity_ids):
+    return " ".join(f"wd:{entity_id}" for entity_id in entity_ids)
+
+
+def fetch_claims_sparql(entity_ids, endpoint = WIKIDATA_SPARQL_ENDPOINT, chunk_size = 50, language = "en"):
+    """
+    Labelled claims of many entities, `chunk_size` entities per query
+
+    Returns:
+        dict: entity ID -> list of (property label, value label), entities without labelled claims are left out
+    """
+    entity_ids = list(dict.fromkeys(entity_ids))
+    claims = {}
+    for start in tqdm(range(0, len(entity_ids), chunk_size), desc="Fetching gold claims via SPARQL"):
+        chunk = entity_ids[start:start + chunk_size]
+        rows = run_sparql_query(CLAIMS_QUERY.format(values=_values(chunk), language=language), endpoint)
+        for row in rows:
+            claims.setdefault(_entity_id(row["item"]), []).append((row["propLabel"], row["valueLabel"]))
+    return claims
+
+
+def fetch_revisions_sparql(entity_ids, endpoint = WIKIDATA_SPARQL_ENDPOINT, chunk_size = 50):
+    """
+    Latest revision id and modification timestamp of many entities, same structure as `fetch_wikidata_revisions`
+    """
+    entity_ids = list(dict.fromkeys(entity_ids))
+    revisions = {}
+    for start in range(0, len(entity_ids), chunk_size):
+        chunk = entity_ids[start:start + chunk_size]
+        for row in run_sparql_query(REVISIONS_QUERY.format(values=_values(chunk)), endpoint):
+            revisions[_entity_id(row["item"])] = {
+                "lastrevid": int(row["version"]) if "version" in row else None,
+                "modified": row.get("modified"),
+            }
+    return revisions
+
+
+def build_gold_records_from_sparql(subject_qids, endpoint = WIKIDATA_SPARQL_ENDPOINT, chunk_size = 50, language = "en"):
+    """
+    Build the gold records for the given subjects through SPARQL.
+
+    Args:
+        subject_qids (dict): subject name -> Wikidata entity ID, subjects without an ID are skipped
+        endpoint (str): SPARQL endpoint url or local RDF file
+        chunk_size (int): Number of entities per query
+
+    Returns:
+        dict: subject name -> {"qid", "lastrevid", "modified", "triples"}, where triples has the structure of
+        `convert_wikidata_claims_to_triples(..., 'dict')`
+    """
+    entity_ids = [entity_id for entity_id in subject_qids.values() if entity_id is not None]
+    with telemetry.timer("gold_entity_fetch_seconds", source="sparql"):
+        claims = fetch_claims_sparql(entity_ids, endpoint, chunk_size, language)
+        revisions = fetch_revisions_sparql(entity_ids, endpoint, chunk_size)
+
+    gold_records = dict()
+    for subject, entity_id in subject_qids.items():
+        if entity_id is None:
+            continue
+        revision = revisions.get(entity_id, {})
+        gold_records[subject] = {
+            "qid": entity_id,
+            "lastrevid": revision.get("lastrevid"),
+            "modified": revision.get("modified"),
+            "triples": [
+                {'subject': subject, 'predicate': prop_label, 'object': value_label}
+                for prop_label, value_label in claims.get(entity_id, [])
+            ],
+        }
+        telemetry.inc("gold_entities_fetched_total", source="sparql")
+
+    logger.info(f"Fetched the gold triples of {len(gold_records)} subjects in {-(-len(set(entity_ids)) // chunk_size)} chunks ...")
+    return gold_records
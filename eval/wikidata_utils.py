@@ -1,16 +1,32 @@
-import requests
 from tqdm import tqdm 
-import torch
-from sentence_transformers import SentenceTransformer, util
 from loguru import logger
 import json
+from telemetry import telemetry
+from http_client import http_client
+from embedding_worker import EmbeddingClient
 
 """
 
 py file containing helper methods for fetching data from wikidata for entities
+
+Soft matching embeds through `EmbeddingClient`: the local embedding worker when it is running, otherwise torch and
+sentence_transformers are imported on first use, so that the wikidata only paths (sanity check, gold triples,
+exact matching) start without loading them
 """
 
-def get_wikidata_entity_id(entity_name, language = 'en'):
+SOFT_MATCH_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# connects to the embedding worker (or loads the model) on the first soft match only
+soft_match_model = EmbeddingClient(SOFT_MATCH_MODEL_NAME)
+
+def http_get(url, params = None, headers = None):
+    """
+    GET through the shared pooled client (keep-alive, gzip, timeouts, retries, per host caps), see `http_client`
+    """
+    return http_client.get(url, params=params, headers=headers)
+
+
+def get_wikidata_entity_id(entity_name, language = 'en', raise_on_error = False):
 
     """
     Fetches the Wikidata entity ID for a given entity string.
@@ -18,6 +34,8 @@ def get_wikidata_entity_id(entity_name, language = 'en'):
     Args:
         entity_name (str): The name of the entity to search for.
         language (str): The language of the entity (default is "en").
+        raise_on_error (bool): Raise `httpx.HTTPStatusError` on a failed request (429, 5xx once the retries are
+            exhausted) instead of returning None, so that callers caching the result can tell it from "no match".
     
     Returns:
         str: The Wikidata entity ID (e.g., "Q937") or None if not found.
@@ -31,7 +49,7 @@ def get_wikidata_entity_id(entity_name, language = 'en'):
         "format": "json"
     }
 
-    response = requests.get(url, params=params)
+    response = http_get(url, params=params)
     
     if response.status_code == 200:
         results = response.json().get("search", [])
@@ -43,6 +61,8 @@ def get_wikidata_entity_id(entity_name, language = 'en'):
             return None
     else:
         logger.info(f"Failed to fetch data. HTTP Status Code: {response.status_code}")
+        if raise_on_error:
+            response.raise_for_status()
         return None
 
 
@@ -57,16 +77,26 @@ def sanity_check_entity(entity_name, language = 'en'):
         return False
 
 
-def fetch_wikidata_claims(entity_id):
+def fetch_wikidata_entity(entity_id):
     """
-    Fetches properties for claims given a Wikidata entity using its ID.
+    Fetches the full entity document (claims, labels, lastrevid, modified, ...) given a Wikidata entity ID.
     """
     url = f"https://www.wikidata.org/wiki/Special:EntityData/{entity_id}.json"
-    response = requests.get(url)
+    response = http_get(url)
     if response.status_code != 200:
         raise Exception(f"Failed to fetch entity data for {entity_id}")
     data = response.json()
-    claims = data['entities'][entity_id]['claims']
+    # redirected ids are returned under the id of the redirect target
+    if entity_id not in data['entities']:
+        return next(iter(data['entities'].values()))
+    return data['entities'][entity_id]
+
+
+def extract_claim_values(entity):
+    """
+    Map every property of an entity document to the list of its claim values
+    """
+    claims = entity['claims']
     properties = {}
     for prop, values in claims.items():
         properties[prop] = [v['mainsnak']['datavalue']['value'] for v in values if 'datavalue' in v['mainsnak']]
@@ -74,6 +104,49 @@ def fetch_wikidata_claims(entity_id):
     return properties
 
 
+def fetch_wikidata_claims(entity_id):
+    """
+    Fetches properties for claims given a Wikidata entity using its ID.
+    """
+    return extract_claim_values(fetch_wikidata_entity(entity_id))
+
+
+def fetch_wikidata_revisions(entity_ids, batch_size = 50):
+    """
+    Fetches the latest revision id and modification timestamp for many entities, `batch_size` ids per
+    `wbgetentities` call (50 is the api limit for anonymous clients).
+
+    Args:
+        entity_ids (list): Wikidata entity IDs (e.g., ["Q42", "Q937"]).
+        batch_size (int): Number of ids per request.
+
+    Returns:
+        dict: entity ID -> {"lastrevid": int, "modified": str}, ids missing on wikidata are left out
+    """
+    url = "https://www.wikidata.org/w/api.php"
+    entity_ids = list(dict.fromkeys(entity_ids))
+    revisions = {}
+    for start in range(0, len(entity_ids), batch_size):
+        batch_ids = entity_ids[start:start + batch_size]
+        params = {
+            "action": "wbgetentities",
+            "ids": "|".join(batch_ids),
+            "props": "info",
+            "format": "json"
+        }
+        response = http_get(url, params=params)
+        if response.status_code != 200:
+            raise Exception(f"Failed to fetch revisions. HTTP Status Code: {response.status_code}")
+
+        for entity_id, entity in response.json().get("entities", {}).items():
+            if "missing" in entity:
+                logger.info(f"Entity {entity_id} is missing on wikidata")
+                continue
+            revisions[entity_id] = {"lastrevid": entity.get("lastrevid"), "modified": entity.get("modified")}
+
+    return revisions
+
+
 def get_wikidata_entity_name(entity_id, language="en"):
     """
     Fetches the name (label) of a Wikidata entity given its ID.
@@ -94,7 +167,7 @@ def get_wikidata_entity_name(entity_id, language="en"):
         "format": "json"
     }
     
-    response = requests.get(url, params=params)
+    response = http_get(url, params=params)
     
     if response.status_code == 200:
         data = response.json()
@@ -131,7 +204,7 @@ def get_wikidata_property_label(property_id, language="en"):
         "format": "json"
     }
     
-    response = requests.get(url, params=params)
+    response = http_get(url, params=params)
     
     if response.status_code == 200:
         data = response.json()
@@ -176,10 +249,9 @@ def soft_match_triples_with_claims(current_triple, wikidata_claims, threshold_sc
     return True else False
 
     """
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu") 
-    model = SentenceTransformer('all-MiniLM-L6-v2').to(device)
+    model = soft_match_model
     triple_texts = [f"{current_triple['subject']} {current_triple['predicate']} {current_triple['object']}"]
-    triple_embeddings = model.encode(triple_texts, convert_to_tensor=True, device = device)
+    triple_embeddings = model.encode(triple_texts, normalize_embeddings=True)
 
     # variable for storing all wikidata claims converted to triple format
     all_triple_wikidata_claims = []
@@ -196,14 +268,14 @@ def soft_match_triples_with_claims(current_triple, wikidata_claims, threshold_sc
                         all_triple_wikidata_claims.append(curr_wikidata_claim_string)
     
 
-    claim_embedding = model.encode(all_triple_wikidata_claims, convert_to_tensor=True, device = device)
-    similarities = util.pytorch_cos_sim(triple_embeddings, claim_embedding)
+    if not all_triple_wikidata_claims:
+        return False
 
-    # record indices for matching triples semantically
-    indices = (similarities > threshold_score).nonzero(as_tuple=True)
-    values = similarities[indices]
+    # cosine similarities of the normalised embeddings
+    claim_embedding = model.encode(all_triple_wikidata_claims, normalize_embeddings=True)
+    similarities = triple_embeddings @ claim_embedding.T
 
-    if len(values) > 0:
+    if (similarities > threshold_score).any():
         return True
     
     return False
@@ -228,20 +300,52 @@ def soft_match_utils(raw_triples):
     return plausible_triples
 
 
-def create_gold_triples_file(data_triples, gold_file_path):
+def fetch_gold_record(subject_name, subject_entity_id):
+    """
+    Fetch a single entity from the web api and convert its claims to the gold triples of `subject_name`
+
+    Returns:
+        dict: {"qid", "lastrevid", "modified", "triples"}
+    """
+    with telemetry.timer("gold_entity_fetch_seconds", source="api"):
+        entity = fetch_wikidata_entity(subject_entity_id)
+        wikidata_claims = extract_claim_values(entity)
+        all_triples_wikidata = convert_wikidata_claims_to_triples(wikidata_claims, subject_name, 'dict')
+    telemetry.inc("gold_entities_fetched_total", source="api")
+    return {
+        "qid": subject_entity_id,
+        "lastrevid": entity.get("lastrevid"),
+        "modified": entity.get("modified"),
+        "triples": all_triples_wikidata,
+    }
+
+
+def fetch_gold_triples(subject_name, subject_entity_id):
+    """
+    Fetch the claims of a single entity from the web api and convert them to the gold triples of `subject_name`
+    """
+    return fetch_gold_record(subject_name, subject_entity_id)["triples"]
+
+
+def create_gold_triples_file(data_triples, gold_file_path, entity_resolver = None):
 
     """
     Create gold triples file so that every time eval framework is used, web api lookup can be prevented
+    If an entity resolver is given, the subject QIDs are taken from it instead of one search call per subject
     """
     
+    if entity_resolver is not None:
+        subject_entity_ids = entity_resolver.resolve([each_triple['subject'] for each_triple in data_triples])
+
     gold_triples = dict()
     for each_triple in data_triples:
         if each_triple['subject'] not in gold_triples:
-            subject_entity_id = get_wikidata_entity_id(each_triple['subject'])
+            if entity_resolver is not None:
+                subject_entity_id = subject_entity_ids[each_triple['subject']]
+            else:
+                subject_entity_id = get_wikidata_entity_id(each_triple['subject'])
             if subject_entity_id is not None:
-                wikidata_claims = fetch_wikidata_claims(subject_entity_id)
-                all_triples_wikidata = convert_wikidata_claims_to_triples(wikidata_claims, each_triple['subject'], 'dict')
-                gold_triples[each_triple['subject']] = all_triples_wikidata
+                gold_triples[each_triple['subject']] = fetch_gold_triples(each_triple['subject'], subject_entity_id)
     
     with open(gold_file_path, "w") as json_file:
         json.dump(gold_triples, json_file, indent=4)
@@ -0,0 +1,455 @@
+import csv
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import fire
+from loguru import logger
+
+"""
+
+py file containing the orchestrator of the whole workflow: elicitation, entity sanity check, gold triples, judging
+and results.csv. Every step is a stage with declared inputs (parameters, files and the outputs of its upstream
+stages) and outputs. The inputs are content hashed into a key stored next to the output hashes of the last run, a
+stage whose key and outputs are unchanged is skipped. Stages run concurrently as soon as their upstream stages are
+done, and the work is split per template, so changing one template only recomputes the stages of that template
+
+The stages run the CLIs of `elicitation/` and `eval/` as subprocesses in their own directory, the output of every
+stage is written to `<stamp_dir>/logs/<stage>.log`
+"""
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+ELICITATION_DIR = os.path.join(ROOT_DIR, "elicitation")
+EVAL_DIR = os.path.join(ROOT_DIR, "eval")
+
+ELICITATION_JOB_TYPES = ("realtime", "batch")
+
+
+def file_digest(path):
+    """
+    sha256 of the content of a file, or of every file below a directory (with relative paths), None if it does not exist
+    """
+    if not os.path.exists(path):
+        return None
+
+    file_paths = [path]
+    if os.path.isdir(path):
+        file_paths = sorted(os.path.join(dir_path, file_name) for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+
+    digest = hashlib.sha256()
+    for file_path in file_paths:
+        digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Stage:
+    def __init__(self, name: str, run, outputs, inputs: dict = None, input_files: list = (), depends_on: list = (), always_run: bool = False):
+        """
+        One step of the pipeline
+
+        Arguments:
+            name (str): Unique name, e.g. `elicit:prompt_elicitation.json.jinja`
+            run (callable): Runs the stage, raises on failure
+            outputs (callable): Output paths of the stage, called after the run since some depend on it
+            inputs (dict): Parameters the outputs depend on (models, seed, sample size, ...)
+            input_files (list): Files or dirs whose content the outputs depend on
+            depends_on (list): Names of the upstream stages, their output hashes are inputs of this stage
+            always_run (bool): Run the stage every time, for stages reading state without a declared input (e.g. the
+                gold store, updated by `refresh_gold.py`); its downstream stages still only run when its outputs change
+        """
+        self.name = name
+        self.run = run
+        self.outputs = outputs
+        self.inputs = inputs or {}
+        self.input_files = list(input_files)
+        self.depends_on = list(depends_on)
+        self.always_run = always_run
+
+
+class Pipeline:
+    def __init__(self, stamp_dir: str, max_workers: int = 4, force: bool = False):
+        """
+        Arguments:
+            stamp_dir (str): Directory of the stage stamps (key and output hashes of the last successful run) and logs
+            max_workers (int): Number of stages running at the same time
+            force (bool): Run every stage, even if it is up to date
+        """
+        self.stamp_dir = stamp_dir
+        self.max_workers = max_workers
+        self.force = force
+        self.stages = {}
+        os.makedirs(os.path.join(stamp_dir, "stamps"), exist_ok=True)
+        os.makedirs(os.path.join(stamp_dir, "logs"), exist_ok=True)
+
+    def add(self, stage: Stage):
+        if stage.name in self.stages:
+            raise ValueError(f"Duplicate stage {stage.name}")
+        self.stages[stage.name] = stage
+        return stage
+
+    def stamp_path(self, stage_name):
+        return os.path.join(self.stamp_dir, "stamps", stage_name.replace(":", "__").replace("/", "_") + ".json")
+
+    def log_path(self, stage_name):
+        return os.path.join(self.stamp_dir, "logs", stage_name.replace(":", "__").replace("/", "_") + ".log")
+
+    def stage_key(self, stage: Stage, upstream_outputs: dict):
+        key_data = {
+            "inputs": stage.inputs,
+            "input_files": {path: file_digest(path) for path in stage.input_files},
+            "upstream": upstream_outputs,
+        }
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def read_stamp(self, stage_name):
+        stamp_path = self.stamp_path(stage_name)
+        if not os.path.isfile(stamp_path):
+            return None
+        with open(stamp_path, "r") as f:
+            return json.load(f)
+
+    def is_up_to_date(self, stage: Stage, key):
+        """
+        Same key as the last successful run, and its outputs are still there unchanged
+        """
+        stamp = self.read_stamp(stage.name)
+        if self.force or stage.always_run or stamp is None or stamp["key"] != key:
+            return False
+        try:
+            output_paths = stage.outputs()
+        except Exception:
+            return False
+        return sorted(output_paths) == sorted(stamp["outputs"]) and all(file_digest(path) == stamp["outputs"][path] for path in output_paths)
+
+    def run_stage(self, stage: Stage, upstream_outputs: dict):
+        """
+        Run a stage unless it is up to date
+
+        Returns:
+            (dict, bool): output path -> content hash, and whether the stage ran
+        """
+        key = self.stage_key(stage, upstream_outputs)
+        if self.is_up_to_date(stage, key):
+            logger.info(f"[{stage.name}] up to date, skipped")
+            return self.read_stamp(stage.name)["outputs"], False
+
+        logger.info(f"[{stage.name}] running ...")
+        start = time.perf_counter()
+        stage.run()
+
+        outputs = {path: file_digest(path) for path in stage.outputs()}
+        missing_outputs = [path for path, digest in outputs.items() if digest is None]
+        if missing_outputs:
+            raise RuntimeError(f"Stage {stage.name} did not produce {missing_outputs}")
+
+        tmp_stamp_path = self.stamp_path(stage.name) + ".tmp"
+        with open(tmp_stamp_path, "w") as f:
+            json.dump({"key": key, "outputs": outputs, "finished_at": time.time()}, f, indent=4)
+        os.replace(tmp_stamp_path, self.stamp_path(stage.name))
+
+        logger.info(f"[{stage.name}] done in {time.perf_counter() - start:.1f}s")
+        return outputs, True
+
+    def run(self):
+        """
+        Run all stages in dependency order, independent stages concurrently. A failed stage fails its downstream
+        stages, the other stages still run
+
+        Returns:
+            dict: stage name -> `ran`, `skipped`, `failed` or `blocked`
+        """
+        pending = dict(self.stages)
+        outputs = {}
+        status = {}
+
+        with ThreadPoolExecutor(max_workers = self.max_workers) as executor:
+            running = {}
+            while pending or running:
+                for name, stage in list(pending.items()):
+                    if any(status.get(dependency) in ("failed", "blocked") for dependency in stage.depends_on):
+                        status[name] = "blocked"
+                        del pending[name]
+                        logger.error(f"[{name}] not run, an upstream stage failed")
+                    elif all(dependency in outputs for dependency in stage.depends_on):
+                        del pending[name]
+                        upstream_outputs = {dependency: outputs[dependency] for dependency in stage.depends_on}
+                        running[executor.submit(self.run_stage, stage, upstream_outputs)] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when = FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        outputs[name], ran = future.result()
+                        status[name] = "ran" if ran else "skipped"
+                    except Exception as e:
+                        status[name] = "failed"
+                        logger.error(f"[{name}] failed: {e} (log: {self.log_path(name)})")
+
+        # stages waiting for stages which do not exist
+        for name in pending:
+            status[name] = "blocked"
+            logger.error(f"[{name}] not run, unknown upstream stages {[dependency for dependency in self.stages[name].depends_on if dependency not in self.stages]}")
+
+        return status
+
+
+def run_command(command, cwd, log_path):
+    """
+    Run a CLI of the repo, its output is appended to the log of the stage
+    """
+    with open(log_path, "a") as log_file:
+        log_file.write(f"$ (cd {cwd} && {' '.join(command)})\n")
+        log_file.flush()
+        subprocess.run(command, cwd = cwd, stdout = log_file, stderr = subprocess.STDOUT, check = True)
+
+
+def cli_arguments(arguments: dict):
+    command = []
+    for name, value in arguments.items():
+        if value is None:
+            continue
+        command.append(f"--{name}={json.dumps(value) if isinstance(value, (dict, list)) else value}")
+    return command
+
+
+def elicited_csv_path(template_file_name, wikidata_triples_dir):
+    """
+    csv file of a template, its index is kept in the elicitation state of the template
+    """
+    state_file_path = os.path.join(ELICITATION_DIR, "elicitation_state", f"{template_file_name}.json")
+    with open(state_file_path, "r") as f:
+        csv_file_index = json.load(f)["csv_file_index"]
+    return os.path.join(wikidata_triples_dir, f"wikidata_triples_{csv_file_index}.csv")
+
+
+def has_submitted_subjects(template_file_name):
+    state_file_path = os.path.join(ELICITATION_DIR, "elicitation_state", f"{template_file_name}.json")
+    if not os.path.isfile(state_file_path):
+        return False
+    with open(state_file_path, "r") as f:
+        subjects = json.load(f)["subjects"]
+    return any(record["status"] == "submitted" for record in subjects.values())
+
+
+def merge_results(results_file_paths, output_file_path):
+    """
+    Concatenate the results.csv files of the templates
+    """
+    # files of older runs may lack the newer columns, which are left empty for their rows
+    fieldnames, rows = {}, []
+    for results_file_path in results_file_paths:
+        with open(results_file_path, mode = 'r', newline = '') as f:
+            reader = csv.DictReader(f)
+            fieldnames.update(dict.fromkeys(reader.fieldnames or []))
+            rows.extend(reader)
+
+    with open(output_file_path, mode = 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = list(fieldnames))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(
+        template_path_dir: str,
+        wikidata_entities_file_path: str,
+        wikidata_triples_dir: str,
+        gpt_model_elicitation: str,
+        model_name: str,
+        seed: str,
+        verification_method: str,
+        sample_size: int,
+        metric: str,
+        results_dir_path: str,
+        elicitation_job_type: str = "realtime",
+        batch_poll_seconds: int = 600,
+        elicitation_args: dict = None,
+        eval_args: dict = None,
+        wikidata_dump_path: str = None,
+        sparql_endpoint: str = None,
+        stamp_dir: str = None,
+        max_workers: int = 4,
+        force: bool = False,
+):
+    """
+    Run the stages of the workflow which are not up to date
+
+    Arguments:
+        template_path_dir (str): Dir of the jinja files, every template gets its own elicit / gold / evaluate stages
+        wikidata_entities_file_path (str): File path storing the wikidata entities
+        wikidata_triples_dir (str): Dir path for storing the elicited triples
+        gpt_model_elicitation (str): Name of the model to use for elicitation
+        model_name (str): Name of the LLM that will be used for evaluation
+        seed (str): Seed of the evaluation sample
+        verification_method (str): Either wikidata or web
+        sample_size (int): Size of the random sample. Select -1 if you dont want to sample
+        metric (str): Type precision or recall
+        results_dir_path (str): Directory of the results, one sub directory per template and the merged results.csv
+        elicitation_job_type (str): Either realtime (chat completions endpoint) or batch (submit, then verify every `batch_poll_seconds` until done)
+        batch_poll_seconds (int): Seconds between two verify runs of a batch elicitation
+        elicitation_args (dict): Further arguments of `elicitation/main.py`, e.g. {"max_retries": 3}
+        eval_args (dict): Further arguments of `eval/main.py`, e.g. {"judge_backend": "rule", "deduplicate": "exact"}
+        wikidata_dump_path (str): Optional local Wikidata JSON dump used to build the gold triples
+        sparql_endpoint (str): Optional SPARQL endpoint used to build the gold triples in bulk
+        stamp_dir (str): Directory of the stage stamps and logs (default `.pipeline/` in the repo)
+        max_workers (int): Number of stages running at the same time
+        force (bool): Run every stage, even if it is up to date
+    """
+    if elicitation_job_type not in ELICITATION_JOB_TYPES:
+        raise ValueError(f"Unknown elicitation job type {elicitation_job_type}, expected one of {ELICITATION_JOB_TYPES}")
+
+    # the stages run in the CLI directories
+    template_path_dir = os.path.abspath(template_path_dir)
+    wikidata_entities_file_path = os.path.abspath(wikidata_entities_file_path)
+    wikidata_triples_dir = os.path.abspath(wikidata_triples_dir)
+    results_dir_path = os.path.abspath(results_dir_path)
+    wikidata_dump_path = os.path.abspath(wikidata_dump_path) if wikidata_dump_path else None
+    stamp_dir = os.path.abspath(stamp_dir or os.path.join(ROOT_DIR, ".pipeline"))
+    for directory in ("gold", "triples"):
+        os.makedirs(os.path.join(stamp_dir, directory), exist_ok=True)
+
+    pipeline = Pipeline(stamp_dir, max_workers, force)
+    # verify processes the completed batches of all templates, so only one runs at a time
+    verify_lock = threading.Lock()
+
+    entity_qids_path = os.path.join(stamp_dir, "entity_qids.json")
+    pipeline.add(Stage(
+        "entities",
+        run = lambda: run_command(
+            [sys.executable, "prepare_gold.py"] + cli_arguments({
+                "wikidata_entities_file_path": wikidata_entities_file_path,
+                "entity_qids_path": entity_qids_path,
+            }),
+            EVAL_DIR,
+            pipeline.log_path("entities"),
+        ),
+        outputs = lambda: [entity_qids_path],
+        input_files = [wikidata_entities_file_path],
+    ))
+
+    template_file_names = sorted(file_name for file_name in os.listdir(template_path_dir) if file_name.endswith(".jinja"))
+    for template_file_name in template_file_names:
+        template_name = template_file_name[:-len(".jinja")]
+
+        def elicit(template_file_name = template_file_name):
+            elicitation_command = [sys.executable, "main.py"] + cli_arguments({
+                "gpt_model_elicitation": gpt_model_elicitation,
+                "template_path_dir": template_path_dir,
+                "wikidata_entities_file_path": wikidata_entities_file_path,
+                "wikidata_triples_dir": wikidata_triples_dir,
+                "template_file_name": template_file_name,
+                **(elicitation_args or {}),
+            })
+            log_path = pipeline.log_path(f"elicit:{template_file_name}")
+            if elicitation_job_type == "realtime":
+                run_command(elicitation_command + ["--job_type=realtime"], ELICITATION_DIR, log_path)
+                return
+
+            run_command(elicitation_command + ["--job_type=submit"], ELICITATION_DIR, log_path)
+            # retry batches of the failed subjects are submitted by verify, so wait until nothing is in flight
+            while has_submitted_subjects(template_file_name):
+                time.sleep(batch_poll_seconds)
+                with verify_lock:
+                    run_command(elicitation_command + ["--job_type=verify"], ELICITATION_DIR, log_path)
+
+        pipeline.add(Stage(
+            f"elicit:{template_file_name}",
+            run = elicit,
+            outputs = lambda template_file_name = template_file_name: [elicited_csv_path(template_file_name, wikidata_triples_dir)],
+            inputs = {"gpt_model_elicitation": gpt_model_elicitation, "job_type": elicitation_job_type, "elicitation_args": elicitation_args},
+            input_files = [os.path.join(template_path_dir, template_file_name), wikidata_entities_file_path],
+        ))
+
+        gold_manifest_path = os.path.join(stamp_dir, "gold", f"{template_name}.json")
+        pipeline.add(Stage(
+            f"gold:{template_file_name}",
+            run = lambda template_file_name = template_file_name, gold_manifest_path = gold_manifest_path: run_command(
+                [sys.executable, "prepare_gold.py"] + cli_arguments({
+                    "wikidata_entities_file_path": wikidata_entities_file_path,
+                    "wikidata_triples_file_path": elicited_csv_path(template_file_name, wikidata_triples_dir),
+                    "manifest_path": gold_manifest_path,
+                    "wikidata_dump_path": wikidata_dump_path,
+                    "sparql_endpoint": sparql_endpoint,
+                }),
+                EVAL_DIR,
+                pipeline.log_path(f"gold:{template_file_name}"),
+            ),
+            outputs = lambda gold_manifest_path = gold_manifest_path: [gold_manifest_path],
+            inputs = {"wikidata_dump_path": wikidata_dump_path, "sparql_endpoint": sparql_endpoint},
+            depends_on = ["entities", f"elicit:{template_file_name}"],
+            # the manifest hashes the gold triples of the subjects, it is the gold version the evaluation depends on
+            always_run = True,
+        ))
+
+        template_results_dir = os.path.join(results_dir_path, template_name)
+
+        def evaluate(template_file_name = template_file_name, template_name = template_name, template_results_dir = template_results_dir):
+            # eval reads a dir of csv files, the csv of the template gets a dir of its own (same file name, for the jinja mapping)
+            csv_file_path = elicited_csv_path(template_file_name, wikidata_triples_dir)
+            template_triples_dir = os.path.join(stamp_dir, "triples", template_name)
+            shutil.rmtree(template_triples_dir, ignore_errors=True)
+            os.makedirs(template_triples_dir)
+            shutil.copy2(csv_file_path, template_triples_dir)
+
+            run_command(
+                [sys.executable, "main.py"] + cli_arguments({
+                    "wikidata_triples_dir": template_triples_dir,
+                    "wikidata_entities_file_path": wikidata_entities_file_path,
+                    "model_name": model_name,
+                    "seed": seed,
+                    "verification_method": verification_method,
+                    "sample_size": sample_size,
+                    "metric": metric,
+                    "results_dir_path": template_results_dir,
+                    "wikidata_dump_path": wikidata_dump_path,
+                    "sparql_endpoint": sparql_endpoint,
+                    **(eval_args or {}),
+                }),
+                EVAL_DIR,
+                pipeline.log_path(f"evaluate:{template_file_name}"),
+            )
+
+        pipeline.add(Stage(
+            f"evaluate:{template_file_name}",
+            run = evaluate,
+            outputs = lambda template_results_dir = template_results_dir: [os.path.join(template_results_dir, "results.csv")],
+            inputs = {
+                "model_name": model_name,
+                "seed": seed,
+                "verification_method": verification_method,
+                "sample_size": sample_size,
+                "metric": metric,
+                "eval_args": eval_args,
+            },
+            input_files = [wikidata_entities_file_path],
+            depends_on = [f"elicit:{template_file_name}", f"gold:{template_file_name}"],
+        ))
+
+    results_file_path = os.path.join(results_dir_path, "results.csv")
+    template_results_file_paths = [os.path.join(results_dir_path, file_name[:-len(".jinja")], "results.csv") for file_name in template_file_names]
+    pipeline.add(Stage(
+        "report",
+        run = lambda: merge_results(template_results_file_paths, results_file_path),
+        outputs = lambda: [results_file_path],
+        depends_on = [f"evaluate:{file_name}" for file_name in template_file_names],
+    ))
+
+    status = pipeline.run()
+    summary = {state: sorted(name for name, stage_status in status.items() if stage_status == state) for state in set(status.values())}
+    logger.info(f"Pipeline finished: {json.dumps(summary, indent=4)}")
+    if any(stage_status in ("failed", "blocked") for stage_status in status.values()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the eval and elicitation modules are flat scripts importing each other by module name
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT_DIR, "eval"), os.path.join(ROOT_DIR, "elicitation")]
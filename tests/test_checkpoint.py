@@ -0,0 +1,51 @@
+import json
+
+from checkpoint import CheckpointWriter, read_checkpoint
+
+
+def record(index):
+    return {"task_id": f"{index}:t", "output": "a"}
+
+
+def test_resume_after_an_interrupted_write(tmp_path):
+    file_path = str(tmp_path / "checkpoint.jsonl")
+    with CheckpointWriter(file_path, resume = False) as checkpoint:
+        checkpoint.write(record(0))
+        checkpoint.write(record(1))
+
+    # crash in the middle of writing the third record
+    with open(file_path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(record(2))[:15])
+    assert set(read_checkpoint(file_path)) == {"0:t", "1:t"}
+
+    with CheckpointWriter(file_path, resume = True) as checkpoint:
+        checkpoint.write(record(2))
+        checkpoint.write(record(3))
+
+    assert set(read_checkpoint(file_path)) == {"0:t", "1:t", "2:t", "3:t"}
+    with open(file_path, "r", encoding="utf-8") as f:
+        assert len(f.read().splitlines()) == 4
+
+
+def test_resume_keeps_complete_records_and_restart_drops_them(tmp_path):
+    file_path = str(tmp_path / "checkpoint.jsonl")
+    with CheckpointWriter(file_path, resume = True) as checkpoint:
+        checkpoint.write(record(0))
+    with CheckpointWriter(file_path, resume = True) as checkpoint:
+        checkpoint.write(record(1))
+    assert set(read_checkpoint(file_path)) == {"0:t", "1:t"}
+
+    with CheckpointWriter(file_path, resume = False) as checkpoint:
+        checkpoint.write(record(2))
+    assert set(read_checkpoint(file_path)) == {"2:t"}
+
+
+def test_truncated_single_line(tmp_path):
+    file_path = str(tmp_path / "checkpoint.jsonl")
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write('{"task_id": "0:')
+
+    with CheckpointWriter(file_path) as checkpoint:
+        checkpoint.write(record(1))
+
+    assert set(read_checkpoint(file_path)) == {"1:t"}
@@ -0,0 +1,32 @@
+from elicitation_state import ElicitationState, assign_csv_file_indices
+
+
+def save_index(state_dir_path, source_file_name, csv_file_index):
+    elicitation_state = ElicitationState(state_dir_path, source_file_name)
+    elicitation_state.csv_file_index = csv_file_index
+    elicitation_state.save()
+
+
+def test_added_template_gets_an_unused_index(tmp_path):
+    state_dir_path = str(tmp_path / "elicitation_state")
+
+    first_run = assign_csv_file_indices(state_dir_path, ["b.jinja", "d.jinja"])
+    assert first_run == {"b.jinja": 1, "d.jinja": 2}
+    for source_file_name, csv_file_index in first_run.items():
+        save_index(state_dir_path, source_file_name, csv_file_index)
+
+    # a.jinja and c.jinja sort before or between the submitted templates, they must not take their indices
+    second_run = assign_csv_file_indices(state_dir_path, ["d.jinja", "c.jinja", "a.jinja", "b.jinja"])
+    assert second_run == {"a.jinja": 3, "b.jinja": 1, "c.jinja": 4, "d.jinja": 2}
+
+
+def test_indices_of_removed_templates_and_older_runs_stay_reserved(tmp_path):
+    state_dir_path = str(tmp_path / "elicitation_state")
+    save_index(state_dir_path, "removed.jinja", 1)
+    # templates submitted before the state files existed are only in the jinja index mapping
+    jinja_file_mapping_path = tmp_path / "jinja_index_mapping.txt"
+    jinja_file_mapping_path.write_text("old.jinja wikidata_triples_2\nold.jinja wikidata_triples_2\n")
+
+    csv_file_indices = assign_csv_file_indices(state_dir_path, ["new.jinja", "old.jinja"], str(jinja_file_mapping_path))
+
+    assert csv_file_indices == {"new.jinja": 3, "old.jinja": 2}
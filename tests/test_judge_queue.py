@@ -0,0 +1,89 @@
+import os
+import subprocess
+import sys
+
+from judge_queue import DONE, JudgeQueue
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+JUDGE = "rule"
+
+
+def make_tasks(num_tasks):
+    return [
+        {
+            "task_id": f"{index}:t",
+            "subject": f"S{index % 5}",
+            "predicate": "p",
+            "triple_str": f"(S{index % 5}, p, o{index})",
+            "context": f"(S{index % 5} p o{index}), " if index % 2 else "(unrelated)",
+        }
+        for index in range(num_tasks)
+    ]
+
+
+def start_workers(queue_file_path, num_workers):
+    return [
+        subprocess.Popen(
+            [
+                sys.executable, os.path.join(ROOT_DIR, "eval", "judge_queue.py"), "worker", queue_file_path,
+                "--judge_backend=rule", "--claim_size=3", "--poll_interval=0.2", f"--worker_id=worker{index}",
+            ],
+            cwd=os.path.join(ROOT_DIR, "eval"),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        for index in range(num_workers)
+    ]
+
+
+def test_workers_judge_every_task_once_and_recover_expired_leases(tmp_path):
+    queue_file_path = str(tmp_path / "queue.sqlite")
+    queue = JudgeQueue(queue_file_path)
+    queue.enqueue("file_precision_1", make_tasks(40), JUDGE)
+
+    # a crashed worker: its lease expires and the tasks are judged by the others
+    crashed_tasks = queue.claim("crashed", JUDGE, batch_size=5, lease_seconds=1.0)
+    assert len(crashed_tasks) == 5
+
+    workers = start_workers(queue_file_path, 4)
+    for worker in workers:
+        _, stderr = worker.communicate(timeout=120)
+        assert worker.returncode == 0, stderr
+
+    assert queue.counts() == {"pending": 0, "leased": 0, DONE: 40, "failed": 0}
+    rows = queue.connection.execute("SELECT task_id, status, worker, output FROM tasks").fetchall()
+    assert len({task_id for task_id, _, _, _ in rows}) == 40
+    assert all(status == DONE and output in ("a", "b", "c", "d") for _, status, _, output in rows)
+    assert {worker for task_id, _, worker, _ in rows if task_id in {task["task_id"] for task in crashed_tasks}} != {"crashed"}
+
+    # a late verdict of the crashed worker does not replace the written one
+    outputs = queue.outputs("file_precision_1")
+    assert queue.complete("crashed", [(task["job"], task["task_id"], "x") for task in crashed_tasks]) == 0
+    assert queue.outputs("file_precision_1") == outputs
+    queue.close()
+
+
+def test_released_claims_do_not_fail_tasks(tmp_path):
+    queue = JudgeQueue(str(tmp_path / "queue.sqlite"))
+    queue.enqueue("job", make_tasks(1), JUDGE)
+    for _ in range(10):
+        queue.release("worker", queue.claim("worker", JUDGE, max_attempts=5))
+    assert queue.counts(max_attempts=5)["pending"] == 1
+
+    for _ in range(5):
+        queue.claim("worker", JUDGE, lease_seconds=-1.0, max_attempts=5)
+    assert queue.counts(max_attempts=5)["failed"] == 1
+    assert queue.claim("worker", JUDGE, max_attempts=5) == []
+    assert queue.requeue_failed(max_attempts=5) == 1
+    assert len(queue.claim("worker", JUDGE, max_attempts=5)) == 1
+    queue.close()
+
+
+def test_workers_only_claim_jobs_of_their_judge(tmp_path):
+    queue = JudgeQueue(str(tmp_path / "queue.sqlite"))
+    queue.enqueue("job", make_tasks(3), "openai:gpt-4o-mini:prefix_cache")
+    assert queue.claim("worker", JUDGE) == []
+    assert queue.counts(judge=JUDGE)["pending"] == 0
+    queue.close()
@@ -0,0 +1,83 @@
+import bz2
+import os
+import shutil
+
+import pytest
+
+import entity_resolver
+from gold_store import GoldStore
+from wikidata_dump import build_gold_records_from_dump, collect_labels, collect_subject_claims
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "wikidata_dump.json")
+
+
+@pytest.fixture(params=[".json", ".json.bz2"])
+def dump_path(request, tmp_path):
+    if request.param == ".json":
+        return FIXTURE_PATH
+    path = str(tmp_path / "wikidata_dump.json.bz2")
+    with open(FIXTURE_PATH, "rb") as source, bz2.open(path, "wb") as target:
+        shutil.copyfileobj(source, target)
+    return path
+
+
+def test_label_match_keeps_the_entity_with_most_sitelinks(dump_path):
+    # three entities are labelled "Kurt Gödel", Q1 has the most sitelinks and sits between the other two
+    matched = collect_subject_claims(dump_path, ["Kurt Gödel", "Nobody"])
+
+    assert list(matched) == ["Kurt Gödel"]
+    assert matched["Kurt Gödel"]["qid"] == "Q1"
+    assert matched["Kurt Gödel"]["lastrevid"] == 101
+    # the novalue and time claims are dropped, only claims referring to entities are kept
+    assert matched["Kurt Gödel"]["claims"] == [("P27", "Q3"), ("P106", "Q4"), ("P106", "Q99")]
+
+
+def test_id_match_wins_over_the_label(dump_path):
+    matched = collect_subject_claims(dump_path, ["Kurt Gödel", "The capital"], {"Kurt Gödel": "Q7", "The capital": "Q6"})
+
+    assert matched["Kurt Gödel"]["qid"] == "Q7"
+    assert matched["The capital"]["qid"] == "Q6"
+    assert matched["The capital"]["claims"] == [("P17", "Q3")]
+
+
+def test_description_is_not_taken_for_a_missing_label(dump_path):
+    # Q8 has no english label, the prefix regex reaches into its description "fixture entity"
+    assert collect_subject_claims(dump_path, ["fixture entity"]) == {}
+
+
+def test_collect_labels_of_items_and_properties(dump_path):
+    labels = collect_labels(dump_path, {"P27", "Q3", "Q8", "Q99"})
+
+    assert labels == {"P27": "country of citizenship", "Q3": "Austria"}
+
+
+def test_build_gold_records(dump_path):
+    gold_records = build_gold_records_from_dump(["Kurt Gödel", "Vienna", "Nobody", "Vienna"], dump_path)
+
+    assert list(gold_records) == ["Kurt Gödel", "Vienna"]
+    assert gold_records["Kurt Gödel"] == {
+        "qid": "Q1",
+        "lastrevid": 101,
+        "modified": "2024-01-03T00:00:00Z",
+        # Q99 is not in the dump, its triple has no label and is dropped
+        "triples": [
+            {"subject": "Kurt Gödel", "predicate": "country of citizenship", "object": "Austria"},
+            {"subject": "Kurt Gödel", "predicate": "occupation", "object": "mathematician"},
+        ],
+    }
+    assert gold_records["Vienna"]["triples"] == [{"subject": "Vienna", "predicate": "country", "object": "Austria"}]
+
+
+def test_sanity_check_from_the_dump_stays_offline(dump_path, tmp_path, monkeypatch):
+    def no_network(*args, **kwargs):
+        raise AssertionError("the web api was called in dump mode")
+
+    monkeypatch.setattr(entity_resolver, "get_wikidata_entity_id", no_network)
+    resolver = entity_resolver.EntityResolver(str(tmp_path / "entity_qids.json"))
+    resolver.add_precomputed({"The capital": "Q6"})
+    gold_store = GoldStore(str(tmp_path / "gold"))
+
+    entity_qids = gold_store.check_entities(["Kurt Gödel", "The capital", "Nobody"], resolver, dump_path)
+
+    assert entity_qids == {"Kurt Gödel": "Q1", "The capital": "Q6", "Nobody": None}
+    assert gold_store.missing(["Kurt Gödel", "The capital", "Nobody"]) == []
@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from wikidata_sparql import build_gold_records_from_sparql, fetch_claims_sparql, fetch_revisions_sparql
+
+pytest.importorskip("rdflib")
+
+FIXTURE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "wikidata_sparql.ttl")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 50])
+def test_claims_join_the_english_labels(chunk_size):
+    claims = fetch_claims_sparql(["Q1", "Q6", "Q1"], FIXTURE_PATH, chunk_size)
+
+    # statements of all ranks, values without an english label and literal values drop out, truthy triples are not claims
+    assert sorted(claims["Q1"]) == [("country of citizenship", "Austria"), ("occupation", "mathematician")]
+    assert claims["Q6"] == [("country", "Austria")]
+
+
+def test_claims_in_another_language():
+    claims = fetch_claims_sparql(["Q1"], FIXTURE_PATH, language="de")
+
+    assert claims == {"Q1": [("Staatsangehörigkeit", "Österreich")]}
+
+
+def test_revisions():
+    revisions = fetch_revisions_sparql(["Q1", "Q6"], FIXTURE_PATH)
+
+    assert revisions["Q1"] == {"lastrevid": 101, "modified": "2024-01-03T00:00:00Z"}
+    # an endpoint returns Q6 with both OPTIONALs unbound, rdflib leaves the row out, both read as "no revision"
+    assert revisions.get("Q6", {"lastrevid": None, "modified": None}) == {"lastrevid": None, "modified": None}
+
+
+def test_build_gold_records():
+    gold_records = build_gold_records_from_sparql(
+        {"Kurt Gödel": "Q1", "Vienna": "Q6", "Nobody": None, "Unknown": "Q42"}, FIXTURE_PATH, chunk_size=2
+    )
+
+    assert list(gold_records) == ["Kurt Gödel", "Vienna", "Unknown"]
+    assert gold_records["Kurt Gödel"]["qid"] == "Q1"
+    assert gold_records["Kurt Gödel"]["lastrevid"] == 101
+    assert sorted(gold_records["Kurt Gödel"]["triples"], key=lambda triple: triple["predicate"]) == [
+        {"subject": "Kurt Gödel", "predicate": "country of citizenship", "object": "Austria"},
+        {"subject": "Kurt Gödel", "predicate": "occupation", "object": "mathematician"},
+    ]
+    assert gold_records["Vienna"]["triples"] == [{"subject": "Vienna", "predicate": "country", "object": "Austria"}]
+    assert gold_records["Unknown"] == {"qid": "Q42", "lastrevid": None, "modified": None, "triples": []}